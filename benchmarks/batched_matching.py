@@ -0,0 +1,89 @@
+"""Compare the throughput of batched matching to the single-pair path.
+
+Pairs of a feature file are matched one by one, as in match_features, and
+in batches of increasing sizes, bucketed by numbers of keypoints as in
+match_features_batch. The features are read beforehand such that only
+the matching is timed. The matches of each batch size are compared to the
+single-pair ones.
+
+Usage: python -m benchmarks.batched_matching --features <h5> --pairs <txt>
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+import h5py
+import numpy as np
+import torch
+
+from hloc import match_features, matchers
+from hloc.match_features_batch import batch_data, bucket_pairs
+from hloc.match_features import pair_data
+from hloc.plan_pairs import parse_pairs, plan_pairs
+from hloc.utils.base_model import dynamic_load
+from hloc.utils.feature_cache import FeatureCache
+
+
+@torch.no_grad()
+def run(model, inputs):
+    """Match the inputs and return the matches of each pair and the time."""
+    model(inputs[0][0])  # warmup
+    matches = []
+    t = time.perf_counter()
+    for data, nums in inputs:
+        pred = model(data)['matches0']
+        matches += [pred[i, :n] for i, n in enumerate(nums)]
+    return matches, time.perf_counter() - t
+
+
+def main(features, pairs, matcher_conf, batch_sizes=(1, 2, 4, 8, 16, 32, 64),
+         num_pairs=512, num_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    pair_list = plan_pairs(parse_pairs(pairs))[:num_pairs]
+    hfile = h5py.File(str(features), 'r')
+    cache = FeatureCache(1 << 40)
+    feats = [(cache.read(hfile, n0), cache.read(hfile, n1))
+             for n0, n1 in pair_list]
+    logging.info(f'Loaded the features of {len(pair_list)} pairs, '
+                 f'{cache.size/1e6:.1f}MB.')
+    Model = dynamic_load(matchers, matcher_conf['model']['name'])
+    model = Model(matcher_conf['model']).eval()
+
+    inputs = [(pair_data(f0, f1, 'cpu'), [len(f0['keypoints'])])
+              for f0, f1 in feats]
+    ref, t_ref = run(model, inputs)
+    logging.info(f'Single pairs: {len(ref)/t_ref:.1f} pairs/s')
+
+    index = {p: i for i, p in enumerate(pair_list)}
+    shape = {p: (len(f0['keypoints']), len(f1['keypoints']))
+             for p, (f0, f1) in zip(pair_list, feats)}
+    for batch_size in batch_sizes:
+        batches = bucket_pairs(pair_list, shape.get, batch_size)
+        inputs = [(batch_data([feats[index[p]] for p in b]),
+                   [shape[p][0] for p in b]) for b in batches]
+        masks = [d[f'mask{i}'] for d, _ in inputs for i in range(2)]
+        padding = 1 - sum(int(m.sum()) for m in masks) / sum(
+            m.numel() for m in masks)
+        matches, t = run(model, inputs)
+        order = [index[p] for b in batches for p in b]
+        same = np.mean([torch.equal(m, ref[i])
+                        for m, i in zip(matches, order)])
+        logging.info(f'Batch size {batch_size:>2}: {len(matches)/t:.1f} '
+                     f'pairs/s ({t_ref/t:.2f}x), padding {padding:.1%}, '
+                     f'identical matches {same:.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', type=Path, required=True)
+    parser.add_argument('--pairs', type=Path, required=True)
+    parser.add_argument('--matcher', type=str, default='superglue',
+                        choices=list(match_features.confs.keys()))
+    parser.add_argument('--batch_sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--num_pairs', type=int, default=512)
+    parser.add_argument('--num_threads', type=int)
+    args = parser.parse_args()
+    main(args.features, args.pairs, match_features.confs[args.matcher],
+         args.batch_sizes, args.num_pairs, args.num_threads)
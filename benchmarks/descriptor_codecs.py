@@ -0,0 +1,134 @@
+"""Measure the recall loss of the descriptor codecs on held-out pairs.
+
+The codecs are fitted on the descriptors of a random half of the images and
+evaluated on pairs of images of the other half. For each pair, the mutual
+nearest neighbor matches computed on the compressed descriptors are compared
+to those computed on the original descriptors: recall is the fraction of the
+original matches that are recovered, precision the fraction of compressed
+matches that are original matches. Features are either synthetic or read
+from an existing feature file, with optional pairs.
+
+Usage: python -m benchmarks.descriptor_codecs [--features <h5> --pairs <txt>]
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+import h5py
+import numpy as np
+import torch
+
+from hloc.compress_features import confs
+from hloc.matchers.nearest_neighbor import NearestNeighbor
+from hloc.utils.codecs import build_codec
+from hloc.utils.io import read_feature, list_names
+from hloc.utils.parsers import parse_retrieval
+
+
+def synthetic_descriptors(num_images, num_keypoints=2048, dim=256, rank=48,
+                          overlap=.5, noise=.6, seed=0):
+    """Correlated descriptors where consecutive images share keypoints."""
+    rng = np.random.RandomState(seed)
+    basis = rng.randn(dim, rank)
+
+    def sample(num):
+        return (basis @ rng.randn(rank, num) / np.sqrt(rank)
+                + .3 * rng.randn(dim, num))
+
+    desc, previous = {}, sample(num_keypoints)
+    for i in range(num_images):
+        shared = int(overlap * num_keypoints)
+        d = np.concatenate([
+            previous[:, :shared] + noise * rng.randn(dim, shared),
+            sample(num_keypoints - shared)], 1)
+        previous = d[:, rng.permutation(num_keypoints)]
+        desc[f'image_{i:04d}.jpg'] = (
+            d / np.linalg.norm(d, axis=0, keepdims=True)).astype(np.float32)
+    pairs = [(f'image_{i:04d}.jpg', f'image_{i+1:04d}.jpg')
+             for i in range(num_images-1)]
+    return desc, pairs
+
+
+def descriptors_from_file(path, pairs_path=None):
+    with h5py.File(str(path), 'r') as hfile:
+        desc = {n: read_feature(hfile[n], 'descriptors')
+                for n in list_names(hfile)}
+    if pairs_path is None:
+        names = sorted(desc)
+        pairs = list(zip(names[:-1], names[1:]))
+    else:
+        pairs = [(q, r) for q, rs in parse_retrieval(pairs_path).items()
+                 for r in rs]
+    return desc, pairs
+
+
+def match(model, data):
+    return model(data)['matches0'][0].cpu().numpy()
+
+
+def main(features=None, pairs=None, codecs=None, num_pairs=100,
+         num_samples=100000, seed=0):
+    if features is None:
+        desc, pair_list = synthetic_descriptors(2 * num_pairs + 2)
+    else:
+        desc, pair_list = descriptors_from_file(features, pairs)
+
+    rng = np.random.RandomState(seed)
+    names = sorted(desc)
+    train = set(rng.permutation(names)[:len(names)//2])
+    test_pairs = [(a, b) for a, b in pair_list
+                  if a not in train and b not in train]
+    test_pairs = [test_pairs[i] for i in rng.permutation(
+        len(test_pairs))[:num_pairs]]
+    train_desc = np.concatenate([desc[n] for n in sorted(train)], 1)
+    train_desc = train_desc[:, rng.choice(
+        train_desc.shape[1], min(num_samples, train_desc.shape[1]),
+        replace=False)]
+    dim = train_desc.shape[0]
+    logging.info(f'Fitting on {train_desc.shape[1]} descriptors of '
+                 f'{len(train)} images, evaluating on {len(test_pairs)} '
+                 'held-out pairs.')
+
+    matcher_conf = {'do_mutual_check': True, 'distance_threshold': .7}
+    reference = NearestNeighbor(matcher_conf)
+    raw = []
+    for a, b in test_pairs:
+        raw.append(match(reference, {
+            'descriptors0': torch.from_numpy(desc[a])[None],
+            'descriptors1': torch.from_numpy(desc[b])[None]}))
+
+    for name in codecs or confs:
+        codec = build_codec(confs[name]).fit(train_desc)
+        model = NearestNeighbor({**matcher_conf, 'codec': codec})
+        found = correct = expected = 0
+        times = []
+        for (a, b), m_raw in zip(test_pairs, raw):
+            data = {}
+            for i, n in enumerate([a, b]):
+                for k, v in codec.encode(desc[n]).items():
+                    data[k+str(i)] = torch.from_numpy(v)[None]
+            t = time.perf_counter()
+            m = match(model, data)
+            times.append(time.perf_counter() - t)
+            valid = m > -1
+            found += valid.sum()
+            correct += (valid & (m == m_raw)).sum()
+            expected += (m_raw > -1).sum()
+        logging.info(
+            f'{name:>7}: {codec.bytes_per_descriptor(dim):4d} bytes/desc '
+            f'({100*codec.bytes_per_descriptor(dim)/(4*dim):5.1f}%), '
+            f'recall {100*correct/max(expected, 1):5.1f}%, '
+            f'precision {100*correct/max(found, 1):5.1f}%, '
+            f'match {1e3*np.mean(times):.1f}ms/pair')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', type=Path)
+    parser.add_argument('--pairs', type=Path)
+    parser.add_argument('--codecs', nargs='+', choices=list(confs.keys()))
+    parser.add_argument('--num_pairs', type=int, default=100)
+    parser.add_argument('--num_samples', type=int, default=100000)
+    args = parser.parse_args()
+    main(args.features, args.pairs, args.codecs, args.num_pairs,
+         args.num_samples)
@@ -0,0 +1,62 @@
+"""Measure the per-query latency of the in-memory FeatureExtractor.
+
+Usage: python -m benchmarks.feature_extractor_latency --image_dir <dir>
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+import numpy as np
+
+from hloc import extract_features
+from hloc.extract_features import FeatureExtractor, ImageDataset
+
+
+def percentiles(times):
+    times = np.array(times) * 1e3
+    return (f'mean {times.mean():.1f}ms, p50 {np.percentile(times, 50):.1f}'
+            f'ms, p90 {np.percentile(times, 90):.1f}ms, '
+            f'p99 {np.percentile(times, 99):.1f}ms')
+
+
+def main(conf, image_dir, num_queries=100, num_warmup=5, batch_size=1):
+    paths = ImageDataset(image_dir, conf['preprocessing']).paths
+    buffers = []
+    for i in range(num_queries + num_warmup):
+        with open(str(Path(image_dir, paths[i % len(paths)])), 'rb') as f:
+            buffers.append(f.read())
+
+    extractor = FeatureExtractor(conf)
+    for b in buffers[:num_warmup]:
+        extractor.extract(b)
+
+    prepare, total = [], []
+    buffers = buffers[num_warmup:]
+    for i in range(0, len(buffers), batch_size):
+        batch = buffers[i:i+batch_size]
+        t0 = time.perf_counter()
+        for b in batch:
+            extractor.prepare(b)
+        t1 = time.perf_counter()
+        extractor.extract_batch(batch)
+        t2 = time.perf_counter()
+        prepare.append((t1 - t0) / len(batch))
+        total.append((t2 - t1) / len(batch))
+
+    logging.info(f'Decoding and preprocessing per image: '
+                 f'{percentiles(prepare)}')
+    logging.info(f'End-to-end extraction per image, batch size '
+                 f'{batch_size}: {percentiles(total)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type=Path, required=True)
+    parser.add_argument('--conf', type=str, default='superpoint_aachen',
+                        choices=list(extract_features.confs.keys()))
+    parser.add_argument('--num_queries', type=int, default=100)
+    parser.add_argument('--num_warmup', type=int, default=5)
+    parser.add_argument('--batch_size', type=int, default=1)
+    args = parser.parse_args()
+    main(extract_features.confs[args.conf], args.image_dir,
+         args.num_queries, args.num_warmup, args.batch_size)
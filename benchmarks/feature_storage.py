@@ -0,0 +1,89 @@
+"""Compare the storage layouts of feature files.
+
+For each layout, report the bytes on disk, the write throughput, the latency
+of reading the features of a random image, and the decoding error.
+Features are either synthetic or copied from an existing feature file.
+
+Usage: python -m benchmarks.feature_storage --output_dir <dir>
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+import h5py
+import numpy as np
+
+from hloc.utils.io import layouts, write_features, read_features, list_names
+
+
+def synthetic_features(num_images, num_keypoints=4096, dim=256, seed=0):
+    rng = np.random.RandomState(seed)
+    for i in range(num_images):
+        desc = rng.randn(dim, num_keypoints).astype(np.float32)
+        desc /= np.linalg.norm(desc, axis=0, keepdims=True)
+        yield f'image_{i:06d}.jpg', {
+            'keypoints': (rng.rand(num_keypoints, 2) * 1024).astype(
+                np.float32),
+            'scores': rng.rand(num_keypoints).astype(np.float32),
+            'descriptors': desc,
+            'image_size': np.array([1024, 768]),
+        }
+
+
+def features_from_file(path, num_images):
+    with h5py.File(str(path), 'r') as hfile:
+        for name in list_names(hfile)[:num_images]:
+            yield name, read_features(hfile[name])
+
+
+def main(output_dir, num_images=200, num_reads=500, features=None):
+    output_dir.mkdir(exist_ok=True, parents=True)
+    if features is None:
+        data = list(synthetic_features(num_images))
+    else:
+        data = list(features_from_file(features, num_images))
+    raw_bytes = sum(v.nbytes for _, p in data for v in p.values())
+    logging.info(f'Benchmarking {len(data)} images, '
+                 f'{raw_bytes/1e6:.1f}MB of raw features.')
+
+    rng = np.random.RandomState(0)
+    for name, layout in layouts.items():
+        path = output_dir / f'feats-{name}.h5'
+        if path.exists():
+            path.unlink()
+        t = time.perf_counter()
+        with h5py.File(str(path), 'w') as hfile:
+            for n, pred in data:
+                write_features(hfile.create_group(n), pred, layout)
+        write_time = time.perf_counter() - t
+
+        errors = {}
+        read_times = []
+        with h5py.File(str(path), 'r') as hfile:
+            for i in rng.randint(len(data), size=num_reads):
+                n, pred = data[i]
+                t = time.perf_counter()
+                decoded = read_features(hfile[n])
+                read_times.append(time.perf_counter() - t)
+                for k, v in pred.items():
+                    err = np.abs(decoded[k].astype(np.float64) - v).max()
+                    errors[k] = max(errors.get(k, 0), err)
+
+        size = path.stat().st_size
+        read_times = np.array(read_times) * 1e3
+        logging.info(
+            f'{name:>10}: {size/1e6:8.1f}MB ({100*size/raw_bytes:5.1f}%), '
+            f'write {raw_bytes/1e6/write_time:7.1f}MB/s, '
+            f'read p50 {np.median(read_times):.2f}ms '
+            f'p99 {np.percentile(read_times, 99):.2f}ms, max error '
+            + ', '.join(f'{k} {v:.2g}' for k, v in errors.items()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', type=Path, required=True)
+    parser.add_argument('--features', type=Path)
+    parser.add_argument('--num_images', type=int, default=200)
+    parser.add_argument('--num_reads', type=int, default=500)
+    args = parser.parse_args()
+    main(args.output_dir, args.num_images, args.num_reads, args.features)
@@ -0,0 +1,113 @@
+"""Compare the speed and accuracy of the CPU inference backends.
+
+The extractor runs on images of a directory and the matcher on pairs of
+features of the resulting feature file. Each backend is compared to the
+eager fp32 model: for the extractor, the fraction of keypoints repeated
+within 1 pixel and the cosine similarity of their descriptors; for the
+matcher, the fraction of identical matches.
+
+Usage: python -m benchmarks.inference_backends --image_dir <dir>
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+from hloc import extract_features, match_features, extractors, matchers
+from hloc.extract_features import ImageDataset
+from hloc.utils.base_model import dynamic_load
+
+backends = ['eager', 'torchscript', 'compile', 'quantized']
+
+
+def load_model(root, conf, backend, num_threads):
+    Model = dynamic_load(root, conf['name'])
+    return Model({**conf, 'backend': backend,
+                  'num_threads': num_threads}).eval()
+
+
+@torch.no_grad()
+def run(model, inputs, num_warmup=2):
+    for data in inputs[:num_warmup]:
+        model(data)
+    outputs, times = [], []
+    for data in inputs:
+        t = time.perf_counter()
+        outputs.append(model(data))
+        times.append(time.perf_counter() - t)
+    return outputs, 1e3 * np.median(times)
+
+
+def compare_features(ref, pred):
+    repeat, cos = [], []
+    for r, p in zip(ref, pred):
+        kr, kp = r['keypoints'][0].numpy(), p['keypoints'][0].numpy()
+        dist, idx = cKDTree(kp).query(kr)
+        valid = dist < 1
+        repeat.append(valid.mean())
+        dr = r['descriptors'][0].numpy()[:, valid]
+        dp = p['descriptors'][0].numpy()[:, idx[valid]]
+        cos.append((dr * dp).sum(0).mean())
+    return f'repeatability {np.mean(repeat):.3f}, cosine {np.mean(cos):.4f}'
+
+
+def compare_matches(ref, pred):
+    same = [(r['matches0'] == p['matches0']).float().mean().item()
+            for r, p in zip(ref, pred)]
+    return f'identical matches {np.mean(same):.3f}'
+
+
+def main(image_dir, extractor_conf, matcher_conf, num_images=20,
+         num_threads=None):
+    dataset = ImageDataset(image_dir, extractor_conf['preprocessing'])
+    images = [{'image': torch.from_numpy(dataset[i]['image'])[None].float()}
+              for i in range(min(num_images, len(dataset)))]
+
+    features = None
+    for backend in backends:
+        model = load_model(
+            extractors, extractor_conf['model'], backend, num_threads)
+        preds, t = run(model, images)
+        if backend == 'eager':
+            ref, features = preds, preds
+            logging.info(f'Extractor {backend:>11}: {t:.1f}ms')
+        else:
+            logging.info(f'Extractor {backend:>11}: {t:.1f}ms, '
+                         f'{compare_features(ref, preds)}')
+
+    pairs = []
+    for f0, f1, im0, im1 in zip(features[:-1], features[1:],
+                                images[:-1], images[1:]):
+        data = {k+'0': v[0][None] for k, v in f0.items()}
+        data.update({k+'1': v[0][None] for k, v in f1.items()})
+        data['image0'], data['image1'] = im0['image'], im1['image']
+        pairs.append(data)
+
+    for backend in backends:
+        model = load_model(
+            matchers, matcher_conf['model'], backend, num_threads)
+        preds, t = run(model, pairs)
+        if backend == 'eager':
+            ref = preds
+            logging.info(f'Matcher {backend:>11}: {t:.1f}ms')
+        else:
+            logging.info(f'Matcher {backend:>11}: {t:.1f}ms, '
+                         f'{compare_matches(ref, preds)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type=Path, required=True)
+    parser.add_argument('--extractor', type=str, default='superpoint_aachen',
+                        choices=list(extract_features.confs.keys()))
+    parser.add_argument('--matcher', type=str, default='superglue',
+                        choices=list(match_features.confs.keys()))
+    parser.add_argument('--num_images', type=int, default=20)
+    parser.add_argument('--num_threads', type=int)
+    args = parser.parse_args()
+    main(args.image_dir, extract_features.confs[args.extractor],
+         match_features.confs[args.matcher], args.num_images,
+         args.num_threads)
@@ -0,0 +1,53 @@
+"""Compare the full and reduced-resolution JPEG decoding of ImageDataset.
+
+Report the time to load and preprocess an image with both paths, and the
+mean and 99th percentile of the absolute difference of the network inputs,
+as a fraction of the intensity range.
+
+Usage: python -m benchmarks.reduced_decoding --image_dir <dir>
+"""
+import argparse
+import logging
+import time
+from pathlib import Path
+import numpy as np
+
+from hloc.extract_features import ImageDataset
+
+
+def main(image_dir, resize_max=1024, grayscale=True, num_images=50):
+    conf = {'resize_max': resize_max, 'grayscale': grayscale}
+    full = ImageDataset(image_dir, conf)
+    reduced = ImageDataset(image_dir, {**conf, 'reduced_decoding': True})
+
+    times = {'full': [], 'reduced': []}
+    mean_diff, p99_diff = [], []
+    for i in range(min(num_images, len(full))):
+        t = time.perf_counter()
+        a = full[i]
+        times['full'].append(time.perf_counter() - t)
+        t = time.perf_counter()
+        b = reduced[i]
+        times['reduced'].append(time.perf_counter() - t)
+
+        assert np.all(a['original_size'] == b['original_size'])
+        assert a['image'].shape == b['image'].shape
+        diff = np.abs(a['image'] - b['image'])
+        mean_diff.append(diff.mean())
+        p99_diff.append(np.percentile(diff, 99))
+
+    for k, v in times.items():
+        logging.info(f'{k:>8} decoding: {1e3*np.mean(v):.1f}ms per image')
+    logging.info(f'Absolute difference: mean {100*np.mean(mean_diff):.2f}%, '
+                 f'99th percentile {100*np.mean(p99_diff):.2f}%, worst '
+                 f'image mean {100*np.max(mean_diff):.2f}%.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type=Path, required=True)
+    parser.add_argument('--resize_max', type=int, default=1024)
+    parser.add_argument('--color', action='store_true')
+    parser.add_argument('--num_images', type=int, default=50)
+    args = parser.parse_args()
+    main(args.image_dir, args.resize_max, not args.color, args.num_images)
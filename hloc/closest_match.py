@@ -4,11 +4,15 @@ import h5py
 import numpy as np
 import torch
 from tqdm import tqdm
-from signal import signal, SIGINT
 
 from . import matchers
 from .utils.base_model import dynamic_load
 from .utils.parsers import names_to_pair
+from .match_features import load_matcher, pair_data
+from .utils.ann import IVFIndex
+from .utils.global_descriptors import GlobalDescriptors
+from .utils.feature_cache import FeatureCache, Prefetcher
+from .utils.journal import MatchJournal
 
 
 '''
@@ -43,28 +47,28 @@ def get_model(conf):
     return model
 
 @torch.no_grad()
-def do_match (name0, name1, pairs, matched, num_matches_found, model, match_file, feat0_file, feat1_file, min_match_score, min_valid_ratio):
+def do_match (name0, name1, pairs, matched, num_matches_found, model, journal, feat0_file, feat1_file, min_match_score, min_valid_ratio, codec=None, cache=None):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     if name0 != name1 :
         pair = names_to_pair(name0, name1)
 
         # Avoid to recompute duplicates to save time
         #if len({(name0, name1), (name1, name0)} & matched) or pair in match_file:
-        if len({(name0, name1), (name1, name0)} & matched) \
-                or pair in match_file:
+        if len({(name0, name1), (name1, name0)} & matched):
             return num_matches_found
-        data = {}
-        feats0, feats1 = feat0_file[name0], feat1_file[name1]
-        for k in feats1.keys():
-            data[k+'0'] = feats0[k].__array__()
-        for k in feats1.keys():
-            data[k+'1'] = feats1[k].__array__()
-        data = {k: torch.from_numpy(v)[None].float().to(device)
-                for k, v in data.items()}
-
-        # some matchers might expect an image but only use its size
-        data['image0'] = torch.empty((1, 1,)+tuple(feats0['image_size'])[::-1])
-        data['image1'] = torch.empty((1, 1,)+tuple(feats1['image_size'])[::-1])
+        if journal.recovering and pair in journal.rejected:
+            return num_matches_found
+        if pair in journal:
+            # matched and valid in a previous run
+            pairs.append((name0, name1))
+            matched |= {(name0, name1), (name1, name0)}
+            return num_matches_found + 1
+        if cache is not None:
+            feats0 = cache.read(feat0_file, name0)
+            feats1 = cache.read(feat1_file, name1)
+        else:
+            feats0, feats1 = feat0_file[name0], feat1_file[name1]
+        data = pair_data(feats0, feats1, device, codec)
 
         pred = model(data)
         matches = pred['matches0'][0].cpu().short().numpy()
@@ -75,72 +79,78 @@ def do_match (name0, name1, pairs, matched, num_matches_found, model, match_file
         print(f'{len(matches)} matches, valid ratio {float(num_valid)/len(matches)}')
         if float(num_valid)/len(matches) > min_valid_ratio:
             pairs.append((name0, name1))
-            grp = match_file.create_group(pair)
-            grp.create_dataset('matches0', data=matches)
-            grp.create_dataset('matching_scores0', data=scores)
+            journal.write(pair, matches0=matches, matching_scores0=scores)
             matched |= {(name0, name1), (name1, name0)}
             num_matches_found += 1
+        else:
+            journal.reject(pair)
     return num_matches_found
 
-done_match = False
-def handler(signal_received, frame):
-    global done_match
-    # Handle any cleanup here
-    print('SIGINT or CTRL-C detected. Exiting gracefully')
-    done_match = True
-
 @torch.no_grad()
-def main(conf, desc1, desc2, feat1, feat2, num_matched, match_output, pair_output=None, min_match_score=0.85, min_valid_ratio=0.2):
-    hfile1 = h5py.File(str(desc1), 'r')
-    hfile2 = h5py.File(str(desc2), 'r')
+def main(conf, desc1, desc2, feat1, feat2, num_matched, match_output, pair_output=None, min_match_score=0.85, min_valid_ratio=0.2, index=None, num_probes=None, num_neighbors=None, cache_size=1 << 30, checkpoint_interval=60):
+    global1 = GlobalDescriptors(desc1)
+    global2 = GlobalDescriptors(desc2)
     hfeat1 = h5py.File(str(feat1), 'r')
     hfeat2 = h5py.File(str(feat2), 'r')
 
-    names1 = []
-    hfile1.visititems(
-        lambda _, obj: names1.append(obj.parent.name.strip('/'))
-        if isinstance(obj, h5py.Dataset) else None)
-    names1 = list(set(names1))
-    names2 = []
-    hfile2.visititems(
-        lambda _, obj: names2.append(obj.parent.name.strip('/'))
-        if isinstance(obj, h5py.Dataset) else None)
-    names2 = list(set(names2))
+    names1 = global1.names
+    names2 = global2.names
 
     print (f'size of desc1:{len(names1)}, size of desc2:{len(names2)}')
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    def tensor_from_names(names, hfile):
-        desc = [hfile[i]['global_descriptor'].__array__() for i in names]
-        desc = torch.from_numpy(np.stack(desc, 0)).to(device).float()
-        return desc
-
-    db_desc1 = tensor_from_names(names1, hfile1)
-    db_desc2 = tensor_from_names(names2, hfile2)
-    sim = torch.einsum('id,jd->ij', db_desc1, db_desc2)
-    sim = torch.reshape(sim,(-1,))
-    topk = torch.topk(sim, len(names1)*len(names2)).indices.cpu().numpy()
-
-    match_file = h5py.File(str(match_output), 'a')
-    conf = confs[args.conf]
-    Model = dynamic_load(matchers, conf['model']['name'])
-    model = Model(conf['model']).eval().to(device)
+    if index is not None:
+        # approximate neighbors in dataset 2 of each image of dataset 1
+        index = IVFIndex(index)
+        mask = np.array([n in global2 for n in index.names])
+        db_desc1 = global1.tensor(names1, device)
+        scores, ids = index.search(db_desc1.cpu().numpy(),
+                                   num_neighbors or num_matched, num_probes,
+                                   mask)
+        valid = ids >= 0
+        order = np.argsort(-scores[valid], kind='stable')
+        i1 = np.nonzero(valid)[0][order]
+        i2 = global2.rows([index.names[i] for i in ids[valid][order]])
+        topk = i1 * len(names2) + i2
+    else:
+        db_desc1 = global1.tensor(names1, device)
+        db_desc2 = global2.tensor(names2, device)
+        sim = torch.einsum('id,jd->ij', db_desc1, db_desc2)
+        sim = torch.reshape(sim,(-1,))
+        topk = torch.topk(sim, len(names1)*len(names2)).indices.cpu().numpy()
+
+    model, codec = load_matcher(conf, device, feat1, feat2)
+    # the features of the next pairs are read while matching
+    cache = FeatureCache(cache_size, device, codec)
+    prefetcher = Prefetcher(cache, (
+        (f, n) for k in topk for f, n in zip(
+            [hfeat1, hfeat2],
+            [names1[k // len(names2)], names2[k % len(names2)]])))
+    prefetcher.start()
     pairs = []
     matched = set()
     num_matches_found = 0
-    #for k in tqdm(topk):
-    for k in topk:
-        n1 = names1[int(k/len(names2))]
-        n2 = names2[k % len(names2)]
-        num_matches_found = do_match(n1, n2, pairs, matched, num_matches_found, model, match_file, hfeat1, hfeat2, min_match_score, min_valid_ratio)
-        print (f'num_matches_found {num_matches_found}')
-        if num_matches_found >= num_matched:
-            break
-        if done_match:
-            break
-
-    match_file.close()
+    # the matches are resumed from the last checkpoint of an interrupted run
+    journal = MatchJournal(match_output, checkpoint_interval)
+    try:
+        #for k in tqdm(topk):
+        for k in topk:
+            n1 = names1[int(k/len(names2))]
+            n2 = names2[k % len(names2)]
+            num_matches_found = do_match(n1, n2, pairs, matched, num_matches_found, model, journal, hfeat1, hfeat2, min_match_score, min_valid_ratio, codec, cache)
+            prefetcher.advance(2)
+            print (f'num_matches_found {num_matches_found}')
+            if num_matches_found >= num_matched:
+                break
+    except KeyboardInterrupt:
+        print('SIGINT or CTRL-C detected. Exiting gracefully')
+        journal.close(clean=False)
+    else:
+        journal.close()
+
+    prefetcher.close()
+    print(f'Feature cache: {cache.summary()}')
     s1=set(())
     s2=set(())
     if pair_output is not None:
@@ -173,5 +183,14 @@ if __name__ == "__main__":
     parser.add_argument('--num_matched', type=int, required=True)
     parser.add_argument('--min_match_score', type=float, default=0.85)
     parser.add_argument('--min_valid_ratio', type=float, default=0.2)
+    parser.add_argument('--index', type=Path)
+    parser.add_argument('--num_probes', type=int)
+    parser.add_argument('--num_neighbors', type=int)
+    parser.add_argument('--cache_size', type=float, default=1,
+                        help='size of the feature cache in GB')
+    parser.add_argument('--checkpoint_interval', type=float, default=60,
+                        help='seconds between checkpoints of the matches')
     args = parser.parse_args()
+    args.conf = confs[args.conf]
+    args.cache_size = int(args.cache_size * (1 << 30))
     main(**args.__dict__)
@@ -0,0 +1,103 @@
+import argparse
+import logging
+from pathlib import Path
+import h5py
+import numpy as np
+from tqdm import tqdm
+import pprint
+
+from .utils.codecs import build_codec, codec_path
+from .utils.io import read_feature, read_features, write_features
+from .utils.io import list_names, update_names
+
+
+'''
+A set of standard codec configurations that can be directly selected from the
+command line using their name. Each is a dictionary with the entries of a
+codec defined in utils/codecs.py, and its `name`. The comments give the
+recall of mutual nearest neighbor matches w.r.t. the uncompressed ones, as
+measured by benchmarks/descriptor_codecs.py on synthetic descriptors.
+'''
+confs = {
+    # ~100% recall
+    'pca64': {
+        'name': 'pca',
+        'dim': 64,
+    },
+    # ~100% recall
+    'pca128': {
+        'name': 'pca',
+        'dim': 128,
+    },
+    # ~100% recall, the default
+    'int8': {
+        'name': 'int8',
+    },
+    # ~13% recall, too lossy for matching
+    'pq32': {
+        'name': 'pq',
+        'num_subvectors': 32,
+        'num_centroids': 256,
+    },
+    # ~93% recall
+    'pq64': {
+        'name': 'pq',
+        'num_subvectors': 64,
+        'num_centroids': 256,
+    },
+}
+
+
+def sample_descriptors(hfile, names, num_samples, seed=0):
+    """Sample about `num_samples` descriptors uniformly over the images."""
+    rng = np.random.RandomState(seed)
+    per_image = max(1, num_samples // max(1, len(names)))
+    samples = []
+    for name in names:
+        desc = read_feature(hfile[name], 'descriptors')
+        num = min(per_image, desc.shape[1])
+        samples.append(desc[:, rng.choice(desc.shape[1], num, replace=False)])
+    return np.concatenate(samples, 1)
+
+
+def encode_file(codec, feature_path, output_path, names=None):
+    with h5py.File(str(feature_path), 'r') as src, \
+            h5py.File(str(output_path), 'w') as dst:
+        names = names or list_names(src)
+        for name in tqdm(names):
+            feats = read_features(src[name])
+            feats.update(codec.encode(feats.pop('descriptors')))
+            write_features(dst.create_group(name), feats)
+        update_names(dst, names)
+    codec.save(codec_path(output_path))
+
+
+def main(conf, feature_path, output_path, num_samples=200000,
+         train_names=None):
+    """Fit a codec on a feature file and write the compressed features.
+
+    The codec is fitted on the descriptors of `train_names`, or of all the
+    images, and saved next to the output file.
+    """
+    logging.info('Compressing descriptors with configuration:'
+                 f'\n{pprint.pformat(conf)}')
+    with h5py.File(str(feature_path), 'r') as hfile:
+        names = list_names(hfile)
+        desc = sample_descriptors(hfile, train_names or names, num_samples)
+    logging.info(f'Fitting the codec on {desc.shape[1]} descriptors.')
+    codec = build_codec(conf).fit(desc)
+    encode_file(codec, feature_path, output_path, names)
+    logging.info(f'{codec.bytes_per_descriptor(desc.shape[0])} bytes per '
+                 f'descriptor instead of {4*desc.shape[0]}.')
+    return codec
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', type=Path, required=True)
+    parser.add_argument('--output', type=Path, required=True)
+    parser.add_argument('--conf', type=str, default='int8',
+                        choices=list(confs.keys()))
+    parser.add_argument('--num_samples', type=int, default=200000)
+    args = parser.parse_args()
+    main(confs[args.conf], args.features, args.output, args.num_samples)
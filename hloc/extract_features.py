@@ -6,12 +6,27 @@ import logging
 from types import SimpleNamespace
 import cv2
 import numpy as np
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 import pprint
+import io
+from collections import defaultdict
+import multiprocessing
+import queue
+import threading
+import tarfile
+import zipfile
 
 from . import extractors
 from .utils.base_model import dynamic_load
-from .utils.tools import map_tensor
+from .utils.tools import map_tensor, StageTimer
+from .utils.manifest import Manifest, conf_hash, file_entry, file_hash
+from .utils.content_cache import ContentCache
+from .utils.io import get_layout, layouts, write_features, merge_files
+from .utils.io import new_shard_run, remove_unlinked_shards
+from .utils.io import mark_writing, update_names
+from .utils.scan import scan_images, name_matcher
+from .utils.parsers import parse_image_list
 
 
 '''
@@ -20,6 +35,14 @@ line using their name. Each is a dictionary with the following entries:
     - output: the name of the feature file that will be generated.
     - model: the model configuration, as passed to a feature extractor.
     - preprocessing: how to preprocess the images read from disk.
+    - batch_size (optional): the number of images processed at once; images
+      are grouped by their shape after resizing (and padding).
+    - storage (optional): the HDF5 layout of the features, as defined in
+      utils/io.py, e.g. with compression or quantized descriptors.
+    - tiling (optional): run the model over overlapping tiles of very large
+      images, with entries `tile_size` and `overlap`, in pixels.
+Several configurations can be extracted at once, e.g. local features and
+global descriptors, in which case each image is decoded only once.
 '''
 confs = {
     'superpoint_aachen': {
@@ -69,132 +92,1088 @@ confs = {
             'resize_max': 1600,
         },
     },
+    'netvlad': {
+        'output': 'global-feats-netvlad',
+        'model': {
+            'name': 'netvlad',
+        },
+        'preprocessing': {
+            'resize_max': 1024,
+        },
+    },
 }
 
 
+def resize_shape(size, resize_max):
+    """Compute the (w, h) size of an image of size `size` after resizing."""
+    w, h = size
+    if resize_max and max(w, h) > resize_max:
+        scale = resize_max / max(h, w)
+        return int(round(w*scale)), int(round(h*scale))
+    return w, h
+
+
+def padded_size(size, canonical_sizes):
+    """Return the smallest canonical size that fits `size`, if any."""
+    fits = [tuple(s) for s in canonical_sizes or []
+            if s[0] >= size[0] and s[1] >= size[1]]
+    return min(fits, key=lambda s: s[0]*s[1]) if fits else tuple(size)
+
+
+def read_image_header(source):
+    """Read the (w, h) size and the format of an image from its header.
+
+    `source` is a path or a file object. The size accounts for the EXIF
+    orientation, which OpenCV applies when decoding.
+    """
+    from PIL import Image  # a dependency of matplotlib
+    if isinstance(source, Path):
+        source = str(source)
+    with Image.open(source) as image:
+        w, h = image.size
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            w, h = h, w
+        return (w, h), image.format
+
+
+def read_image_size(path):
+    """Read the (w, h) size of an image from its header, without decoding."""
+    return read_image_header(path)[0]
+
+
+def read_image(path, grayscale=False):
+    mode = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    image = cv2.imread(str(path), mode)
+    if image is None:
+        raise ValueError(f'Cannot read image {str(path)}.')
+    if not grayscale:
+        image = image[:, :, ::-1]  # BGR to RGB
+    return image
+
+
+def decode_image(buffer, grayscale=False):
+    """Decode an encoded image (e.g. JPEG or PNG bytes) like `read_image`."""
+    mode = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    image = cv2.imdecode(np.frombuffer(buffer, np.uint8), mode)
+    if image is None:
+        raise ValueError('Cannot decode image.')
+    if not grayscale:
+        image = image[:, :, ::-1]  # BGR to RGB
+    return image
+
+
+REDUCED_MODES = {
+    (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+    (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+    (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def reduction_factor(size, target_size):
+    """Largest JPEG scaling that keeps the image as large as the target."""
+    for factor in (8, 4, 2):
+        if all(-(-s // factor) >= t for s, t in zip(size, target_size)):
+            return factor
+    return 1
+
+
+def read_image_reduced(source, grayscale=False, resize_max=None):
+    """Decode a JPEG directly at 1/2, 1/4 or 1/8 of its resolution.
+
+    libjpeg downscales in the DCT domain, which skips most of the decoding
+    work. The factor is chosen such that the decoded image is still larger
+    than the target of `resize_max`, so the result only needs a mild resize.
+    `source` is a path or encoded bytes. Other formats are fully decoded.
+    Returns the uint8 image and its original (w, h) size.
+    """
+    is_buffer = not isinstance(source, (str, Path))
+    size, format_ = read_image_header(
+        io.BytesIO(source) if is_buffer else source)
+    factor = reduction_factor(size, resize_shape(size, resize_max))
+    if format_ == 'JPEG' and factor > 1:
+        mode = REDUCED_MODES[factor, grayscale]
+        if is_buffer:
+            image = cv2.imdecode(np.frombuffer(source, np.uint8), mode)
+        else:
+            image = cv2.imread(str(source), mode)
+        expected = tuple(-(-s // factor) for s in size)
+        if image is not None and image.shape[:2][::-1] == expected:
+            if not grayscale:
+                image = image[:, :, ::-1]  # BGR to RGB
+            return image, size
+
+    if is_buffer:
+        image = decode_image(source, grayscale)
+    else:
+        image = read_image(source, grayscale)
+    return image, image.shape[:2][::-1]
+
+
+def preprocess_image(image, conf, original_size=None):
+    """Resize, pad and normalize a decoded HxW or HxWx3 RGB image.
+
+    `original_size` is the size of the image before a reduced decoding, if
+    any. In that case, the uint8 image is resized before the conversion to
+    float, which is cheaper.
+    """
+    if original_size is None:
+        size = image.shape[:2][::-1]
+        if not conf.as_uint8:
+            image = image.astype(np.float32)
+    else:
+        size = tuple(original_size)
+
+    w_new, h_new = resize_shape(size, conf.resize_max)
+    if (w_new, h_new) != image.shape[:2][::-1]:
+        image = cv2.resize(
+            image, (w_new, h_new), interpolation=cv2.INTER_LINEAR)
+    if not conf.as_uint8:
+        image = image.astype(np.float32, copy=False)
+
+    w_pad, h_pad = padded_size((w_new, h_new), conf.canonical_sizes)
+    if (w_pad, h_pad) != (w_new, h_new):
+        pad = [(0, h_pad - h_new), (0, w_pad - w_new)]
+        image = np.pad(image, pad + [(0, 0)]*(image.ndim-2), mode='edge')
+
+    if conf.grayscale:
+        image = image[None]
+    else:
+        image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
+    if not conf.as_uint8:
+        image = image / 255.
+
+    return {
+        'image': image,
+        'original_size': np.array(size),
+        'image_size': np.array((w_new, h_new)),
+    }
+
+
 class ImageDataset(torch.utils.data.Dataset):
     default_conf = {
         'globs': ['*.jpg', '*.png', '*.jpeg', '*.JPG', '*.PNG'],
         'grayscale': False,
         'resize_max': None,
+        # list of (w, h) sizes that resized images are padded to, if they fit
+        'canonical_sizes': None,
+        # decode JPEGs at a reduced resolution when resize_max allows it.
+        # The network input then deviates from the full decoding by about
+        # 1.2% of the intensity range on average (4% at the 99th percentile)
+        # on high-frequency images, mostly because the full path aliases
+        # when downscaling. Measure it with benchmarks/reduced_decoding.py.
+        'reduced_decoding': False,
+        # return uint8 images, normalized later, e.g. one tile at a time
+        'as_uint8': False,
+        # JSON cache of the directory listings of the root, see utils/scan.py
+        'image_index': None,
     }
 
-    def __init__(self, root, conf):
+    def __init__(self, root, conf, paths=None):
         self.conf = conf = SimpleNamespace(**{**self.default_conf, **conf})
         self.root = root
 
-        self.paths = []
-        for g in conf.globs:
-            self.paths += list(Path(root).glob('**/'+g))
+        if paths is not None:
+            # relative paths of the images, e.g. a shard of a larger dataset
+            self.paths = [Path(p) for p in paths]
+            return
+
+        self.paths = scan_images(root, conf.globs, conf.image_index)
         if len(self.paths) == 0:
             raise ValueError(f'Could not find any image in root: {root}.')
-        self.paths = sorted(list(set(self.paths)))
-        self.paths = [i.relative_to(root) for i in self.paths]
         logging.info(f'Found {len(self.paths)} images in root {root}.')
 
+    def image_size(self, idx):
+        path = Path(self.root, self.paths[idx])
+        try:
+            return read_image_size(path)
+        except Exception:
+            return cv2.imread(str(path), cv2.IMREAD_GRAYSCALE).shape[::-1]
+
+    def batch_shape(self, idx):
+        """Predict the (w, h) size of the network input of an image."""
+        return padded_size(resize_shape(self.image_size(idx),
+                                        self.conf.resize_max),
+                           self.conf.canonical_sizes)
+
     def __getitem__(self, idx):
         path = self.paths[idx]
-        if self.conf.grayscale:
-            mode = cv2.IMREAD_GRAYSCALE
+        if self.conf.reduced_decoding and self.conf.resize_max:
+            image, size = read_image_reduced(
+                self.root / path, self.conf.grayscale, self.conf.resize_max)
+            data = preprocess_image(image, self.conf, size)
         else:
-            mode = cv2.IMREAD_COLOR
-        image = cv2.imread(str(self.root / path), mode)
-        if not self.conf.grayscale:
-            image = image[:, :, ::-1]  # BGR to RGB
-        if image is None:
-            raise ValueError(f'Cannot read image {str(path)}.')
-        image = image.astype(np.float32)
-        size = image.shape[:2][::-1]
-        w, h = size
+            image = read_image(self.root / path, self.conf.grayscale)
+            data = preprocess_image(image, self.conf)
+        data['name'] = path.as_posix()
+        return data
 
-        if self.conf.resize_max and max(w, h) > self.conf.resize_max:
-            scale = self.conf.resize_max / max(h, w)
-            h_new, w_new = int(round(h*scale)), int(round(w*scale))
-            image = cv2.resize(
-                image, (w_new, h_new), interpolation=cv2.INTER_LINEAR)
+    def __len__(self):
+        return len(self.paths)
 
-        if self.conf.grayscale:
-            image = image[None]
-        else:
-            image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
-        image = image / 255.
 
-        data = {
-            'name': path.as_posix(),
-            'image': image,
-            'original_size': np.array(size),
+class MultiImageDataset(ImageDataset):
+    """Decode each image once and preprocess it for several extractors.
+
+    The image is decoded in color unless all extractors are grayscale, and
+    at the resolution required by the largest one. Converting a color image
+    to grayscale can differ by one intensity level from a grayscale decoding.
+    Items hold the preprocessed images of each extractor in `outputs`.
+    """
+    def __init__(self, root, confs, paths=None):
+        self.confs = [SimpleNamespace(**{**self.default_conf, **c})
+                      for c in confs]
+        resize_max = [c.resize_max for c in self.confs]
+        conf = {
+            'globs': self.confs[0].globs,
+            'image_index': self.confs[0].image_index,
+            'grayscale': all(c.grayscale for c in self.confs),
+            'resize_max': None if not all(resize_max) else max(resize_max),
+            'reduced_decoding': all(c.reduced_decoding for c in self.confs),
         }
+        super().__init__(root, conf, paths)
+
+    def batch_shape(self, idx):
+        size = self.image_size(idx)
+        return tuple(padded_size(resize_shape(size, c.resize_max),
+                                 c.canonical_sizes) for c in self.confs)
+
+    def __getitem__(self, idx):
+        path = self.paths[idx]
+        size = None
+        if self.conf.reduced_decoding and self.conf.resize_max:
+            image, size = read_image_reduced(
+                self.root / path, self.conf.grayscale, self.conf.resize_max)
+        else:
+            image = read_image(self.root / path, self.conf.grayscale)
+        outputs = []
+        for conf in self.confs:
+            if conf.grayscale and image.ndim == 3:
+                outputs.append(preprocess_image(
+                    cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), conf, size))
+            else:
+                outputs.append(preprocess_image(image, conf, size))
+        return {'name': path.as_posix(), 'outputs': outputs}
+
+
+class StreamDataset(torch.utils.data.IterableDataset):
+    """Stream images from container files, such as videos or archives.
+
+    The files are split across the workers of the data loader and each is
+    read sequentially. Items are preprocessed like in ImageDataset.
+    """
+    extensions = ()
+    default_conf = {}
+
+    def __init__(self, root, conf):
+        self.conf = conf = SimpleNamespace(**{
+            **ImageDataset.default_conf, **self.default_conf, **conf})
+        root = Path(root)
+        if root.is_dir():
+            self.root = root
+            self.files = [root / p for p in scan_images(
+                root, ['*'+e for e in self.extensions], conf.image_index)]
+        else:
+            self.root = root.parent
+            self.files = [root]
+        if len(self.files) == 0:
+            raise ValueError(f'Could not find any file with extensions '
+                             f'{self.extensions} in {root}.')
+        logging.info(f'Streaming images from {len(self.files)} files.')
+
+    def prepare(self, image, name, original_size=None):
+        if self.conf.grayscale and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        data = preprocess_image(image, self.conf, original_size)
+        data['name'] = name
         return data
 
+    def read(self, path):
+        raise NotImplementedError
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        files = self.files
+        if info is not None:
+            files = files[info.id::info.num_workers]
+        for path in files:
+            yield from self.read(path)
+
+    def estimate_len(self):
+        """An estimate of the number of items, for progress reporting."""
+        return None
+
+
+class VideoDataset(StreamDataset):
+    """Stream every `stride`-th frame of videos within a time range.
+
+    Frames are named like the files of a video exploded into a directory
+    of the same name, e.g. `videos/run1/000042.jpg` for the frame 42 of
+    `videos/run1.mp4`, such that features are interchangeable.
+    """
+    extensions = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+    default_conf = {
+        'stride': 1,
+        # time range of the frames, in seconds
+        'start': None,
+        'end': None,
+        'name_format': '{video}/{index:06d}.jpg',
+    }
+
+    def frame_range(self, capture):
+        """The first and the end frames. Some containers and streams do not
+        report their number of frames, the end is then None if not set."""
+        fps = capture.get(cv2.CAP_PROP_FPS) or 30
+        num = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        start = int(round((self.conf.start or 0) * fps))
+        end = None
+        if self.conf.end is not None:
+            end = int(round(self.conf.end * fps))
+        if num > 0:
+            end = num if end is None else min(num, end)
+        return start, end
+
+    def read(self, path):
+        capture = cv2.VideoCapture(str(path))
+        if not capture.isOpened():
+            raise ValueError(f'Cannot read video {path}.')
+        video = path.relative_to(self.root).with_suffix('').as_posix()
+        try:
+            start, end = self.frame_range(capture)
+            if start > 0:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+            index = start - 1
+            while end is None or index + 1 < end:
+                index += 1
+                # skipped frames are demuxed but not converted
+                if not capture.grab():
+                    break
+                if (index - start) % self.conf.stride != 0:
+                    continue
+                ok, image = capture.retrieve()
+                if not ok:
+                    break
+                yield self.prepare(image[:, :, ::-1], self.conf.name_format
+                                   .format(video=video, index=index))
+        finally:
+            capture.release()
+
+    def estimate_len(self):
+        total = 0
+        for path in self.files:
+            capture = cv2.VideoCapture(str(path))
+            start, end = self.frame_range(capture)
+            capture.release()
+            if end is None:
+                return None
+            total += max(0, -(-(end - start) // self.conf.stride))
+        return total
+
+
+class ArchiveDataset(StreamDataset):
+    """Stream the images of tar or zip archives with sequential reads.
+
+    Images are named by their path within the archive, as if it had been
+    extracted into the image directory. Since images of different archives
+    would then have the same name, the archives are checked for duplicates
+    before streaming, unless the names include the path of the archive,
+    e.g. with the name format '{archive}/{member}'.
+    """
+    extensions = ('.tar', '.tar.gz', '.tgz', '.zip')
+    default_conf = {
+        'name_format': '{member}',
+    }
+
+    def __init__(self, root, conf):
+        super().__init__(root, conf)
+        if len(self.files) > 1 and '{archive}' not in self.conf.name_format:
+            self.check_names()
+
+    def members(self, path, read=True):
+        """Yield the name and the encoded bytes of the archived images."""
+        match = name_matcher(self.conf.globs)
+        if path.suffix == '.zip':
+            with zipfile.ZipFile(str(path)) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and match(info.filename):
+                        yield info.filename, read and archive.read(info)
+        else:
+            # streaming mode: the archive is read once, without seeking
+            with tarfile.open(str(path), 'r|*') as archive:
+                for member in archive:
+                    if member.isfile() and match(member.name):
+                        yield member.name, read and (
+                            archive.extractfile(member).read())
+
+    def image_name(self, path, member):
+        archive = path.relative_to(self.root).as_posix()
+        for ext in self.extensions:
+            if archive.endswith(ext):
+                archive = archive[:-len(ext)]
+                break
+        member = Path(member).as_posix()
+        if member.startswith('./'):
+            member = member[2:]
+        return self.conf.name_format.format(archive=archive, member=member)
+
+    def check_names(self):
+        """Fail early if images of different archives have the same name.
+        This lists the members of each archive, without decoding them."""
+        archives = {}
+        for path in self.files:
+            for member, _ in self.members(path, read=False):
+                name = self.image_name(path, member)
+                if archives.setdefault(name, path) != path:
+                    raise ValueError(
+                        f'Image {name} is in both {archives[name]} and '
+                        f'{path}, add {{archive}} to the name format to '
+                        'name the images by archive.')
+
+    def read(self, path):
+        for name, buffer in self.members(path):
+            name = self.image_name(path, name)
+            if self.conf.reduced_decoding and self.conf.resize_max:
+                image, size = read_image_reduced(
+                    buffer, self.conf.grayscale, self.conf.resize_max)
+                yield self.prepare(image, name, size)
+            else:
+                yield self.prepare(
+                    decode_image(buffer, self.conf.grayscale), name)
+
+
+sources = {
+    'video': VideoDataset,
+    'archive': ArchiveDataset,
+}
+
+
+class ShapeBucketSampler(torch.utils.data.Sampler):
+    """Batch together images that have the same network input shape."""
+    def __init__(self, dataset, batch_size):
+        self.batch_size = batch_size
+        self.shapes = [dataset.batch_shape(i) for i in tqdm(
+            range(len(dataset)), desc='Reading image sizes')]
+        self.buckets = defaultdict(list)
+        for i, shape in enumerate(self.shapes):
+            self.buckets[shape].append(i)
+        logging.info(f'Grouped {len(self.shapes)} images into '
+                     f'{len(self.buckets)} shape buckets.')
+
+    def __iter__(self):
+        for indices in self.buckets.values():
+            for i in range(0, len(indices), self.batch_size):
+                yield indices[i:i+self.batch_size]
+
     def __len__(self):
-        return len(self.paths)
+        return sum((len(i) + self.batch_size - 1) // self.batch_size
+                   for i in self.buckets.values())
+
+
+def crop_to_valid(pred, image_size, border):
+    """Drop the keypoints that were detected in the padded image area."""
+    kpts = pred['keypoints']
+    w, h = image_size
+    valid = ((kpts[:, 0] < w - border) & (kpts[:, 1] < h - border))
+    for k in ['keypoints', 'scores']:
+        if k in pred:
+            pred[k] = pred[k][valid]
+    if 'descriptors' in pred:
+        pred['descriptors'] = pred['descriptors'][:, valid]
+    return pred
+
+
+default_tiling = {
+    'tile_size': 1024,
+    'overlap': 64,
+}
+
+
+def tile_origins(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    step = tile_size - overlap
+    num = int(np.ceil((length - overlap) / step))
+    return sorted(set(min(i*step, length-tile_size) for i in range(num)))
+
+
+def nms_keypoints(keypoints, scores, radius):
+    """Greedily suppress the keypoints that have a better one within radius.
+
+    Like the NMS of SuperPoint, the distance is the Chebyshev distance.
+    Returns the indices of the kept keypoints.
+    """
+    pairs = cKDTree(keypoints).query_pairs(
+        radius, p=np.inf, output_type='ndarray')
+    keep = np.ones(len(keypoints), dtype=bool)
+    if len(pairs) == 0:
+        return np.where(keep)[0]
+    neighbors = defaultdict(list)
+    for i, j in pairs:
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+    for i in sorted(neighbors, key=lambda i: -scores[i]):
+        if keep[i]:
+            keep[neighbors[i]] = False
+    return np.where(keep)[0]
+
+
+@torch.no_grad()
+def extract_tiled(model, image, tiling, nms_radius, max_keypoints, device):
+    """Run a local feature extractor over overlapping tiles of an image.
+
+    Each tile only keeps the keypoints that are at least half the overlap
+    away from its borders with other tiles, such that every point of the
+    image is covered by at least one tile. Duplicates across tile borders
+    are then removed with NMS, and the best `max_keypoints` are selected.
+    The memory of the network is bounded by the tile size. `image` is a
+    1xCxHxW uint8 or float tensor, which is normalized one tile at a time.
+    """
+    tiling = {**default_tiling, **tiling}
+    size, overlap = tiling['tile_size'], tiling['overlap']
+    h, w = image.shape[-2:]
+    margin = overlap / 2
+
+    keypoints, scores, descriptors = [], [], []
+    for y in tile_origins(h, size, overlap):
+        for x in tile_origins(w, size, overlap):
+            tile = image[..., y:y+size, x:x+size].to(device)
+            if tile.dtype == torch.uint8:
+                tile = tile.float() / 255.
+            pred = model({'image': tile})
+            if 'keypoints' not in pred:
+                raise ValueError(
+                    'Tiled extraction requires a local feature extractor.')
+            kpts = pred['keypoints'][0].cpu()
+            tile_h, tile_w = tile.shape[-2:]
+            valid = torch.ones(len(kpts), dtype=torch.bool)
+            if x > 0:
+                valid &= kpts[:, 0] >= margin
+            if x + tile_w < w:
+                valid &= kpts[:, 0] < tile_w - margin
+            if y > 0:
+                valid &= kpts[:, 1] >= margin
+            if y + tile_h < h:
+                valid &= kpts[:, 1] < tile_h - margin
+            keypoints.append(kpts[valid] + kpts.new_tensor([x, y]))
+            scores.append(pred['scores'][0].cpu()[valid])
+            descriptors.append(pred['descriptors'][0].cpu()[:, valid])
+
+    keypoints = torch.cat(keypoints, 0)
+    scores = torch.cat(scores, 0)
+    descriptors = torch.cat(descriptors, 1)
+    if len(keypoints) > 0:
+        keep = nms_keypoints(keypoints.numpy(), scores.numpy(), nms_radius)
+        keep = torch.from_numpy(keep)
+        if max_keypoints and max_keypoints > 0 and len(keep) > max_keypoints:
+            keep = keep[torch.topk(scores[keep], max_keypoints).indices]
+        keypoints, scores = keypoints[keep], scores[keep]
+        descriptors = descriptors[:, keep]
+    return {'keypoints': [keypoints], 'scores': [scores],
+            'descriptors': [descriptors]}
+
+
+def build_model(conf, device):
+    """Load the model of a configuration and adapt it for tiling, if any.
+
+    Returns a function that runs the model on a batch and returns lists of
+    numpy predictions, and the preprocessing configuration.
+    """
+    Model = dynamic_load(extractors, conf['model']['name'])
+    tiling = conf.get('tiling')
+    model_conf = conf['model']
+    preprocessing = conf['preprocessing']
+    if tiling:
+        # the keypoint budget is enforced over the entire image
+        max_keypoints = model_conf.get('max_keypoints', -1)
+        model_conf = {**model_conf, 'max_keypoints': -1}
+        nms_radius = model_conf.get('nms_radius', 1)
+        preprocessing = {**preprocessing, 'as_uint8': True}
+    model = Model(model_conf).eval().to(device)
+
+    def run(data):
+        if tiling:
+            preds = extract_tiled(model, data['image'], tiling, nms_radius,
+                                  max_keypoints, device)
+        else:
+            preds = model(map_tensor(data, lambda x: x.to(device)))
+        return {k: [x.cpu().numpy() for x in v] for k, v in preds.items()}
+    return run, preprocessing
+
+
+def split_batch(preds, data, border):
+    """Split batched predictions into per-image write requests."""
+    input_size = np.array(data['image'].shape[-2:][::-1])
+    for i, name in enumerate(data['name']):
+        pred = {k: v[i] for k, v in preds.items()}
+        image_size = data['image_size'][i].numpy()
+        if 'keypoints' in pred and np.any(image_size != input_size):
+            pred = crop_to_valid(pred, image_size, border)
+        yield name, pred, data['original_size'][i].numpy(), image_size
+
+
+def postprocess(pred, original_size, image_size, as_half=False):
+    """Rescale the keypoints to the original image and cast the features."""
+    pred['image_size'] = original_size
+    if 'keypoints' in pred:
+        scales = (original_size / image_size).astype(np.float32)
+        pred['keypoints'] = (pred['keypoints'] + .5) * scales[None] - .5
+
+    if as_half:
+        for k in pred:
+            dt = pred[k].dtype
+            if (dt == np.float32) and (dt != np.float16):
+                pred[k] = pred[k].astype(np.float16)
+    return pred
+
+
+class FeatureWriter(threading.Thread):
+    """Drain predictions from a bounded queue into the HDF5 feature file.
+
+    Keeps the HDF5 writes off the inference thread: the model only blocks
+    when more than `max_pending` predictions are waiting to be written.
+    """
+    def __init__(self, feature_file, as_half=False, max_pending=16,
+                 timer=None, manifest=None, layout=None, cache=None,
+                 cache_keys=None):
+        super().__init__(daemon=True)
+        self.feature_file = feature_file
+        self.as_half = as_half
+        self.layout = get_layout(layout)
+        self.manifest = manifest
+        self.cache = cache
+        self.cache_keys = cache_keys
+        self.names = []  # written so far, to update the index of names
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.timer = timer or StageTimer()
+        self.error = None
+
+    def put(self, name, pred, original_size, image_size):
+        if self.error is not None:
+            raise self.error
+        with self.timer('write (backpressure)'):
+            self.queue.put((name, pred, original_size, image_size))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # keep draining so that the producer never blocks
+            try:
+                with self.timer('write'):
+                    self.write(*item)
+            except Exception as e:
+                self.error = e
+
+    def write(self, name, pred, original_size, image_size):
+        pred = postprocess(pred, original_size, image_size, self.as_half)
+        grp = self.feature_file.create_group(name)
+        write_features(grp, pred, self.layout)
+        self.names.append(name)
+        if self.cache is not None:
+            self.cache.put(self.cache_keys[name], grp)
+        if self.manifest is not None:
+            self.manifest.commit(name)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
 
 class FeatureExtractor(object):
-    def __init__(self, conf):
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    """Keep a feature extractor warm in memory to serve online queries.
+
+    Images are preprocessed exactly like in ImageDataset and features are
+    returned as numpy arrays, in the same format as in the feature files.
+    Images can be given as encoded bytes or as decoded HxW grayscale or
+    HxWx3 RGB arrays.
+    """
+    def __init__(self, conf, device=None, as_half=False):
+        self.device = device or ('cuda' if torch.cuda.is_available()
+                                 else 'cpu')
+        self.conf = SimpleNamespace(**{
+            **ImageDataset.default_conf, **conf['preprocessing']})
+        self.border = conf['model'].get('remove_borders', 4)
+        self.as_half = as_half
         Model = dynamic_load(extractors, conf['model']['name'])
         self.model = Model(conf['model']).eval().to(self.device)
 
+    def prepare(self, image):
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            if self.conf.reduced_decoding and self.conf.resize_max:
+                image, size = read_image_reduced(
+                    bytes(image), self.conf.grayscale, self.conf.resize_max)
+                return preprocess_image(image, self.conf, size)
+            image = decode_image(image, self.conf.grayscale)
+        elif self.conf.grayscale and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        elif not self.conf.grayscale and image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        return preprocess_image(image, self.conf)
+
+    @torch.no_grad()
     def extract(self, image):
-        image = image.astype(np.float32)
-        size = image.shape[:2][::-1]
-        image = image.transpose((2, 0, 1))  # HxWxC to CxHxW
-        image = image / 255.
+        return self.extract_batch([image])[0]
 
-        data = {
-            'image': image,
-            'original_size': np.array(size),
-        }
-        pred = model(map_tensor(data, lambda x: x.to(self.device)))
-        pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
+    @torch.no_grad()
+    def extract_batch(self, images):
+        """Extract features from a list of images, batching equal shapes."""
+        data = [self.prepare(i) for i in images]
+        buckets = defaultdict(list)
+        for i, d in enumerate(data):
+            buckets[d['image'].shape].append(i)
+
+        preds = [None] * len(data)
+        for indices in buckets.values():
+            image = torch.from_numpy(
+                np.stack([data[i]['image'] for i in indices]))
+            batch = self.model({'image': image.float().to(self.device)})
+            for j, i in enumerate(indices):
+                pred = {k: v[j].cpu().numpy() for k, v in batch.items()}
+                input_size = np.array(data[i]['image'].shape[-2:][::-1])
+                image_size = data[i]['image_size']
+                if 'keypoints' in pred and np.any(image_size != input_size):
+                    pred = crop_to_valid(pred, image_size, self.border)
+                preds[i] = postprocess(
+                    pred, data[i]['original_size'], image_size, self.as_half)
+        return preds
+
+
+def plan_incremental(dataset, feature_file, manifest, hash_content=False):
+    """Restrict the dataset to new or modified images and drop stale ones.
+
+    Features of modified and removed images are deleted from the file. Note
+    that HDF5 does not reclaim the freed space; run `h5repack` if needed.
+    """
+    current = {p.as_posix(): file_entry(Path(dataset.root, p), hash_content)
+               for p in tqdm(dataset.paths, desc='Scanning images')}
+    uptodate, todo, stale = manifest.diff(current)
+    # features that went missing from the file are also extracted again
+    missing = [n for n in uptodate if n not in feature_file]
+    uptodate = [n for n in uptodate if n in feature_file]
+    todo += missing
+    logging.info(
+        f'Incremental extraction: {len(uptodate)} images up to date, '
+        f'{len(todo)} new or modified, {len(stale)} stale.')
+
+    mark_writing(feature_file)
+    for name in todo + stale:
+        if name in feature_file:
+            del feature_file[name]
+    update_names(feature_file, removed=todo + stale)
+    for name in stale:
+        manifest.remove(name)
+    for name in todo:
+        manifest.stage(name, current[name])
+
+    todo = set(todo)
+    dataset.paths = [p for p in dataset.paths if p.as_posix() in todo]
+    return dataset
+
+
+def plan_cached(dataset, feature_file, cache, manifest=None, link=False):
+    """Copy the features of the images found in the content cache and
+    restrict the dataset to the others.
+
+    Returns the dataset and the content hashes of its remaining images.
+    """
+    keys, todo, found = {}, [], []
+    mark_writing(feature_file)
+    for path in tqdm(dataset.paths, desc='Hashing images'):
+        name = path.as_posix()
+        image_hash = file_hash(Path(dataset.root, path))
+        if cache.get(image_hash) is not None:
+            cache.copy_to(image_hash, feature_file, name, link)
+            found.append(name)
+            if manifest is not None:
+                manifest.commit(name)
+        else:
+            keys[name] = image_hash
+            todo.append(path)
+    update_names(feature_file, found)
+    logging.info(f'Found {len(dataset.paths) - len(todo)} images in the '
+                 f'feature cache, {len(todo)} remain to be extracted.')
+    dataset.paths = todo
+    return dataset, keys
 
-        pred['image_size'] = original_size = data['original_size'][0].numpy()
-        if 'keypoints' in pred:
-            size = np.array(data['image'].shape[-2:][::-1])
-            scales = (original_size / size).astype(np.float32)
-            pred['keypoints'] = (pred['keypoints'] + .5) * scales[None] - .5
 
-        return pred
+def extract_shard(conf, image_dir, export_dir, paths, num_threads,
+                  kwargs):
+    torch.set_num_threads(num_threads)
+    main(conf, image_dir, export_dir, image_list=paths, **kwargs)
+
+
+def extract_sharded(conf, image_dir, export_dir, num_shards,
+                    threads_per_shard=None, link_shards=False,
+                    image_list=None, incremental=False, hash_content=False,
+                    **kwargs):
+    """Split the images across processes that each write their own shard.
+
+    Each process runs its own PyTorch inference with `threads_per_shard`
+    intra-op threads. The shards are then merged into the feature file,
+    either by copy or, with `link_shards`, as external links to the shards.
+    Each run writes new shards, <output>.run{n}.shard{i}.h5, such that the
+    shards linked by previous runs are never overwritten. Shards that are
+    not linked anymore after the merge are deleted.
+    """
+    dataset = ImageDataset(image_dir, conf['preprocessing'], image_list)
+    feature_path = Path(export_dir, conf['output']+'.h5')
+    feature_path.parent.mkdir(exist_ok=True, parents=True)
+
+    manifest = None
+    if incremental:
+        manifest = Manifest.for_features(
+            feature_path, extraction_hash(conf, dataset, kwargs))
+        with h5py.File(str(feature_path), 'a') as feature_file:
+            dataset = plan_incremental(
+                dataset, feature_file, manifest, hash_content)
+    paths = [p.as_posix() for p in dataset.paths]
+    if len(paths) == 0:
+        if manifest is not None:
+            manifest.save()
+        logging.info('All features are up to date.')
+        return
+
+    threads_per_shard = threads_per_shard or max(
+        1, multiprocessing.cpu_count() // num_shards)
+    logging.info(f'Extracting {len(paths)} images in {num_shards} shards '
+                 f'with {threads_per_shard} threads each.')
+    ctx = multiprocessing.get_context('spawn')
+    # new shard names, since previous shards may still be linked
+    run = new_shard_run(Path(export_dir, conf['output']))
+    shard_confs, processes = [], []
+    for i in range(num_shards):
+        shard_conf = {**conf, 'output': conf['output']+f'.run{run}.shard{i}'}
+        p = ctx.Process(target=extract_shard, args=(
+            shard_conf, image_dir, export_dir, paths[i::num_shards],
+            threads_per_shard, kwargs))
+        p.start()
+        shard_confs.append(shard_conf)
+        processes.append(p)
+    for p in processes:
+        p.join()
+    failed = [i for i, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Extraction failed for shards {failed}.')
+
+    shard_paths = [Path(export_dir, c['output']+'.h5') for c in shard_confs]
+    names = merge_files(shard_paths, feature_path, link=link_shards)
+    if not link_shards:
+        for path in shard_paths:
+            path.unlink()
+    with h5py.File(str(feature_path), 'r') as feature_file:
+        removed = remove_unlinked_shards(
+            feature_file, Path(export_dir, conf['output']))
+    if removed:
+        logging.info(f'Deleted {len(removed)} shards of previous runs that '
+                     'are not linked anymore.')
+    if manifest is not None:
+        for name in names:
+            manifest.commit(name)
+        manifest.save()
+    logging.info('Finished merging the feature shards.')
+
+
+def extraction_hash(conf, dataset, kwargs):
+    preprocessing = {k: v for k, v in dataset.conf.__dict__.items()
+                     if k != 'image_index'}
+    return conf_hash({
+        'model': conf['model'], 'preprocessing': preprocessing,
+        'as_half': kwargs.get('as_half', False),
+        'storage': get_layout(kwargs.get('storage') or conf.get('storage')),
+        'tiling': ({**default_tiling, **conf['tiling']}
+                   if conf.get('tiling') else None),
+    })
+
 
 @torch.no_grad()
-def main(conf, image_dir, export_dir, as_half=False):
+def main(conf, image_dir, export_dir, as_half=False, num_workers=1,
+         prefetch=4, max_pending_writes=16, incremental=False,
+         hash_content=False, batch_size=None, storage=None,
+         image_list=None, num_shards=1, threads_per_shard=None,
+         link_shards=False, source=None, cache_dir=None, cache_size=None,
+         link_cache=False):
+    """Extract features from the images of `image_dir`.
+
+    With a `source`, images are instead streamed from a video or an archive
+    file, or from all those in `image_dir`: a dict with the entry `type`,
+    either 'video' or 'archive', and the options of the source dataset.
+    With a `cache_dir`, the features of images with the same content and
+    configuration are reused from a cache of at most `cache_size` bytes,
+    copied or, with `link_cache`, linked into the feature file.
+    """
+    multiple = isinstance(conf, (list, tuple)) and len(conf) > 1
+    if source is not None and (incremental or num_shards > 1 or multiple):
+        raise ValueError('Incremental, sharded and multiple extractions '
+                         'are not supported with streamed sources.')
+    if cache_dir is not None and (source is not None or multiple):
+        raise ValueError('The feature cache is not supported with streamed '
+                         'sources and multiple extractions.')
+    if isinstance(conf, (list, tuple)):
+        if len(conf) > 1:
+            if incremental or num_shards > 1:
+                raise ValueError('Incremental and sharded extractions are '
+                                 'not supported with several outputs.')
+            return extract_multiple(
+                conf, image_dir, export_dir, as_half, num_workers, prefetch,
+                max_pending_writes, batch_size, storage, image_list)
+        conf = conf[0]
+    if num_shards > 1:
+        return extract_sharded(
+            conf, image_dir, export_dir, num_shards, threads_per_shard,
+            link_shards, image_list, incremental, hash_content,
+            as_half=as_half, num_workers=num_workers, prefetch=prefetch,
+            max_pending_writes=max_pending_writes, batch_size=batch_size,
+            storage=storage, cache_dir=cache_dir, cache_size=cache_size,
+            link_cache=link_cache)
+
     logging.info('Extracting local features with configuration:'
                  f'\n{pprint.pformat(conf)}')
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    Model = dynamic_load(extractors, conf['model']['name'])
-    model = Model(conf['model']).eval().to(device)
-
-    loader = ImageDataset(image_dir, conf['preprocessing'])
-    loader = torch.utils.data.DataLoader(loader, num_workers=1)
+    run_model, preprocessing = build_model(conf, device)
+    if source is None:
+        dataset = ImageDataset(image_dir, preprocessing, image_list)
+        num_images = len(dataset)
+    else:
+        source = dict(source)
+        Source = sources[source.pop('type')]
+        dataset = Source(image_dir, {**preprocessing, **source})
+        num_images = dataset.estimate_len()
+        # streamed images are not sampled, so they cannot be bucketed
+        batch_size = 1
 
     feature_path = Path(export_dir, conf['output']+'.h5')
     feature_path.parent.mkdir(exist_ok=True, parents=True)
     feature_file = h5py.File(str(feature_path), 'a')
 
-    for data in tqdm(loader):
-        pred = model(map_tensor(data, lambda x: x.to(device)))
-        pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
+    layout = get_layout(storage or conf.get('storage'))
+    hash_ = extraction_hash(
+        conf, dataset, {'as_half': as_half, 'storage': storage})
+    manifest = None
+    if incremental:
+        manifest = Manifest.for_features(feature_path, hash_)
+        dataset = plan_incremental(
+            dataset, feature_file, manifest, hash_content)
+        num_images = len(dataset)
+    cache = cache_keys = None
+    if cache_dir is not None:
+        cache = ContentCache(cache_dir, hash_, cache_size)
+        dataset, cache_keys = plan_cached(
+            dataset, feature_file, cache, manifest, link_cache)
+        num_images = len(dataset)
 
-        pred['image_size'] = original_size = data['original_size'][0].numpy()
-        if 'keypoints' in pred:
-            size = np.array(data['image'].shape[-2:][::-1])
-            scales = (original_size / size).astype(np.float32)
-            pred['keypoints'] = (pred['keypoints'] + .5) * scales[None] - .5
+    # decoding runs in `num_workers` processes, each of which keeps at most
+    # `prefetch` images ready so that the model never waits on a single JPEG
+    kwargs = {'prefetch_factor': prefetch} if num_workers > 0 else {}
+    batch_size = batch_size or conf.get('batch_size', 1)
+    if batch_size > 1 and not conf.get('tiling'):
+        kwargs['batch_sampler'] = ShapeBucketSampler(dataset, batch_size)
+    loader = torch.utils.data.DataLoader(
+        dataset, num_workers=num_workers, pin_memory=(device == 'cuda'),
+        **kwargs)
+    border = conf['model'].get('remove_borders', 4)
+
+    timer = StageTimer()
+    writer = FeatureWriter(
+        feature_file, as_half, max_pending_writes, timer, manifest, layout,
+        cache, cache_keys)
+    mark_writing(feature_file)
+    writer.start()
+    try:
+        batches = iter(loader)
+        pbar = tqdm(total=num_images)
+        while True:
+            with timer('decode (wait)'):
+                data = next(batches, None)
+            if data is None:
+                break
+            with timer('inference'):
+                preds = run_model(data)
+            for item in split_batch(preds, data, border):
+                writer.put(*item)
+            pbar.update(len(data['name']))
+        pbar.close()
+    finally:
+        try:
+            writer.close()
+        finally:
+            update_names(feature_file, writer.names)
+            feature_file.close()
+            if manifest is not None:
+                manifest.save()
+            if cache is not None:
+                cache.close()
+    if timer.busy:
+        logging.info(f'Stage utilization: {timer.summary()}.')
+    logging.info('Finished exporting features.')
 
-        if as_half:
-            for k in pred:
-                dt = pred[k].dtype
-                if (dt == np.float32) and (dt != np.float16):
-                    pred[k] = pred[k].astype(np.float16)
 
-        grp = feature_file.create_group(data['name'][0])
-        for k, v in pred.items():
-            grp.create_dataset(k, data=v)
+@torch.no_grad()
+def extract_multiple(confs, image_dir, export_dir, as_half=False,
+                     num_workers=1, prefetch=4, max_pending_writes=16,
+                     batch_size=None, storage=None, image_list=None):
+    """Run several extractors on each image after a single decoding.
+
+    Each configuration is written to its own feature file, as if extracted
+    separately.
+    """
+    logging.info('Extracting features with configurations:'
+                 f'\n{pprint.pformat(confs)}')
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    models, preprocessings = zip(*[build_model(c, device) for c in confs])
+    dataset = MultiImageDataset(image_dir, preprocessings, image_list)
 
-        del pred
+    kwargs = {'prefetch_factor': prefetch} if num_workers > 0 else {}
+    batch_size = batch_size or min(c.get('batch_size', 1) for c in confs)
+    if batch_size > 1 and not any(c.get('tiling') for c in confs):
+        kwargs['batch_sampler'] = ShapeBucketSampler(dataset, batch_size)
+    loader = torch.utils.data.DataLoader(
+        dataset, num_workers=num_workers, pin_memory=(device == 'cuda'),
+        **kwargs)
 
-    feature_file.close()
+    timer = StageTimer()
+    files, writers = [], []
+    for conf in confs:
+        feature_path = Path(export_dir, conf['output']+'.h5')
+        feature_path.parent.mkdir(exist_ok=True, parents=True)
+        files.append(h5py.File(str(feature_path), 'a'))
+        mark_writing(files[-1])
+        writers.append(FeatureWriter(
+            files[-1], as_half, max_pending_writes, timer,
+            layout=storage or conf.get('storage')))
+        writers[-1].start()
+    try:
+        batches = iter(loader)
+        pbar = tqdm(total=len(dataset))
+        for _ in range(len(loader)):
+            with timer('decode (wait)'):
+                data = next(batches)
+            for conf, run_model, writer, output in zip(
+                    confs, models, writers, data['outputs']):
+                output['name'] = data['name']
+                with timer('inference'):
+                    preds = run_model(output)
+                border = conf['model'].get('remove_borders', 4)
+                for item in split_batch(preds, output, border):
+                    writer.put(*item)
+            pbar.update(len(data['name']))
+        pbar.close()
+    finally:
+        try:
+            for writer in writers:
+                writer.close()
+        finally:
+            for feature_file, writer in zip(files, writers):
+                update_names(feature_file, writer.names)
+                feature_file.close()
+    if timer.busy:
+        logging.info(f'Stage utilization: {timer.summary()}.')
     logging.info('Finished exporting features.')
 
 
@@ -202,7 +1181,49 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--image_dir', type=Path, required=True)
     parser.add_argument('--export_dir', type=Path, required=True)
-    parser.add_argument('--conf', type=str, default='superpoint_aachen',
+    parser.add_argument('--conf', type=str, nargs='+',
+                        default=['superpoint_aachen'],
                         choices=list(confs.keys()))
+    parser.add_argument('--as_half', action='store_true')
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--prefetch', type=int, default=4)
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--hash_content', action='store_true')
+    parser.add_argument('--batch_size', type=int)
+    parser.add_argument('--storage', type=str, choices=list(layouts.keys()))
+    parser.add_argument('--num_shards', type=int, default=1)
+    parser.add_argument('--threads_per_shard', type=int)
+    parser.add_argument('--link_shards', action='store_true')
+    parser.add_argument('--reduced_decoding', action='store_true')
+    parser.add_argument('--tile_size', type=int)
+    parser.add_argument('--image_index', type=Path)
+    parser.add_argument('--image_list', type=Path,
+                        help='e.g. a list of keyframes')
+    parser.add_argument('--source', type=str, choices=list(sources.keys()))
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--start', type=float)
+    parser.add_argument('--end', type=float)
+    parser.add_argument('--cache_dir', type=Path)
+    parser.add_argument('--cache_size_gb', type=float)
+    parser.add_argument('--link_cache', action='store_true')
     args = parser.parse_args()
-    main(confs[args.conf], args.image_dir, args.export_dir)
+    conf = [confs[c] for c in args.conf]
+    for c in conf:
+        if args.reduced_decoding:
+            c['preprocessing']['reduced_decoding'] = True
+        if args.tile_size:
+            c['tiling'] = {'tile_size': args.tile_size}
+        if args.image_index:
+            c['preprocessing']['image_index'] = args.image_index
+    main(conf, args.image_dir, args.export_dir,
+         as_half=args.as_half, num_workers=args.num_workers,
+         prefetch=args.prefetch, incremental=args.incremental,
+         hash_content=args.hash_content, batch_size=args.batch_size,
+         storage=args.storage, num_shards=args.num_shards,
+         threads_per_shard=args.threads_per_shard,
+         link_shards=args.link_shards,
+         image_list=args.image_list and parse_image_list(args.image_list),
+         source=args.source and {'type': args.source, 'stride': args.stride,
+                                 'start': args.start, 'end': args.end},
+         cache_dir=args.cache_dir, link_cache=args.link_cache,
+         cache_size=args.cache_size_gb and int(args.cache_size_gb * 1e9))
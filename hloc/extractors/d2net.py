@@ -43,16 +43,14 @@ class D2Net(BaseModel):
         norm = image.new_tensor([103.939, 116.779, 123.68])
         image = (image * 255 - norm.view(1, 3, 1, 1))  # caffe normalization
 
-        if self.conf['multiscale']:
+        scales = [.5, 1, 2] if self.conf['multiscale'] else [1]
+        pred = {'keypoints': [], 'scores': [], 'descriptors': []}
+        # the detection of D2-Net only supports one image at a time
+        for i in range(image.shape[0]):
             keypoints, scores, descriptors = process_multiscale(
-                image, self.net)
-        else:
-            keypoints, scores, descriptors = process_multiscale(
-                image, self.net, scales=[1])
-        keypoints = keypoints[:, [1, 0]]  # (x, y) and remove the scale
-
-        return {
-            'keypoints': torch.from_numpy(keypoints)[None],
-            'scores': torch.from_numpy(scores)[None],
-            'descriptors': torch.from_numpy(descriptors.T)[None],
-        }
+                image[i:i+1], self.net, scales=scales)
+            keypoints = keypoints[:, [1, 0]]  # (x, y) and remove the scale
+            pred['keypoints'].append(torch.from_numpy(keypoints))
+            pred['scores'].append(torch.from_numpy(scores))
+            pred['descriptors'].append(torch.from_numpy(descriptors.T))
+        return pred
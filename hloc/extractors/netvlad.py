@@ -0,0 +1,121 @@
+from pathlib import Path
+import subprocess
+import logging
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from scipy.io import loadmat
+
+from ..utils.base_model import BaseModel
+
+netvlad_path = Path(__file__).parent / '../../third_party/netvlad'
+
+# VGG16 up to conv5_3, without the last ReLU and max-pooling
+vgg16_layers = [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'M',
+                512, 512, 512, 'M', 512, 512, 512]
+
+
+def vgg16_backbone():
+    layers, dim = [], 3
+    for v in vgg16_layers:
+        if v == 'M':
+            layers.append(nn.MaxPool2d(kernel_size=2, stride=2))
+        else:
+            layers += [nn.Conv2d(dim, v, kernel_size=3, padding=1),
+                       nn.ReLU(inplace=True)]
+            dim = v
+    return nn.Sequential(*layers[:-1])
+
+
+class NetVLADLayer(nn.Module):
+    def __init__(self, input_dim=512, K=64, intranorm=True):
+        super().__init__()
+        self.score_proj = nn.Conv1d(input_dim, K, kernel_size=1, bias=False)
+        self.centers = nn.Parameter(torch.empty([input_dim, K]))
+        nn.init.xavier_uniform_(self.centers)
+        self.intranorm = intranorm
+        self.output_dim = input_dim * K
+
+    def forward(self, x):
+        b = x.size(0)
+        scores = F.softmax(self.score_proj(x), dim=1)
+        diff = x.unsqueeze(2) - self.centers.unsqueeze(0).unsqueeze(-1)
+        desc = (scores.unsqueeze(1) * diff).sum(dim=-1)
+        if self.intranorm:
+            desc = F.normalize(desc, dim=1)
+        desc = desc.view(b, -1)
+        return F.normalize(desc, dim=1)
+
+
+class NetVLAD(BaseModel):
+    """The VGG16 NetVLAD of Arandjelovic et al., with the MATLAB weights.
+
+    The weights are the structs exported from the original MATLAB models by
+    https://github.com/uzh-rpg/netvlad_tf_open.
+    """
+    default_conf = {
+        'model_name': 'VGG16-NetVLAD-Pitts30K',
+        'whiten': True,
+    }
+    required_inputs = ['image']
+    models = {
+        'VGG16-NetVLAD-Pitts30K':
+            'https://cvg-data.inf.ethz.ch/hloc/netvlad/Pitts30K_struct.mat',
+        'VGG16-NetVLAD-TokyoTM':
+            'https://cvg-data.inf.ethz.ch/hloc/netvlad/TokyoTM_struct.mat',
+    }
+
+    def _init(self, conf):
+        model_file = netvlad_path / (conf['model_name'] + '.mat')
+        if not model_file.exists():
+            model_file.parent.mkdir(exist_ok=True, parents=True)
+            cmd = ['wget', self.models[conf['model_name']],
+                   '-O', str(model_file)]
+            ret = subprocess.call(cmd)
+            if ret != 0:
+                logging.warning(
+                    f'Cannot download the NetVLAD model with `{cmd}`.')
+                exit(ret)
+
+        self.backbone = vgg16_backbone()
+        self.netvlad = NetVLADLayer()
+        if conf['whiten']:
+            self.whiten = nn.Linear(self.netvlad.output_dim, 4096)
+
+        mat = loadmat(str(model_file), struct_as_record=False,
+                      squeeze_me=True)
+        layers = mat['net'].layers
+        for layer, mat_layer in zip(self.backbone.children(), layers):
+            if isinstance(layer, nn.Conv2d):
+                w, b = mat_layer.weights  # SxSxINxOUT and OUT
+                layer.weight.data = torch.tensor(w).float().permute(3, 2, 0, 1)
+                layer.bias.data = torch.tensor(b).float()
+
+        score_w, center_w = layers[30].weights  # DxK, centers are negated
+        self.netvlad.score_proj.weight.data = (
+            torch.tensor(score_w).float().t().unsqueeze(-1))
+        self.netvlad.centers.data = -torch.tensor(center_w).float()
+
+        if conf['whiten']:
+            w, b = layers[33].weights  # 1x1xINxOUT and OUT
+            self.whiten.weight.data = torch.tensor(w).float().squeeze().t()
+            self.whiten.bias.data = torch.tensor(b.squeeze()).float()
+
+        # the RGB mean, possibly stored for each pixel of an average image
+        mean = mat['net'].meta.normalization.averageImage
+        mean = np.asarray(mean, np.float32).reshape(-1, 3)[0]
+        self.register_buffer('mean', torch.from_numpy(mean).view(-1, 1, 1))
+
+    def _forward(self, data):
+        image = data['image']
+        assert image.shape[1] == 3, 'NetVLAD requires RGB images.'
+        image = torch.clamp(image * 255, 0., 255.) - self.mean
+
+        desc = self.backbone(image)
+        b, c = desc.shape[:2]
+        desc = F.normalize(desc.view(b, c, -1), dim=1)
+        desc = self.netvlad(desc)
+        if hasattr(self, 'whiten'):
+            desc = F.normalize(self.whiten(desc), dim=1)
+        return {'global_descriptor': desc}
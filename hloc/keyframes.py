@@ -0,0 +1,102 @@
+import argparse
+import logging
+import time
+from pathlib import Path
+from collections import defaultdict
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from .extract_features import ImageDataset
+from .utils.global_descriptors import GlobalDescriptors
+
+
+'''
+Select the keyframes of image sequences by discarding near-duplicate frames,
+e.g. while a vehicle is stopped. A frame is kept if it differs enough from
+the last keyframe of its sequence, i.e. of its directory. The novelty is
+measured either on small thumbnails, which are cheap to decode with reduced
+JPEG decoding, or with global descriptors, if they were already extracted.
+'''
+default_conf = {
+    # the longest side of the thumbnails, in pixels
+    'thumbnail_size': 64,
+    # minimum mean absolute difference of the zero-mean thumbnails, in [0, 1]
+    'min_difference': 0.02,
+    # maximum similarity of the global descriptors of consecutive keyframes
+    'max_similarity': 0.95,
+}
+
+
+def thumbnail_difference(a, b):
+    """Mean absolute difference of two thumbnails, insensitive to exposure."""
+    if a.shape != b.shape:
+        return np.inf
+    return np.abs((a - a.mean()) - (b - b.mean())).mean()
+
+
+def iterate_thumbnails(image_dir, conf, image_list=None, num_workers=1):
+    dataset = ImageDataset(image_dir, {
+        'grayscale': True,
+        'resize_max': conf['thumbnail_size'],
+        'reduced_decoding': True,
+    }, image_list)
+    loader = torch.utils.data.DataLoader(dataset, num_workers=num_workers)
+    for data in tqdm(loader):
+        yield data['name'][0], data['image'][0, 0].numpy()
+
+
+def iterate_descriptors(global_descriptors, image_list=None):
+    descriptors = GlobalDescriptors(global_descriptors)
+    for name in tqdm(image_list or descriptors.names):
+        yield name, descriptors.read([name])[0]
+
+
+def main(image_dir, output, conf=None, global_descriptors=None,
+         image_list=None, num_workers=1):
+    conf = {**default_conf, **(conf or {})}
+    if global_descriptors is None:
+        frames = iterate_thumbnails(image_dir, conf, image_list, num_workers)
+        is_novel = (lambda x, key: thumbnail_difference(x, key)
+                    >= conf['min_difference'])
+    else:
+        frames = iterate_descriptors(global_descriptors, image_list)
+        is_novel = (lambda x, key: np.dot(x, key) <= conf['max_similarity'])
+
+    last = {}  # the last keyframe of each sequence
+    keyframes = []
+    total = defaultdict(int)
+    start = time.perf_counter()
+    for name, x in frames:
+        sequence = Path(name).parent.as_posix()
+        total[sequence] += 1
+        if sequence not in last or is_novel(x, last[sequence]):
+            last[sequence] = x
+            keyframes.append(name)
+    duration = time.perf_counter() - start
+
+    num_frames = sum(total.values())
+    logging.info(
+        f'Selected {len(keyframes)} keyframes out of {num_frames} frames '
+        f'({100*len(keyframes)/max(num_frames, 1):.1f}%) in {len(total)} '
+        f'sequences, at {num_frames/duration:.1f} frames/s.')
+    with open(str(output), 'w') as f:
+        f.write('\n'.join(keyframes))
+    return keyframes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dir', type=Path, required=True)
+    parser.add_argument('--output', type=Path, required=True)
+    parser.add_argument('--global_descriptors', type=Path)
+    parser.add_argument('--min_difference', type=float,
+                        default=default_conf['min_difference'])
+    parser.add_argument('--max_similarity', type=float,
+                        default=default_conf['max_similarity'])
+    parser.add_argument('--num_workers', type=int, default=1)
+    args = parser.parse_args()
+    main(args.image_dir, args.output, {
+        'min_difference': args.min_difference,
+        'max_similarity': args.max_similarity,
+    }, args.global_descriptors, num_workers=args.num_workers)
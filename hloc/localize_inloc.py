@@ -11,6 +11,7 @@ import cv2
 import pycolmap
 
 from .utils.parsers import parse_retrieval, names_to_pair
+from .utils.io import read_feature
 
 
 def interpolate_scan(scan, kp):
@@ -69,11 +70,11 @@ def pose_from_cluster(dataset_dir, q, retrieved, feature_file, match_file,
     all_mkpr = []
     all_mkp3d = []
     all_indices = []
-    kpq = feature_file[q]['keypoints'].__array__()
+    kpq = read_feature(feature_file[q], 'keypoints')
     num_matches = 0
 
     for i, r in enumerate(retrieved):
-        kpr = feature_file[r]['keypoints'].__array__()
+        kpr = read_feature(feature_file[r], 'keypoints')
         pair = names_to_pair(q, r)
         m = match_file[pair]['matches0'].__array__()
         v = (m > -1)
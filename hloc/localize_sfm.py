@@ -11,6 +11,7 @@ import pycolmap
 from .utils.read_write_model import read_model
 from .utils.parsers import (
     parse_image_lists_with_intrinsics, parse_retrieval, names_to_pair)
+from .utils.io import read_feature
 
 
 def do_covisibility_clustering(frame_ids, all_images, points3D):
@@ -46,7 +47,7 @@ def do_covisibility_clustering(frame_ids, all_images, points3D):
 
 
 def pose_from_cluster_with_feature(query_feature, qinfo, db_ids, db_images, points3D, feature_match, thresh):
-    kpq = query_feature['keypoints'].__array__()
+    kpq = read_feature(query_feature, 'keypoints')
     kp_idx_to_3D = defaultdict(list)
     kp_idx_to_3D_to_db = defaultdict(lambda: defaultdict(list))
     num_matches = 0
@@ -96,7 +97,7 @@ def pose_from_cluster_with_feature(query_feature, qinfo, db_ids, db_images, poin
 
 def pose_from_cluster(qname, qinfo, db_ids, db_images, points3D,
                       feature_file, match_file, thresh):
-    kpq = feature_file[qname]['keypoints'].__array__()
+    kpq = read_feature(feature_file[qname], 'keypoints')
     kp_idx_to_3D = defaultdict(list)
     kp_idx_to_3D_to_db = defaultdict(lambda: defaultdict(list))
     num_matches = 0
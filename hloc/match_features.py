@@ -1,4 +1,8 @@
 import argparse
+import glob
+import json
+import os
+import multiprocessing
 import torch
 from pathlib import Path
 import h5py
@@ -10,6 +14,15 @@ import numpy as np
 from . import matchers
 from .utils.base_model import dynamic_load
 from .utils.parsers import names_to_pair
+from .utils.io import list_names, merge_files, new_shard_run
+from .utils.io import remove_unlinked_shards
+from .utils.codecs import codec_for_features
+from .utils.ann import IVFIndex
+from .utils.feature_cache import FeatureCache, Prefetcher, load_features
+from .utils.global_descriptors import GlobalDescriptors
+from .utils.journal import MatchJournal
+from .plan_pairs import (
+    orders, parse_pairs, plan_pairs, expected_hit_rate, split_pairs)
 
 
 '''
@@ -43,27 +56,61 @@ def get_model(conf):
     model = Model(conf['model']).eval().to(device)
     return model
 
+
+def load_matcher(conf, device, *feature_paths):
+    """Build the matcher, letting it compare compressed descriptors if the
+    feature files are compressed and if it supports it.
+
+    Returns the model and the codec with which the descriptors must be
+    decoded before matching, if any.
+    """
+    codec = codec_for_features(*feature_paths)
+    Model = dynamic_load(matchers, conf['model']['name'])
+    model_conf = conf['model']
+    if codec is not None and 'codec' in Model.default_conf:
+        model_conf = {**model_conf, 'codec': codec}
+        codec = None
+    return Model(model_conf).eval().to(device), codec
+
+
+def pair_data(feats0, feats1, device, codec=None):
+    """Batch the features of a pair of images as the input of a matcher.
+
+    The features are HDF5 groups or the tensors of a FeatureCache, which
+    are already decoded.
+    """
+    data = {}
+    for i, feats in enumerate([feats0, feats1]):
+        if not isinstance(feats, dict):
+            feats = load_features(feats, device, codec)
+        data.update({k+str(i): v[None] for k, v in feats.items()})
+        # some matchers might expect an image but only use its size
+        size = tuple(int(x) for x in feats['image_size'].tolist())
+        data[f'image{i}'] = torch.empty((1, 1,)+size[::-1])
+    return data
+
 @torch.no_grad()
-def do_match (name0, name1, pairs, matched, num_matches_found, model, match_file, feature_file, query_feature_file, min_match_score, min_valid_ratio):
+def do_match (name0, name1, pairs, matched, num_matches_found, model, journal, feature_file, query_feature_file, min_match_score, min_valid_ratio, codec=None, cache=None):
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     pair = names_to_pair(name0, name1)
 
     # Avoid to recompute duplicates to save time
-    if len({(name0, name1), (name1, name0)} & matched) or pair in match_file:
+    if len({(name0, name1), (name1, name0)} & matched):
         return num_matches_found
-    data = {}
-    feats0, feats1 = query_feature_file[name0], feature_file[name1]
-    for k in feats1.keys():
-        data[k+'0'] = feats0[k].__array__()
-    for k in feats1.keys():
-        data[k+'1'] = feats1[k].__array__()
-    data = {k: torch.from_numpy(v)[None].float().to(device)
-            for k, v in data.items()}
-
-    # some matchers might expect an image but only use its size
-    data['image0'] = torch.empty((1, 1,)+tuple(feats0['image_size'])[::-1])
-    data['image1'] = torch.empty((1, 1,)+tuple(feats1['image_size'])[::-1])
+    if journal.recovering and pair in journal.rejected:
+        return num_matches_found
+    if pair in journal:
+        # matched and valid in a previous run
+        pairs.setdefault(name0, set()).add(name1)
+        matched |= {(name0, name1), (name1, name0)}
+        return num_matches_found + 1
+    if cache is not None:
+        feats0 = cache.read(query_feature_file, name0)
+        feats1 = cache.read(feature_file, name1)
+    else:
+        feats0, feats1 = query_feature_file[name0], feature_file[name1]
+    data = pair_data(feats0, feats1, device, codec)
 
     pred = model(data)
     matches = pred['matches0'][0].cpu().short().numpy()
@@ -77,29 +124,30 @@ def do_match (name0, name1, pairs, matched, num_matches_found, model, match_file
             v = set(())
         v.add(name1)
         pairs[name0] = v
-        grp = match_file.create_group(pair)
-        grp.create_dataset('matches0', data=matches)
-        grp.create_dataset('matching_scores0', data=scores)
+        journal.write(pair, matches0=matches, matching_scores0=scores)
         matched |= {(name0, name1), (name1, name0)}
         num_matches_found += 1
+    else:
+        journal.reject(pair)
 
     return num_matches_found
 
 
 @torch.no_grad()
 def best_match(conf, global_feature_path, feature_path, match_output_path, query_global_feature_path=None, query_feature_path=None, num_match_required=10,
-               max_try=None, min_matched=None, pair_file_path=None, num_seq=False, sample_list=None, sample_list_path=None, min_match_score=0.85, min_valid_ratio=0.09):
+               max_try=None, min_matched=None, pair_file_path=None, num_seq=False, sample_list=None, sample_list_path=None, min_match_score=0.85, min_valid_ratio=0.09,
+               index_path=None, num_probes=None, cache_size=1 << 30, checkpoint_interval=60):
     logging.info('Dyn Matching local features with configuration:'
                  f'\n{pprint.pformat(conf)}')
 
 
     assert global_feature_path.exists(), feature_path
-    global_feature_file = h5py.File(str(global_feature_path), 'r')
+    global_descriptors = GlobalDescriptors(global_feature_path)
     if query_global_feature_path is not None:
         logging.info(f'(Using query_global_feature_path:{query_global_feature_path}')
-        query_global_feature_file = h5py.File(str(query_global_feature_path), 'r')
+        query_global_descriptors = GlobalDescriptors(query_global_feature_path)
     else:
-        query_global_feature_file = global_feature_file
+        query_global_descriptors = global_descriptors
 
     assert feature_path.exists(), feature_path
     feature_file = h5py.File(str(feature_path), 'r')
@@ -109,79 +157,96 @@ def best_match(conf, global_feature_path, feature_path, match_output_path, query
     else:
         query_feature_file = feature_file
 
-    match_file = h5py.File(str(match_output_path), 'a')
-
     if sample_list_path is not None:
-        sample_list = json.load(open(str(sample_list_path, 'r')))
+        with open(str(sample_list_path), 'r') as f:
+            sample_list = json.load(f)
 
     # get all sample names
     if sample_list is not None:
         names = sample_list
         q_names = names
     else:
-        names = []
-        global_feature_file.visititems(
-            lambda _, obj: names.append(obj.parent.name.strip('/'))
-            if isinstance(obj, h5py.Dataset) else None)
-        names = list(set(names))
-        names.sort()
-        q_names = []
-        query_global_feature_file.visititems(
-            lambda _, obj: q_names.append(obj.parent.name.strip('/'))
-            if isinstance(obj, h5py.Dataset) else None)
-        q_names = list(set(q_names))
-        q_names.sort()
+        names = global_descriptors.names
+        q_names = query_global_descriptors.names
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    def tensor_from_names(names, hfile):
-        desc = [hfile[i]['global_descriptor'].__array__() for i in names]
-        desc = torch.from_numpy(np.stack(desc, 0)).to(device).float()
-        return desc
-
-    desc = tensor_from_names(names, global_feature_file)
-    if query_global_feature_path is not None:
-        q_desc = tensor_from_names(q_names, query_global_feature_file)
-    else:
-        q_desc = desc
-    # descriptors are normalized, dot product indicates how close they are
-    sim = torch.einsum('id,jd->ij', q_desc, desc)
     if max_try is None:
         max_try = len(names)
-    topk = torch.topk(sim, max_try, dim=1).indices.cpu().numpy()
-
-    Model = dynamic_load(matchers, conf['model']['name'])
-    model = Model(conf['model']).eval().to(device)
+    if index_path is not None:
+        # approximate search, without reading the database descriptors
+        index = IVFIndex(index_path)
+        position = {n: i for i, n in enumerate(names)}
+        mask = np.array([n in position for n in index.names])
+        q_desc = query_global_descriptors.tensor(q_names, device)
+        _, ids = index.search(q_desc.cpu().numpy(), max_try, num_probes, mask)
+        topk = [[position[index.names[i]] for i in row if i >= 0]
+                for row in ids]
+    else:
+        desc = global_descriptors.tensor(names, device)
+        if query_global_feature_path is not None:
+            q_desc = query_global_descriptors.tensor(q_names, device)
+        else:
+            q_desc = desc
+        # descriptors are normalized, dot product indicates how close they are
+        sim = torch.einsum('id,jd->ij', q_desc, desc)
+        topk = torch.topk(sim, max_try, dim=1).indices.cpu().numpy()
+
+    model, codec = load_matcher(
+        conf, device, feature_path, query_feature_path or feature_path)
+
+    def candidates(name0, indices):
+        """The sequential neighbors and the retrieved images to match with
+        an image, in order."""
+        seq = []
+        if num_seq is not None:
+            name0_at = names.index(name0)
+            seq = [names[i] for i in range(max(name0_at - num_seq, 0),
+                                           min(name0_at + num_seq, len(names)))
+                   if names[i] != name0]
+        retrieved = [names[i] for i in indices
+                     if query_global_feature_path is not None
+                     or names[i] != name0]
+        return seq, retrieved
+
+    def requests():
+        for name0, indices in zip(q_names, topk):
+            yield query_feature_file, name0
+            for name1 in sum(candidates(name0, indices), []):
+                yield feature_file, name1
+
+    # the features of the next candidates are read while matching
+    cache = FeatureCache(cache_size, device, codec)
+    prefetcher = Prefetcher(cache, requests())
+    prefetcher.start()
+    position = 0
 
     pairs = {}
     matched = set()
-    for name0, indices in tqdm(zip(q_names, topk)):
-        num_matches_found = 0
-        # try sequential neighbor first
-        if num_seq is not None:
-            name0_at = names.index(name0)
-            begin_from = name0_at - num_seq
-            if begin_from < 0:
-                begin_from = 0
-            for i in range(begin_from, name0_at+num_seq):
-                if i >= len(names):
-                    break
-                name1 = names[i]
-                if name0 != name1:
-                    num_matches_found = do_match(name0, name1, pairs, matched, num_matches_found, model, match_file, feature_file, query_feature_file, min_match_score, min_valid_ratio)
-
-        # then the global retrievel
-        for i in indices:
-            name1 = names[i]
-            if query_global_feature_path is not None or name0 != name1:
-                num_matches_found = do_match(name0, name1, pairs, matched, num_matches_found, model, match_file, feature_file, query_feature_file, min_match_score, min_valid_ratio)
+    # the matches are resumed from the last checkpoint of an interrupted run
+    with MatchJournal(match_output_path, checkpoint_interval) as journal:
+        for name0, indices in tqdm(zip(q_names, topk)):
+            seq, retrieved = candidates(name0, indices)
+            prefetcher.seek(position)
+            position += 1 + len(seq) + len(retrieved)
+            num_matches_found = 0
+            # try sequential neighbor first
+            for name1 in seq:
+                num_matches_found = do_match(name0, name1, pairs, matched, num_matches_found, model, journal, feature_file, query_feature_file, min_match_score, min_valid_ratio, codec, cache)
+                prefetcher.advance()
+
+            # then the global retrievel
+            for name1 in retrieved:
+                num_matches_found = do_match(name0, name1, pairs, matched, num_matches_found, model, journal, feature_file, query_feature_file, min_match_score, min_valid_ratio, codec, cache)
+                prefetcher.advance()
                 if num_matches_found >= num_match_required:
                     break
 
-        if num_matches_found < num_match_required:
-            logging.warning(f'num match for {name0} found {num_matches_found} less than num_match_required:{num_match_required}')
+            if num_matches_found < num_match_required:
+                logging.warning(f'num match for {name0} found {num_matches_found} less than num_match_required:{num_match_required}')
 
-    match_file.close()
+    prefetcher.close()
+    logging.info(f'Feature cache: {cache.summary()}.')
     if pair_file_path is not None:
         if min_matched is not None:
             pairs = {k:v for k,v in pairs.items() if len(v) >= min_matched }
@@ -194,7 +259,9 @@ def best_match(conf, global_feature_path, feature_path, match_output_path, query
     logging.info('Finished exporting matches.')
 
 @torch.no_grad()
-def main(conf, pairs, features, export_dir, db_features=None, query_features=None, output_dir=None, exhaustive=False):
+def main(conf, pairs, features, export_dir, db_features=None, query_features=None, output_dir=None, exhaustive=False,
+         order='auto', cache_size=1 << 30, workers=1,
+         threads_per_worker=None, link_shards=False, checkpoint_interval=60):
     logging.info('Matching local features with configuration:'
                  f'\n{pprint.pformat(conf)}')
 
@@ -216,71 +283,180 @@ def main(conf, pairs, features, export_dir, db_features=None, query_features=Non
     pairs_name = pairs.stem
     if not exhaustive:
         assert pairs.exists(), pairs
-        with open(pairs, 'r') as f:
-            pair_list = f.read().rstrip('\n').split('\n')
+        pair_list = parse_pairs(pairs)
     elif exhaustive:
         logging.info(f'Writing exhaustive match pairs to {pairs}.')
         assert not pairs.exists(), pairs
 
         # get the list of images from the feature file
-        images = []
-        feature_file.visititems(
-            lambda name, obj: images.append(obj.parent.name.strip('/'))
-            if isinstance(obj, h5py.Dataset) else None)
-        images = list(set(images))
+        images = list_names(feature_file)
 
-        pair_list = [' '.join((images[i], images[j]))
+        pair_list = [(images[i], images[j])
                      for i in range(len(images)) for j in range(i)]
         with open(str(pairs), 'w') as f:
-            f.write('\n'.join(pair_list))
-
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    Model = dynamic_load(matchers, conf['model']['name'])
-    model = Model(conf['model']).eval().to(device)
+            f.write('\n'.join(' '.join(p) for p in pair_list))
 
     match_name = f'{features}_{conf["output"]}_{pairs_name}'
     if output_dir is None:
         output_dir = export_dir
     match_path = Path(output_dir, match_name+'.h5')
     match_path.parent.mkdir(exist_ok=True, parents=True)
-    match_file = h5py.File(str(match_path), 'a')
 
-    matched = set()
-    for pair in tqdm(pair_list, smoothing=.1):
-        name0, name1 = pair.split(' ')
-        pair = names_to_pair(name0, name1)
+    with MatchJournal(match_path, checkpoint_interval) as journal:
+        recover_shards(journal)
+        # duplicates and completed pairs are skipped up front
+        num_pairs = len(pair_list)
+        pair_list = plan_pairs(pair_list, journal.completed, order)
+        logging.info(
+            f'Matching {len(pair_list)} new pairs out of {num_pairs}.')
+
+        if workers > 1:
+            match_sharded(conf, pair_list, feature_path, query_features,
+                          journal, workers, threads_per_worker, link_shards,
+                          cache_size)
+        else:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            model, codec = load_matcher(
+                conf, device, feature_path, query_features)
+            match_pairs(model, pair_list, query_feature_file, feature_file,
+                        journal, device, cache_size, codec)
+    logging.info('Finished exporting matches.')
 
-        # Avoid to recompute duplicates to save time
-        if len({(name0, name1), (name1, name0)} & matched) \
-                or pair in match_file:
-            continue
 
-        data = {}
-        feats0, feats1 = query_feature_file[name0], feature_file[name1]
-        for k in feats1.keys():
-            data[k+'0'] = feats0[k].__array__()
-        for k in feats1.keys():
-            data[k+'1'] = feats1[k].__array__()
-        data = {k: torch.from_numpy(v)[None].float().to(device)
-                for k, v in data.items()}
-
-        # some matchers might expect an image but only use its size
-        data['image0'] = torch.empty((1, 1,)+tuple(feats0['image_size'])[::-1])
-        data['image1'] = torch.empty((1, 1,)+tuple(feats1['image_size'])[::-1])
+@torch.no_grad()
+def match_pairs(model, pairs, query_feature_file, feature_file, journal,
+                device, cache_size=1 << 30, codec=None):
+    """Match a planned list of pairs and write the matches to a journaled
+    match file."""
+    # the features of the next pairs are read while matching
+    cache = FeatureCache(cache_size, device, codec)
+    prefetcher = Prefetcher(cache, (
+        (f, n) for p in pairs
+        for f, n in zip([query_feature_file, feature_file], p)))
+    prefetcher.start()
+
+    for i, (name0, name1) in enumerate(tqdm(pairs, smoothing=.1)):
+        feats0 = cache.read(query_feature_file, name0)
+        feats1 = cache.read(feature_file, name1)
+        prefetcher.advance(2)
+        data = pair_data(feats0, feats1, device)
+        if i == 0:
+            same_file = (Path(query_feature_file.filename).resolve()
+                         == Path(feature_file.filename).resolve())
+            rate = expected_hit_rate(pairs, cache.capacity(), same_file)
+            logging.info(f'Expected feature cache hit rate {100*rate:.1f}%.')
 
         pred = model(data)
-        grp = match_file.create_group(pair)
-        matches = pred['matches0'][0].cpu().short().numpy()
-        grp.create_dataset('matches0', data=matches)
-
+        matches = {'matches0': pred['matches0'][0].cpu().short().numpy()}
         if 'matching_scores0' in pred:
-            scores = pred['matching_scores0'][0].cpu().half().numpy()
-            grp.create_dataset('matching_scores0', data=scores)
+            matches['matching_scores0'] = (
+                pred['matching_scores0'][0].cpu().half().numpy())
+        journal.write(names_to_pair(name0, name1), **matches)
 
-        matched |= {(name0, name1), (name1, name0)}
+    prefetcher.close()
+    logging.info(f'Feature cache: {cache.summary()}.')
 
-    match_file.close()
-    logging.info('Finished exporting matches.')
+
+def shard_path(match_path, run, index):
+    return Path(str(match_path.with_suffix(''))+f'.run{run}.shard{index}.h5')
+
+
+def recover_shards(journal):
+    """Move the completed matches of the shards of an interrupted run into
+    the match file. The shards of a completed run have no journal."""
+    match_path = journal.match_path
+    paths = sorted(match_path.parent.glob(
+        glob.escape(match_path.stem)+'.run*.shard*.h5'))
+    for path in paths:
+        if not Path(str(path)+'.journal').exists():
+            continue
+        with MatchJournal(path) as shard:
+            pairs = sorted(shard.completed)
+            for pair in pairs:
+                if pair in journal.file:
+                    del journal.file[pair]
+                shard.file.copy(shard.file[pair], journal.file, name=pair)
+        for pair in pairs:
+            journal.add(pair)
+        journal.checkpoint()
+        path.unlink()
+        Path(str(path)+'.journal').unlink()
+        logging.info(f'Recovered {len(pairs)} matched pairs from {path}.')
+
+
+def match_shard(conf, pairs, feature_path, query_features, match_path,
+                num_threads, cores, cache_size, checkpoint_interval):
+    if cores:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model, codec = load_matcher(conf, device, feature_path, query_features)
+    with h5py.File(str(feature_path), 'r') as feature_file, \
+            h5py.File(str(query_features), 'r') as query_feature_file, \
+            MatchJournal(match_path, checkpoint_interval) as journal:
+        match_pairs(model, pairs, query_feature_file, feature_file,
+                    journal, device, cache_size, codec)
+
+
+def match_sharded(conf, pairs, feature_path, query_features, journal,
+                  num_workers, threads_per_worker=None, link_shards=False,
+                  cache_size=1 << 30):
+    """Split the planned pairs across processes that each write their own
+    shard of matches.
+
+    Each process runs its own matcher with `threads_per_worker` intra-op
+    threads, pinned to its own cores if there are enough of them. The
+    shards are contiguous in the planned order, such that each worker
+    reuses its cached features. They are then merged into the match file,
+    either by copy or, with `link_shards`, as external links to the shards.
+    Shards are journaled too, and recovered by the next run if a worker
+    fails. Each run writes new shards, since previous ones may be linked,
+    and deletes the shards that are not linked anymore after the merge.
+    """
+    if len(pairs) == 0:
+        return
+    threads_per_worker = threads_per_worker or max(
+        1, multiprocessing.cpu_count() // num_workers)
+    cores = []
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < num_workers * threads_per_worker:
+        cores = []
+    logging.info(f'Matching in {num_workers} processes with '
+                 f'{threads_per_worker} threads each.')
+    ctx = multiprocessing.get_context('spawn')
+    run = new_shard_run(journal.match_path.with_suffix(''))
+    shard_paths, processes = [], []
+    for i, shard in enumerate(split_pairs(pairs, num_workers)):
+        path = shard_path(journal.match_path, run, i)
+        worker_cores = cores[i*threads_per_worker:(i+1)*threads_per_worker]
+        p = ctx.Process(target=match_shard, args=(
+            conf, shard, feature_path, query_features, path,
+            threads_per_worker, worker_cores, cache_size, journal.interval))
+        p.start()
+        shard_paths.append(path)
+        processes.append(p)
+    for p in processes:
+        p.join()
+    failed = [i for i, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Matching failed for shards {failed}, their '
+                           'completed pairs are recovered by the next run.')
+
+    for pair in merge_files(shard_paths, journal.file, link=link_shards,
+                            index_names=False):
+        journal.add(pair)
+    journal.checkpoint()
+    for path in shard_paths:
+        Path(str(path)+'.journal').unlink()
+        if not link_shards:
+            path.unlink()
+    removed = remove_unlinked_shards(
+        journal.file, journal.match_path.with_suffix(''))
+    if removed:
+        logging.info(f'Deleted {len(removed)} shards of previous runs that '
+                     'are not linked anymore.')
+    logging.info('Finished merging the match shards.')
 
 
 if __name__ == '__main__':
@@ -296,6 +472,14 @@ if __name__ == '__main__':
     parser.add_argument('--conf', type=str, default='superglue',
                         choices=list(confs.keys()))
     parser.add_argument('--exhaustive', action='store_true')
+    parser.add_argument('--order', type=str, default='auto', choices=orders)
+    parser.add_argument('--cache_size', type=float, default=1,
+                        help='size of the feature cache in GB')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads_per_worker', type=int)
+    parser.add_argument('--link_shards', action='store_true')
+    parser.add_argument('--checkpoint_interval', type=float, default=60,
+                        help='seconds between checkpoints of the matches')
 
     # best_match
     parser.add_argument('--best_match', action='store_true')
@@ -312,14 +496,23 @@ if __name__ == '__main__':
     parser.add_argument('--min_valid_ratio', type=float, default=0.09)
     parser.add_argument('--sample_list_path', type=Path)
     parser.add_argument('--pair_file_path', type=Path)
+    parser.add_argument('--index_path', type=Path)
+    parser.add_argument('--num_probes', type=int)
 
     args = parser.parse_args()
     if args.best_match:
         best_match(confs[args.conf], args.global_feature_path, args.feature_path, args.match_output_path,
                    query_global_feature_path=args.query_global_feature_path, query_feature_path=args.query_feature_path,
                    num_match_required=args.num_match_required, min_matched=args.min_matched, min_match_score=args.min_match_score, min_valid_ratio=args.min_valid_ratio,
-                   max_try=args.max_try, num_seq=args.num_seq, sample_list_path=args.sample_list_path, pair_file_path=args.pair_file_path)
+                   max_try=args.max_try, num_seq=args.num_seq, sample_list_path=args.sample_list_path, pair_file_path=args.pair_file_path,
+                   index_path=args.index_path, num_probes=args.num_probes,
+                   cache_size=int(args.cache_size * (1 << 30)),
+                   checkpoint_interval=args.checkpoint_interval)
     else:
         main(
             confs[args.conf], args.pairs, args.features,args.export_dir,
-            db_features=args.db_features, query_features=args.query_features, output_dir=args.output_dir, exhaustive=args.exhaustive)
+            db_features=args.db_features, query_features=args.query_features, output_dir=args.output_dir, exhaustive=args.exhaustive,
+            order=args.order, cache_size=int(args.cache_size * (1 << 30)),
+            workers=args.workers, threads_per_worker=args.threads_per_worker,
+            link_shards=args.link_shards,
+            checkpoint_interval=args.checkpoint_interval)
@@ -1,8 +1,8 @@
 import argparse
 import torch
+import torch.nn.functional as F
 from pathlib import Path
 import h5py
-import numpy as np
 import logging
 from tqdm import tqdm
 import pprint
@@ -10,6 +10,10 @@ import pprint
 from . import matchers
 from .utils.base_model import dynamic_load
 from .utils.parsers import names_to_pair
+from .utils.io import read_feature, list_names
+from .utils.codecs import codec_for_features
+from .utils.feature_cache import FeatureCache, Prefetcher
+from .plan_pairs import orders, parse_pairs, plan_pairs
 
 
 '''
@@ -42,8 +46,59 @@ def chunks(lst, n):
     for i in range(0, len(lst), n):
         yield lst[i:i + n]
 
+
+def feature_shape(grp):
+    """The number of keypoints and the size of an image, without reading
+    its features."""
+    return grp['keypoints'].shape[0], tuple(
+        read_feature(grp, 'image_size').tolist())
+
+
+def bucket_pairs(pairs, shape, batch_size, window=16):
+    """Group the pairs with similar numbers of keypoints into batches.
+
+    `shape` maps a pair to its sort key. The pairs are sorted within
+    windows of `window` batches only, which keeps most of their order and
+    thus of the reuse of the feature cache, see plan_pairs.py.
+    """
+    batches = []
+    step = batch_size * window
+    for i in range(0, len(pairs), step):
+        batches += chunks(sorted(pairs[i:i+step], key=shape), batch_size)
+    return batches
+
+
+def batch_data(feats):
+    """Pad the features of pairs of images to a batch.
+
+    `feats` is a list of pairs of feature tensors, as returned by a
+    FeatureCache. The masks of the valid keypoints and the image size of
+    each pair are added such that the matchers ignore the padding.
+    """
+    data = {}
+    for i in range(2):
+        fs = [f[i] for f in feats]
+        num = [len(f['keypoints']) for f in fs]
+        n = max(num)
+        data[f'keypoints{i}'] = torch.stack([
+            F.pad(f['keypoints'], (0, 0, 0, n-m)) for f, m in zip(fs, num)])
+        data[f'descriptors{i}'] = torch.stack([
+            F.pad(f['descriptors'], (0, n-m)) for f, m in zip(fs, num)])
+        data[f'scores{i}'] = torch.stack([
+            F.pad(f['scores'], (0, n-m)) for f, m in zip(fs, num)])
+        indices = torch.arange(n, device=fs[0]['keypoints'].device)
+        data[f'mask{i}'] = torch.stack([indices < m for m in num])
+        data[f'image_size{i}'] = torch.stack([f['image_size'] for f in fs])
+        # some matchers might expect an image but only use its size
+        w, h = (int(x) for x in fs[0]['image_size'].tolist())
+        data[f'image{i}'] = torch.empty((1, 1, h, w)).expand(
+            len(fs), -1, -1, -1)
+    return data
+
+
 @torch.no_grad()
-def main(conf, pairs, features, export_dir, query_features=None, output_dir=None, exhaustive=False, batch_size=1):
+def main(conf, pairs, features, export_dir, query_features=None, output_dir=None, exhaustive=False, batch_size=1, cache_size=1 << 30,
+         order='auto'):
     logging.info('Matching local features with configuration:'
                  f'\n{pprint.pformat(conf)}'
                  f'\nbatch size is {batch_size}')
@@ -63,27 +118,24 @@ def main(conf, pairs, features, export_dir, query_features=None, output_dir=None
     pairs_name = pairs.stem
     if not exhaustive:
         assert pairs.exists(), pairs
-        with open(pairs, 'r') as f:
-            pair_list = f.read().rstrip('\n').split('\n')
+        pair_list = parse_pairs(pairs)
     elif exhaustive:
         logging.info(f'Writing exhaustive match pairs to {pairs}.')
         assert not pairs.exists(), pairs
 
         # get the list of images from the feature file
-        images = []
-        feature_file.visititems(
-            lambda name, obj: images.append(obj.parent.name.strip('/'))
-            if isinstance(obj, h5py.Dataset) else None)
-        images = list(set(images))
+        images = list_names(feature_file)
 
-        pair_list = [' '.join((images[i], images[j]))
+        pair_list = [(images[i], images[j])
                      for i in range(len(images)) for j in range(i)]
         with open(str(pairs), 'w') as f:
-            f.write('\n'.join(pair_list))
+            f.write('\n'.join(' '.join(p) for p in pair_list))
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     Model = dynamic_load(matchers, conf['model']['name'])
     model = Model(conf['model']).eval().to(device)
+    # compressed descriptors are decoded since they are padded to a batch
+    codec = codec_for_features(feature_path, query_features)
 
     match_name = f'{features}_{conf["output"]}_{pairs_name}'
     if output_dir is None:
@@ -92,77 +144,51 @@ def main(conf, pairs, features, export_dir, query_features=None, output_dir=None
     match_path.parent.mkdir(exist_ok=True, parents=True)
     match_file = h5py.File(str(match_path), 'a')
 
-    matched = set()
-    for batch in tqdm(list(chunks(pair_list, batch_size)), smoothing=0.1):
-        kplist0 = []
-        kplist1 = []
-        desc0=[]
-        desc1=[]
-        sc0=[]
-        sc1=[]
-
-        for pair in batch:
-            name0, name1 = pair.split(' ')
-            pair = names_to_pair(name0, name1)
-
-            feats0, feats1 = query_feature_file[name0], feature_file[name1]
-            # Avoid to recompute duplicates to save time
-            if len({(name0, name1), (name1, name0)} & matched) \
-               or pair in match_file:
-                continue
-        
-            kplist0.append(feats0['keypoints'].__array__())
-            kplist1.append(feats1['keypoints'].__array__())
-            desc0.append(feats0['descriptors'].__array__())
-            desc1.append(feats1['descriptors'].__array__())
-            sc0.append(feats0['scores'].__array__())
-            sc1.append(feats1['scores'].__array__())
-
-        if len(kplist0) == 0:
-            continue
-        # pad feature0
-        size_list=[n.shape[0] for n in kplist0]
-        max_size = np.max(size_list)
-        kplist0 = [ np.concatenate((n, np.zeros((max_size-n.shape[0], n.shape[1]))), axis=0) for n in kplist0]
-        desc0 = [ np.concatenate((n, np.zeros((n.shape[0], max_size-n.shape[1]))), axis=1) for n in desc0]
-        sc0 = [ np.concatenate((n, np.zeros((max_size-n.shape[0]))), axis=0) for n in sc0]
-        # pad feature1
-        size_list=[n.shape[0] for n in kplist1]
-        max_size = np.max(size_list)
-        kplist1 = [ np.concatenate((n, np.zeros((max_size-n.shape[0], n.shape[1]))), axis=0) for n in kplist1]
-        desc1 = [ np.concatenate((n, np.zeros((n.shape[0], max_size-n.shape[1]))), axis=1) for n in desc1]
-        sc1 = [ np.concatenate((n, np.zeros((max_size-n.shape[0]))), axis=0) for n in sc1]
-
-        data = {'keypoints0':kplist0, 'descriptors0':desc0, 'scores0':sc0,'keypoints1':kplist1, 'descriptors1':desc1, 'scores1':sc1}
-        data = {k: torch.from_numpy(np.array(v)).float().to(device) for k, v in data.items()}
-
-        # some matchers might expect an image but only use its size
-        data['image0'] = torch.empty((len(sc0), 1,)+tuple(feats0['image_size'])[::-1])
-        data['image1'] = torch.empty((len(sc0), 1,)+tuple(feats1['image_size'])[::-1])
-
-        pred = model(data)
-
-        index=0
-        for pair in batch:
-            name0, name1 = pair.split(' ')
-            pair = names_to_pair(name0, name1)
-
-            # Avoid to recompute duplicates to save time
-            if len({(name0, name1), (name1, name0)} & matched) \
-               or pair in match_file:
-                continue
-
-            grp = match_file.create_group(pair)
-            matches = pred['matches0'][index].cpu().short().numpy()
+    # duplicates and existing pairs are skipped up front
+    num_pairs = len(pair_list)
+    pair_list = plan_pairs(pair_list, set(match_file.keys()), order)
+    logging.info(f'Matching {len(pair_list)} new pairs out of {num_pairs}.')
+
+    shapes0 = {n: feature_shape(query_feature_file[n])
+               for n in {p[0] for p in pair_list}}
+    shapes1 = {n: feature_shape(feature_file[n])
+               for n in {p[1] for p in pair_list}}
+    batches = bucket_pairs(
+        pair_list, lambda p: (shapes0[p[0]], shapes1[p[1]]), batch_size)
+    num_real = sum(shapes0[p[0]][0] + shapes1[p[1]][0] for p in pair_list)
+    num_padded = sum(len(b) * (max(shapes0[p[0]][0] for p in b)
+                               + max(shapes1[p[1]][0] for p in b))
+                     for b in batches)
+    logging.info(f'Padding {100*(1-num_real/max(num_padded, 1)):.1f}% of '
+                 f'the keypoints in {len(batches)} batches.')
+
+    # the features of the next batches are read while matching
+    cache = FeatureCache(cache_size, device, codec)
+    prefetcher = Prefetcher(cache, (
+        (f, n) for b in batches for p in b
+        for f, n in zip([query_feature_file, feature_file], p)),
+        lookahead=max(32, 2*batch_size))
+    prefetcher.start()
+
+    for batch in tqdm(batches, smoothing=0.1):
+        feats = [(cache.read(query_feature_file, name0),
+                  cache.read(feature_file, name1)) for name0, name1 in batch]
+        prefetcher.advance(2*len(batch))
+        pred = model(batch_data(feats))
+
+        for index, (name0, name1) in enumerate(batch):
+            num = len(feats[index][0]['keypoints'])
+            grp = match_file.create_group(names_to_pair(name0, name1))
+            matches = pred['matches0'][index, :num].cpu().short().numpy()
             grp.create_dataset('matches0', data=matches)
 
             if 'matching_scores0' in pred:
-                scores = pred['matching_scores0'][index].cpu().half().numpy()
-                grp.create_dataset('matching_scores0', data=scores)
-
-            matched |= {(name0, name1), (name1, name0)}
-            index += 1
+                scores = pred['matching_scores0'][index, :num]
+                grp.create_dataset(
+                    'matching_scores0', data=scores.cpu().half().numpy())
 
+    prefetcher.close()
+    logging.info(f'Feature cache: {cache.summary()}.')
     match_file.close()
     logging.info('Finished exporting matches.')
 
@@ -180,7 +206,11 @@ if __name__ == '__main__':
                         choices=list(confs.keys()))
     parser.add_argument('--exhaustive', action='store_true')
     parser.add_argument('--batch', type=int, default=1)
+    parser.add_argument('--order', type=str, default='auto', choices=orders)
+    parser.add_argument('--cache_size', type=float, default=1,
+                        help='size of the feature cache in GB')
     args = parser.parse_args()
     main(
         confs[args.conf], args.pairs, args.features,args.export_dir,
-        query_features=args.query_features, output_dir=args.output_dir, batch_size=args.batch, exhaustive=args.exhaustive)
+        query_features=args.query_features, output_dir=args.output_dir, batch_size=args.batch, exhaustive=args.exhaustive,
+        cache_size=int(args.cache_size * (1 << 30)), order=args.order)
@@ -24,11 +24,20 @@ def mutual_check(m0, m1):
     return m0_new
 
 
+def mask_matches(matches, scores, mask0, mask1):
+    """Invalidate the matches from or to padded keypoints."""
+    valid = mask0 & torch.gather(mask1, -1, matches.clamp(min=0))
+    return (torch.where(valid, matches, matches.new_tensor(-1)),
+            torch.where(valid, scores, scores.new_tensor(0)))
+
+
 class NearestNeighbor(BaseModel):
     default_conf = {
         'ratio_threshold': None,
         'distance_threshold': None,
         'do_mutual_check': True,
+        # compare compressed descriptors, see utils/codecs.py
+        'codec': None,
     }
     required_inputs = ['descriptors0', 'descriptors1']
 
@@ -36,17 +45,29 @@ class NearestNeighbor(BaseModel):
         pass
 
     def _forward(self, data):
-        sim = torch.einsum(
-            'bdn,bdm->bnm', data['descriptors0'], data['descriptors1'])
+        if self.conf['codec'] is None:
+            sim = torch.einsum(
+                'bdn,bdm->bnm', data['descriptors0'], data['descriptors1'])
+        else:
+            sim = self.conf['codec'].similarity(data)
+        # batched pairs are padded, see match_features_batch.py
+        masked = 'mask0' in data and not (
+            data['mask0'].all() and data['mask1'].all())
+        if masked:
+            valid = data['mask0'][:, :, None] & data['mask1'][:, None]
+            sim = sim.masked_fill(~valid, float('-inf'))
         matches0, scores0 = find_nn(
             sim, self.conf['ratio_threshold'], self.conf['distance_threshold'])
-        matches1, scores1 = find_nn(
-            sim.transpose(1, 2), self.conf['ratio_threshold'],
-            self.conf['distance_threshold'])
+        if masked:
+            matches0, scores0 = mask_matches(
+                matches0, scores0, data['mask0'], data['mask1'])
         if self.conf['do_mutual_check']:
             matches1, scores1 = find_nn(
                 sim.transpose(1, 2), self.conf['ratio_threshold'],
                 self.conf['distance_threshold'])
+            if masked:
+                matches1, scores1 = mask_matches(
+                    matches1, scores1, data['mask1'], data['mask0'])
             matches0 = mutual_check(matches0, matches1)
         return {
             'matches0': matches0,
@@ -1,5 +1,7 @@
 import sys
 from pathlib import Path
+import torch
+import torch.nn.functional as F
 
 from ..utils.base_model import BaseModel
 
@@ -22,4 +24,36 @@ class SuperGlue(BaseModel):
         self.net = SG(conf)
 
     def _forward(self, data):
+        if 'mask0' in data and not self.is_dense(data):
+            return self.forward_pairs(data)
         return self.net(data)
+
+    @staticmethod
+    def is_dense(data):
+        """Whether a batch has no padding and a single image size."""
+        return all(data[f'mask{i}'].all() and (
+            data[f'image_size{i}'] == data[f'image_size{i}'][:1]).all()
+            for i in range(2))
+
+    def forward_pairs(self, data):
+        """Match the pairs of a padded batch one by one, since attention
+        and keypoint normalization do not support padding."""
+        preds = []
+        for b in range(len(data['mask0'])):
+            pair = {}
+            for i in range(2):
+                n = int(data[f'mask{i}'][b].sum())
+                pair[f'keypoints{i}'] = data[f'keypoints{i}'][b:b+1, :n]
+                pair[f'scores{i}'] = data[f'scores{i}'][b:b+1, :n]
+                pair[f'descriptors{i}'] = data[f'descriptors{i}'][b:b+1, :, :n]
+                w, h = (int(x) for x in data[f'image_size{i}'][b].tolist())
+                pair[f'image{i}'] = torch.empty((1, 1, h, w))
+            preds.append(self.net(pair))
+
+        pred = {}
+        for k in preds[0]:
+            n = data[f'mask{k[-1]}'].shape[1]
+            fill = -1 if k.startswith('matches') else 0
+            pred[k] = torch.cat([F.pad(p[k], (0, n-p[k].shape[-1]), value=fill)
+                                 for p in preds])
+        return pred
@@ -1,53 +1,112 @@
 import argparse
 import logging
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import scipy.sparse as sp
 from tqdm import tqdm
-from collections import defaultdict
 
-from .utils.read_write_model import read_model
+from .utils.read_write_model import read_images_binary
+from .utils.parsers import parse_image_list
 
 
-def main(model, output, num_matched):
-    logging.info('Reading the COLMAP model...')
-    cameras, images, points3D = read_model(model, '.bin')
+def incidence_matrix(images):
+    """Sparse image x point matrix of the number of observations."""
+    rows, points = [], []
+    for i, image in enumerate(images):
+        ids = image.point3D_ids[image.point3D_ids != -1]
+        rows.append(np.full(len(ids), i))
+        points.append(ids)
+    rows, points = np.concatenate(rows), np.concatenate(points)
+    points, cols = np.unique(points, return_inverse=True)
+    return sp.csr_matrix(
+        (np.ones(len(rows), np.int32), (rows, cols)),
+        shape=(len(images), len(points)))
+
+
+def covisibility_matrix(incidence, num_workers=1, block_size=4096):
+    """Number of 3D points shared by each pair of images.
+
+    The product of the incidence matrix with its transpose is computed by
+    blocks of rows, in parallel threads.
+    """
+    transposed = incidence.T.tocsr()
+    starts = range(0, incidence.shape[0], block_size)
+
+    def block(start):
+        return incidence[start:start+block_size] @ transposed
+    with ThreadPoolExecutor(num_workers) as pool:
+        blocks = list(tqdm(pool.map(block, starts), total=len(starts)))
+    covis = sp.vstack(blocks, format='csr') if blocks else sp.csr_matrix(
+        (0, 0), dtype=np.int32)
+    covis = covis - sp.diags(covis.diagonal(), format='csr',
+                             dtype=covis.dtype)
+    covis.eliminate_zeros()
+    return covis
+
+
+def top_k(covis, k):
+    """The k columns of each row with the largest values, by decreasing
+    value and then increasing column."""
+    rows = np.repeat(np.arange(covis.shape[0]), np.diff(covis.indptr))
+    order = np.lexsort((covis.indices, -covis.data, rows))
+    rank = np.arange(len(order)) - covis.indptr[rows]
+    keep = order[rank < k]
+    return rows[keep], covis.indices[keep]
+
+
+def save_covisibility(path, covis, names):
+    sp.save_npz(str(path), covis)
+    with open(str(path)+'.names.txt', 'w') as f:
+        f.write('\n'.join(names))
+
+
+def load_covisibility(path):
+    covis = sp.load_npz(str(path)).tocsr()
+    names = parse_image_list(str(path)+'.names.txt')
+    return covis, names
+
+
+def main(model, output, num_matched, keyframes=None, covisibility=None,
+         num_workers=1):
+    """Find the num_matched images that share the most 3D points with each
+    image of a COLMAP model.
+
+    The covisibility graph of all the images is saved to the .npz file
+    `covisibility`, if given, and reused as long as the model is older.
+    """
+    images_path = Path(model, 'images.bin')
+    if covisibility is not None and Path(covisibility).exists() and (
+            Path(covisibility).stat().st_mtime
+            >= images_path.stat().st_mtime):
+        logging.info(f'Loading the covisibility graph {covisibility}...')
+        covis, names = load_covisibility(covisibility)
+    else:
+        logging.info('Reading the COLMAP model...')
+        images = list(read_images_binary(str(images_path)).values())
+        names = [image.name for image in images]
+        logging.info('Computing the covisibility graph...')
+        covis = covisibility_matrix(incidence_matrix(images), num_workers)
+        if covisibility is not None:
+            save_covisibility(covisibility, covis, names)
+
+    if keyframes is not None:
+        keyframes = set(parse_image_list(keyframes))
+        keep = [i for i, n in enumerate(names) if n in keyframes]
+        covis = covis[keep][:, keep]
+        covis.eliminate_zeros()
+        names = [names[i] for i in keep]
+        logging.info(f'Restricted to {len(names)} keyframes.')
 
     logging.info('Extracting image pairs from covisibility info...')
-    pairs = []
-    for image_id, image in tqdm(images.items()):
-        matched = image.point3D_ids != -1
-        points3D_covis = image.point3D_ids[matched]
-
-        covis = defaultdict(int)
-        for point_id in points3D_covis:
-            for image_covis_id in points3D[point_id].image_ids:
-                if image_covis_id != image_id:
-                    covis[image_covis_id] += 1
-
-        if len(covis) == 0:
-            logging.info(f'Image {image_id} does not have any covisibility.')
-            continue
-
-        covis_ids = np.array(list(covis.keys()))
-        covis_num = np.array([covis[i] for i in covis_ids])
-
-        if len(covis_ids) <= num_matched:
-            top_covis_ids = covis_ids[np.argsort(-covis_num)]
-        else:
-            # get covisible image ids with top k number of common matches
-            ind_top = np.argpartition(covis_num, -num_matched)
-            ind_top = ind_top[-num_matched:]  # unsorted top k
-            ind_top = ind_top[np.argsort(-covis_num[ind_top])]
-            top_covis_ids = [covis_ids[i] for i in ind_top]
-            assert covis_num[ind_top[0]] == np.max(covis_num)
-
-        for i in top_covis_ids:
-            pair = (image.name, images[i].name)
-            pairs.append(pair)
-
-    logging.info(f'Found {len(pairs)} pairs.')
+    for i in np.flatnonzero(np.diff(covis.indptr) == 0):
+        logging.info(f'Image {names[i]} does not have any covisibility.')
+    rows, cols = top_k(covis, num_matched)
+
+    logging.info(f'Found {len(rows)} pairs.')
     with open(output, 'w') as f:
-        f.write('\n'.join(' '.join([i, j]) for i, j in pairs))
+        f.write('\n'.join(f'{names[i]} {names[j]}'
+                          for i, j in zip(rows, cols)))
 
 
 if __name__ == "__main__":
@@ -55,5 +114,8 @@ if __name__ == "__main__":
     parser.add_argument('--model', required=True, type=Path)
     parser.add_argument('--output', required=True, type=Path)
     parser.add_argument('--num_matched', required=True, type=int)
+    parser.add_argument('--keyframes', type=Path)
+    parser.add_argument('--covisibility', type=Path)
+    parser.add_argument('--num_workers', type=int, default=1)
     args = parser.parse_args()
     main(**args.__dict__)
@@ -1,15 +1,18 @@
 import argparse
 import logging
 from pathlib import Path
-import h5py
 import numpy as np
 import torch
 
 from .utils.parsers import parse_image_lists_with_intrinsics
+from .utils.parsers import parse_image_list
+from .utils.ann import IVFIndex
+from .utils.global_descriptors import GlobalDescriptors
 
 
 def main(descriptors, output, num_matched, query_descriptors=None,
-         db_prefix=None, query_prefix=None, db_list=None, query_list=None):
+         db_prefix=None, query_prefix=None, db_list=None, query_list=None,
+         keyframes=None, block_size=4096, index=None, num_probes=None):
     logging.info('Extracting image pairs from a retrieval database.')
     has_query_descriptors = True
     if query_descriptors is not None:
@@ -19,26 +22,17 @@ def main(descriptors, output, num_matched, query_descriptors=None,
         query_descriptors = descriptors
         has_query_descriptors = False
         
-    hfile = h5py.File(str(descriptors), 'r')
-    q_hfile = h5py.File(str(query_descriptors), 'r')
+    db_global = GlobalDescriptors(descriptors)
+    q_global = GlobalDescriptors(query_descriptors)
 
     if db_prefix and query_prefix:
         if db_prefix == 'ALL':
             db_prefix = ''
         if query_prefix == 'ALL':
             query_prefix = ''
-        names = []
-        hfile.visititems(
-            lambda _, obj: names.append(obj.parent.name.strip('/'))
-            if isinstance(obj, h5py.Dataset) else None)
-        names = list(set(names))
-        db_names = [n for n in names if n.startswith(db_prefix)]
-        q_names = []
-        q_hfile.visititems(
-            lambda _, obj: q_names.append(obj.parent.name.strip('/'))
-            if isinstance(obj, h5py.Dataset) else None)
-        q_names = list(set(q_names))
-        query_names = [n for n in q_names if n.startswith(query_prefix)]
+        db_names = [n for n in db_global.names if n.startswith(db_prefix)]
+        query_names = [
+            n for n in q_global.names if n.startswith(query_prefix)]
         assert len(db_names)
         assert len(query_names)
     elif db_list and query_list:
@@ -50,28 +44,72 @@ def main(descriptors, output, num_matched, query_descriptors=None,
         raise ValueError('Provide either prefixes of DB and query names, '
                          'or paths to lists of DB and query images.')
 
+    if keyframes is not None:
+        # queries are restricted only if they are also database images,
+        # as localization queries are not in the list of keyframes
+        keyframes = set(parse_image_list(keyframes))
+        db_names = [n for n in db_names if n in keyframes]
+        if not has_query_descriptors:
+            query_names = [n for n in query_names if n in keyframes]
+        logging.info(f'Restricted to {len(db_names)} database and '
+                     f'{len(query_names)} query keyframes.')
+
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    def tensor_from_names(names, hfile):
-        desc = [hfile[i]['global_descriptor'].__array__() for i in names]
-        desc = torch.from_numpy(np.stack(desc, 0)).to(device).float()
-        return desc
+    mask = None
+    if index is not None:
+        logging.info(f'Searching the index {index}.')
+        index = IVFIndex(index)
+        db_set = set(db_names)
+        mask = np.array([n in db_set for n in index.names])
+        db_names = index.names
 
-    db_desc = tensor_from_names(db_names, hfile)
-    query_desc = tensor_from_names(query_names, q_hfile)
-    sim = torch.einsum('id,jd->ij', query_desc, db_desc)
-    topk = torch.topk(sim, num_matched, dim=1).indices.cpu().numpy()
+    # index of each query in the database, to remove the self-matches
+    db_index = {n: i for i, n in enumerate(db_names)}
+    self_index = torch.tensor([
+        -1 if has_query_descriptors else db_index.get(n, -1)
+        for n in query_names])
+    k = min(num_matched, len(db_names) if mask is None else int(mask.sum()))
 
-    pairs = []
-    for query, indices in zip(query_names, topk):
-        for i in indices:
-            if has_query_descriptors or query != db_names[i] :
-                pair = (query, db_names[i])
-                pairs.append(pair)
+    def exact_topk(query_desc):
+        # running top-k over the blocks of the database
+        scores = torch.full((len(query_desc), 0), -float('inf'),
+                            device=device)
+        indices = torch.zeros((len(query_desc), 0), dtype=torch.long,
+                              device=device)
+        for start in range(0, len(db_names), block_size):
+            db_desc = db_global.tensor(
+                db_names[start:start+block_size], device)
+            sim = torch.einsum('id,jd->ij', query_desc, db_desc)
+            scores = torch.cat([scores, sim], 1)
+            indices = torch.cat([indices, start + torch.arange(
+                sim.shape[1], device=device).expand_as(sim)], 1)
+            scores, top = torch.topk(scores, min(k, scores.shape[1]), dim=1)
+            indices = torch.gather(indices, 1, top)
+        return indices.cpu()
 
-    logging.info(f'Found {len(pairs)} pairs.')
+    num_pairs = 0
     with open(output, 'w') as f:
-        f.write('\n'.join(' '.join([i, j]) for i, j in pairs))
+        for q_start in range(0, len(query_names), block_size):
+            q_names = query_names[q_start:q_start+block_size]
+            query_desc = q_global.tensor(q_names, device)
+            if index is None:
+                indices = exact_topk(query_desc)
+            else:
+                _, indices = index.search(
+                    query_desc.cpu().numpy(), k, num_probes, mask)
+                indices = torch.from_numpy(indices)
+
+            valid = indices != self_index[q_start:q_start+block_size, None]
+            valid &= indices >= 0
+            rows, cols = np.nonzero(valid.numpy())
+            lines = [f'{q_names[i]} {db_names[j]}' for i, j in zip(
+                rows, indices.numpy()[rows, cols])]
+            if lines:
+                f.write(('\n' if num_pairs else '') + '\n'.join(lines))
+            num_pairs += len(lines)
+
+    logging.info(f'Found {num_pairs} pairs.')
 
 
 if __name__ == "__main__":
@@ -84,5 +122,11 @@ if __name__ == "__main__":
     parser.add_argument('--query_prefix', type=str)
     parser.add_argument('--db_list', type=Path)
     parser.add_argument('--query_list', type=Path)
+    parser.add_argument('--keyframes', type=Path,
+                        help='restrict the database images, and the queries '
+                        'if they have no separate descriptors')
+    parser.add_argument('--block_size', type=int, default=4096)
+    parser.add_argument('--index', type=Path)
+    parser.add_argument('--num_probes', type=int)
     args = parser.parse_args()
     main(**args.__dict__)
@@ -0,0 +1,125 @@
+import argparse
+import logging
+from pathlib import Path
+from collections import Counter, OrderedDict
+import h5py
+
+from .utils.parsers import names_to_pair
+
+
+'''
+Plan the matching of a list of image pairs. Duplicate pairs, in either
+order, are removed, as well as those already in the match file, and the
+remaining pairs are ordered such that consecutive pairs share an image,
+whose features are then read once and kept in the feature cache of
+utils/feature_cache.py. The orders are:
+    - 'file': the order of the pair file.
+    - 'query': grouped by the first image of the pairs.
+    - 'db': grouped by the second image of the pairs.
+    - 'auto': grouped by the image of each pair that is in the most pairs.
+The planned pairs can also be split into balanced shards for parallel
+workers.
+'''
+orders = ['file', 'query', 'db', 'auto']
+
+
+def parse_pairs(path):
+    with open(str(path), 'r') as f:
+        return [tuple(p.split(' ')) for p in f.read().rstrip('\n').split('\n')
+                if p]
+
+
+def plan_pairs(pairs, existing=(), order='auto'):
+    """Dedupe and order a list of pairs of names.
+
+    The first occurrence of a pair is kept, in its order, and a pair is
+    dropped if it is in `existing`, the set of groups of the match file.
+    """
+    if order not in orders:
+        raise ValueError(f'Unknown order {order}, choose one of {orders}.')
+    seen, planned = set(), []
+    for name0, name1 in pairs:
+        key = (name0, name1) if name0 <= name1 else (name1, name0)
+        if key in seen:
+            continue
+        seen.add(key)
+        if names_to_pair(name0, name1) not in existing:
+            planned.append((name0, name1))
+
+    if order == 'query':
+        planned.sort()
+    elif order == 'db':
+        planned.sort(key=lambda p: (p[1], p[0]))
+    elif order == 'auto':
+        degree = Counter(n for p in planned for n in p)
+
+        def key(pair):
+            pivot = max(pair, key=lambda n: (degree[n], n))
+            other = pair[1] if pivot == pair[0] else pair[0]
+            return (-degree[pivot], pivot, other)
+        planned.sort(key=key)
+    return planned
+
+
+def expected_hit_rate(pairs, cache_size, same_file=True):
+    """Simulate a feature cache of `cache_size` images over the pairs."""
+    cache, hits = OrderedDict(), 0
+    for name0, name1 in pairs:
+        for key in [(same_file, name0), (True, name1)]:
+            if key in cache:
+                hits += 1
+                cache.move_to_end(key)
+            else:
+                cache[key] = None
+                if len(cache) > cache_size:
+                    cache.popitem(last=False)
+    return hits / max(2*len(pairs), 1)
+
+
+def split_pairs(pairs, num_shards):
+    """Split the pairs into contiguous shards of balanced sizes, which
+    preserve the grouping of the pairs by image."""
+    size, rest = divmod(len(pairs), num_shards)
+    shards, start = [], 0
+    for i in range(num_shards):
+        end = start + size + (i < rest)
+        shards.append(pairs[start:end])
+        start = end
+    return shards
+
+
+def main(pairs, output, order='auto', num_shards=1, cache_size=64,
+         matches=None):
+    pair_list = parse_pairs(pairs)
+    existing = set()
+    if matches is not None and Path(matches).exists():
+        with h5py.File(str(matches), 'r') as match_file:
+            existing = set(match_file.keys())
+    planned = plan_pairs(pair_list, existing, order)
+    unordered = plan_pairs(pair_list, existing, 'file')
+    logging.info(
+        f'Planned {len(planned)} pairs out of {len(pair_list)}, expected '
+        'feature cache hit rate '
+        f'{100*expected_hit_rate(planned, cache_size):.1f}% instead of '
+        f'{100*expected_hit_rate(unordered, cache_size):.1f}%.')
+
+    shards = split_pairs(planned, num_shards)
+    for i, shard in enumerate(shards):
+        path = output if num_shards == 1 else Path(
+            str(Path(output).with_suffix(''))+f'.shard{i}.txt')
+        with open(str(path), 'w') as f:
+            f.write('\n'.join(' '.join(p) for p in shard))
+    return shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=Path, required=True)
+    parser.add_argument('--output', type=Path, required=True)
+    parser.add_argument('--order', type=str, default='auto', choices=orders)
+    parser.add_argument('--num_shards', type=int, default=1)
+    parser.add_argument('--cache_size', type=int, default=64,
+                        help='number of images in the feature cache')
+    parser.add_argument('--matches', type=Path)
+    args = parser.parse_args()
+    main(**args.__dict__)
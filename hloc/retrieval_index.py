@@ -0,0 +1,58 @@
+import argparse
+import logging
+from pathlib import Path
+import pprint
+
+from .utils.ann import IVFIndex
+from .utils.global_descriptors import GlobalDescriptors
+
+
+'''
+A set of standard index configurations that can be directly selected from the
+command line using their name. Each is a dictionary with the entries of the
+configuration of an IVFIndex, defined in utils/ann.py.
+'''
+confs = {
+    'ivf': {
+        'pq': None,
+    },
+    'ivfpq': {
+        'pq': {
+            'num_subvectors': 64,
+            'num_centroids': 256,
+        },
+    },
+}
+
+
+def main(conf, descriptors, output, num_eval=1000):
+    """Build an approximate nearest neighbor index of global descriptors.
+
+    The recall@10 w.r.t. exhaustive search is reported for increasing
+    numbers of probes on `num_eval` database descriptors, to select the
+    `num_probes` of the retrieval.
+    """
+    logging.info('Building a retrieval index with configuration:'
+                 f'\n{pprint.pformat(conf)}')
+    descriptors = GlobalDescriptors(descriptors)
+    index = IVFIndex.build(descriptors.names, descriptors.read, output, conf,
+                           num_eval)
+    logging.info(f'Indexed {len(index)} descriptors in {output}.')
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--descriptors', type=Path, required=True)
+    parser.add_argument('--output', type=Path, required=True)
+    parser.add_argument('--conf', type=str, default='ivf',
+                        choices=list(confs.keys()))
+    parser.add_argument('--num_lists', type=int)
+    parser.add_argument('--num_probes', type=int)
+    parser.add_argument('--num_eval', type=int, default=1000)
+    args = parser.parse_args()
+    conf = dict(confs[args.conf])
+    for k in ['num_lists', 'num_probes']:
+        if getattr(args, k) is not None:
+            conf[k] = getattr(args, k)
+    main(conf, args.descriptors, args.output, args.num_eval)
@@ -11,6 +11,7 @@ from .utils.read_write_model import (
         read_cameras_binary, read_images_binary, CAMERA_MODEL_NAMES)
 from .utils.database import COLMAPDatabase
 from .utils.parsers import names_to_pair
+from .utils.io import read_feature
 
 
 def create_db_from_model(empty_model, database_path):
@@ -43,7 +44,7 @@ def import_features(image_ids, database_path, features_path, use_replace=False):
     db = COLMAPDatabase.connect(database_path)
 
     for image_name, image_id in tqdm(image_ids.items()):
-        keypoints = hfile[image_name]['keypoints'].__array__()
+        keypoints = read_feature(hfile[image_name], 'keypoints')
         keypoints += 0.5  # COLMAP origin
         db.add_keypoints(image_id, keypoints, use_replace=use_replace)
 
@@ -0,0 +1,190 @@
+import json
+import logging
+from pathlib import Path
+import numpy as np
+import torch
+
+from .codecs import PQCodec, assign, kmeans
+
+
+'''
+An inverted file (IVF) index of L2-normalized global descriptors, for
+approximate nearest neighbor search in large databases. The descriptors are
+clustered by k-means into lists, and a query is only compared to the lists
+of its `num_probes` nearest centroids: increasing `num_probes` trades speed
+for recall, up to exhaustive search when it equals the number of lists. The
+descriptors can be compressed with product quantization (PQ). The index is
+saved as a directory of .npy files, which are memory-mapped when loaded.
+'''
+default_conf = {
+    'num_lists': None,  # square root of the number of descriptors if None
+    'num_probes': 8,
+    'pq': None,  # the configuration of a PQCodec, or None to store floats
+    'num_iterations': 20,
+    'num_samples': 100000,  # number of descriptors to learn the centroids
+    'seed': 0,
+}
+
+
+class IVFIndex(object):
+    def __init__(self, path):
+        path = Path(path)
+        with open(str(path / 'index.json'), 'r') as f:
+            info = json.load(f)
+        self.conf = info['conf']
+        self.names = info['names']  # sorted by list
+        self.centroids = np.load(str(path / 'centroids.npy'))
+        self.offsets = np.load(str(path / 'offsets.npy'))
+        self.vectors = np.load(str(path / 'vectors.npy'), mmap_mode='r')
+        self.pq = None
+        if self.conf['pq'] is not None:
+            self.pq = PQCodec(**self.conf['pq'])
+            self.pq.set_state({
+                'centroids': np.load(str(path / 'pq_centroids.npy'))})
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def build(cls, names, read, path, conf=None, eval_queries=0,
+              block_size=4096):
+        """Build the index of the descriptors of `names` into `path`.
+
+        `read` returns the NxD descriptors of a list of names, and is called
+        on blocks of names such that the memory is bounded. The exact
+        neighbors of `eval_queries` random descriptors are computed on the
+        way to evaluate the recall, see `recall`.
+        """
+        conf = {**default_conf, **(conf or {})}
+        rng = np.random.RandomState(conf['seed'])
+        samples = np.sort(rng.choice(
+            len(names), min(conf['num_samples'], len(names)), replace=False))
+        train = read([names[i] for i in samples]).astype(np.float32)
+        num_lists = min(
+            conf['num_lists'] or int(np.ceil(np.sqrt(len(names)))),
+            len(train))
+        logging.info(f'Learning {num_lists} lists from {len(train)} '
+                     'descriptors.')
+        centroids = kmeans(train, num_lists, conf['num_iterations'], rng)
+        pq = None
+        if conf['pq'] is not None:
+            conf['pq'] = {**PQCodec.default_conf, **conf['pq']}
+            pq = PQCodec(**conf['pq']).fit(train.T)
+
+        labels = np.concatenate([
+            assign(read(names[i:i+block_size]).astype(np.float32), centroids)
+            for i in range(0, len(names), block_size)])
+        order = np.argsort(labels, kind='stable')
+        offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(labels, minlength=num_lists))])
+
+        queries = train[rng.permutation(len(train))[:eval_queries]]
+        exact = Neighbors(len(queries), 10)
+
+        path = Path(path)
+        path.mkdir(exist_ok=True, parents=True)
+        dim = centroids.shape[1]
+        shape = (len(names), dim if pq is None else len(pq.centroids))
+        vectors = np.lib.format.open_memmap(
+            str(path / 'vectors.npy'), mode='w+', shape=shape,
+            dtype=np.float32 if pq is None else np.uint8)
+        for i in range(0, len(names), block_size):
+            block = read([names[j] for j in order[i:i+block_size]])
+            block = block.astype(np.float32)
+            exact.update(queries @ block.T, i)
+            if pq is None:
+                vectors[i:i+len(block)] = block
+            else:
+                vectors[i:i+len(block)] = pq.encode(block.T)['descriptors'].T
+        vectors.flush()
+        del vectors
+
+        np.save(str(path / 'centroids.npy'), centroids)
+        np.save(str(path / 'offsets.npy'), offsets)
+        if pq is not None:
+            np.save(str(path / 'pq_centroids.npy'), pq.centroids)
+        with open(str(path / 'index.json'), 'w') as f:
+            json.dump({'conf': conf, 'names': [names[i] for i in order]}, f)
+        index = cls(path)
+        if len(queries):
+            index.recall(queries, exact.ids)
+        return index
+
+    def read_list(self, i):
+        """The float descriptors of the i-th list."""
+        vectors = np.asarray(self.vectors[self.offsets[i]:self.offsets[i+1]])
+        if self.pq is None:
+            return vectors
+        return self.pq.decode({'descriptors': vectors.T}).T
+
+    def search(self, queries, k, num_probes=None, mask=None,
+               block_size=1024):
+        """Find the k most similar descriptors of a batch of NxD queries.
+
+        Returns NxK similarities and indices into `names`, sorted by
+        decreasing similarity and padded with -1 if fewer than k descriptors
+        were found. Descriptors whose entry of the boolean `mask` is False
+        are ignored.
+        """
+        queries = np.asarray(queries, np.float32)
+        num_probes = min(num_probes or self.conf['num_probes'],
+                         len(self.centroids))
+        centroids = torch.from_numpy(self.centroids)
+        neighbors = Neighbors(len(queries), k)
+        for start in range(0, len(queries), block_size):
+            q = torch.from_numpy(queries[start:start+block_size])
+            dist = (centroids**2).sum(1)[None] - 2 * q @ centroids.T
+            probes = torch.topk(-dist, num_probes, dim=1).indices.numpy()
+            # visit each list once for all the queries that probe it
+            for i in np.unique(probes):
+                ids = np.arange(self.offsets[i], self.offsets[i+1])
+                if mask is not None:
+                    ids = ids[mask[ids]]
+                if len(ids) == 0:
+                    continue
+                vectors = self.read_list(i)[ids - self.offsets[i]]
+                qs = np.nonzero((probes == i).any(1))[0]
+                sim = (q[qs] @ torch.from_numpy(vectors).T).numpy()
+                neighbors.update(sim, ids, start + qs)
+        return neighbors.scores, neighbors.ids
+
+    def recall(self, queries, exact_ids, num_probes=None):
+        """Log the recall@k of the search w.r.t. exact neighbors."""
+        k = exact_ids.shape[1]
+        num_lists = len(self.centroids)
+        if num_probes is None:
+            num_probes = sorted({2**i for i in range(
+                int(np.log2(num_lists)) + 1)} | {num_lists})
+        recalls = []
+        for n in num_probes:
+            _, ids = self.search(queries, k, n)
+            found = [len(set(a) & set(b)) for a, b in zip(ids, exact_ids)]
+            recalls.append(np.sum(found) / exact_ids.size)
+            logging.info(f'Recall@{k} with {n}/{num_lists} probes: '
+                         f'{100*recalls[-1]:.1f}%')
+        return recalls
+
+
+class Neighbors(object):
+    """Running top-k of the candidates of a set of queries."""
+    def __init__(self, num_queries, k):
+        self.scores = np.full((num_queries, k), -np.inf, np.float32)
+        self.ids = np.full((num_queries, k), -1, np.int64)
+
+    def update(self, sim, ids, queries=None):
+        """Add the candidates `ids` with similarities to `queries`.
+
+        `ids` is either an array of M indices or the offset of a range, and
+        `sim` the corresponding QxM similarities.
+        """
+        if queries is None:
+            queries = np.arange(len(sim))
+        if np.isscalar(ids):
+            ids = ids + np.arange(sim.shape[1])
+        k = self.scores.shape[1]
+        scores = np.concatenate([self.scores[queries], sim], 1)
+        ids = np.concatenate([
+            self.ids[queries], np.broadcast_to(ids, sim.shape)], 1)
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        self.scores[queries] = np.take_along_axis(scores, top, 1)
+        self.ids[queries] = np.take_along_axis(ids, top, 1)
@@ -1,19 +1,107 @@
 from abc import ABCMeta, abstractmethod
+import torch
 from torch import nn
 from copy import copy
 import inspect
+import logging
+
+
+class PointwiseLinear(nn.Module):
+    """A 1x1 Conv1d expressed as a Linear layer, which can be quantized."""
+    def __init__(self, conv):
+        super().__init__()
+        self.linear = nn.Linear(
+            conv.in_channels, conv.out_channels, bias=conv.bias is not None)
+        self.linear.weight.data = conv.weight.data[..., 0].clone()
+        if conv.bias is not None:
+            self.linear.bias.data = conv.bias.data.clone()
+
+    def forward(self, x):
+        return self.linear(x.transpose(1, 2)).transpose(1, 2)
+
+
+def convert_pointwise_convs(module):
+    """Recursively replace the 1x1 Conv1d layers with PointwiseLinear."""
+    for name, child in module.named_children():
+        if (isinstance(child, nn.Conv1d) and child.kernel_size == (1,)
+                and child.stride == (1,) and child.padding == (0,)
+                and child.groups == 1):
+            setattr(module, name, PointwiseLinear(child))
+        else:
+            convert_pointwise_convs(child)
+    return module
+
+
+def set_num_threads(num_threads=None, num_interop_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:  # can only be set once, before any parallel work
+            logging.warning('Could not set the number of inter-op threads.')
+
+
+def apply_backend(net, backend):
+    """Wrap a network with a CPU inference backend.
+
+    - eager: the original PyTorch module.
+    - torchscript: compile the module with torch.jit.script.
+    - compile: optimize the module with torch.compile (PyTorch >= 2.0).
+    - quantized: dynamic int8 quantization of the Linear and 1x1 Conv1d
+      layers. Dynamic quantization does not support Conv2d layers, so
+      convolutional networks like SuperPoint are left unchanged.
+    Backends that cannot be applied fall back to eager with a warning.
+    """
+    if backend == 'eager':
+        return net
+    if backend == 'torchscript':
+        try:
+            return torch.jit.script(net)
+        except Exception as e:
+            logging.warning(f'Cannot script {type(net).__name__}, using the '
+                            f'eager model: {e}')
+            return net
+    if backend == 'compile':
+        if not hasattr(torch, 'compile'):
+            logging.warning('torch.compile requires PyTorch 2.0, '
+                            'using the eager model.')
+            return net
+        return torch.compile(net)
+    if backend == 'quantized':
+        net = convert_pointwise_convs(net)
+        if not any(isinstance(m, nn.Linear) for m in net.modules()):
+            logging.warning(f'{type(net).__name__} has no layer that '
+                            'supports dynamic quantization.')
+            return net
+        return torch.quantization.quantize_dynamic(
+            net, {nn.Linear}, dtype=torch.qint8)
+    raise ValueError(f'Unknown inference backend {backend}.')
 
 
 class BaseModel(nn.Module, metaclass=ABCMeta):
     default_conf = {}
     required_data_keys = []
+    # common options of all models, see `apply_backend`
+    base_conf = {
+        'backend': 'eager',
+        'num_threads': None,
+        'num_interop_threads': None,
+    }
 
     def __init__(self, conf):
         """Perform some logic and call the _init method of the child model."""
         super().__init__()
-        self.conf = conf = {**self.default_conf, **conf}
+        self.conf = conf = {**self.base_conf, **self.default_conf, **conf}
         self.required_data_keys = copy(self.required_data_keys)
         self._init(conf)
+        set_num_threads(conf['num_threads'], conf['num_interop_threads'])
+        if conf['backend'] != 'eager':
+            if not isinstance(getattr(self, 'net', None), nn.Module):
+                logging.warning(f'{type(self).__name__} does not wrap a '
+                                'network, ignoring the inference backend.')
+            else:
+                self.net = apply_backend(self.net.eval(), conf['backend'])
 
     def forward(self, data):
         """Check the data and call the _forward method of the child model."""
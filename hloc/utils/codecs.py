@@ -0,0 +1,270 @@
+import hashlib
+import json
+from pathlib import Path
+import numpy as np
+import torch
+
+
+'''
+Compact codecs of L2-normalized local descriptors, as stored in feature files
+written by compress_features.py. A codec replaces the DxN `descriptors` of
+each image with a compressed form, and is itself stored in a sidecar
+<feature file>.codec.npz. Matchers that accept a `codec` in their
+configuration compare the compressed descriptors directly, while the others
+receive decoded float descriptors.
+'''
+
+
+class Codec(object):
+    name = None
+    default_conf = {}
+    # the datasets written in the feature file, in addition to descriptors
+    extra_keys = []
+
+    def __init__(self, **conf):
+        self.conf = {**self.default_conf, **conf}
+        self._cache = {}
+
+    def fit(self, descriptors):
+        """Learn the codec from a DxN array of descriptors."""
+        return self
+
+    def encode(self, descriptors):
+        """Encode DxN descriptors into a dict of arrays."""
+        raise NotImplementedError
+
+    def decode(self, codes):
+        """Decode a dict of arrays into DxN float32 descriptors."""
+        raise NotImplementedError
+
+    def similarity(self, data):
+        """Compute the BxNxM similarity of the encoded descriptors of a pair.
+
+        The codes are batched tensors in `data`, with suffixes 0 and 1 like
+        in the input of the matchers.
+        """
+        return torch.einsum(
+            'bdn,bdm->bnm', data['descriptors0'], data['descriptors1'])
+
+    def get_state(self):
+        return {}
+
+    def set_state(self, state):
+        pass
+
+    def tensor(self, key, device):
+        """Cache the learned arrays as tensors on each device."""
+        if (key, device) not in self._cache:
+            self._cache[key, device] = torch.from_numpy(
+                self.get_state()[key]).to(device)
+        return self._cache[key, device]
+
+    def digest(self):
+        h = hashlib.sha1(json.dumps(
+            [self.name, self.conf], sort_keys=True).encode())
+        for k, v in sorted(self.get_state().items()):
+            h.update(np.ascontiguousarray(v).tobytes())
+        return h.hexdigest()
+
+    def save(self, path):
+        np.savez(str(path), name=self.name, conf=json.dumps(self.conf),
+                 **self.get_state())
+
+    def bytes_per_descriptor(self, dim):
+        codes = self.encode(np.ones((dim, 1), np.float32) / np.sqrt(dim))
+        return sum(v.nbytes for v in codes.values())
+
+
+class PCACodec(Codec):
+    """Project descriptors onto their principal subspace and re-normalize.
+
+    The projection is not centered, such that dot products are preserved.
+    """
+    name = 'pca'
+    default_conf = {
+        'dim': 128,
+    }
+
+    def fit(self, descriptors):
+        descriptors = descriptors.astype(np.float64)
+        cov = descriptors @ descriptors.T / descriptors.shape[1]
+        _, vecs = np.linalg.eigh(cov)  # ascending eigenvalues
+        self.components = np.ascontiguousarray(
+            vecs[:, ::-1][:, :self.conf['dim']].T.astype(np.float32))
+        return self
+
+    def encode(self, descriptors):
+        proj = self.components @ descriptors.astype(np.float32)
+        proj /= np.maximum(np.linalg.norm(proj, axis=0, keepdims=True), 1e-8)
+        return {'descriptors': proj}
+
+    def decode(self, codes):
+        desc = self.components.T @ codes['descriptors'].astype(np.float32)
+        desc /= np.maximum(np.linalg.norm(desc, axis=0, keepdims=True), 1e-8)
+        return desc
+
+    def get_state(self):
+        return {'components': self.components}
+
+    def set_state(self, state):
+        self.components = state['components']
+
+
+class Int8Codec(Codec):
+    """Quantize each descriptor to int8 with its own scale.
+
+    Similarities are computed on the integer codes: their products and sums
+    are exact in float32 as long as D*127^2 < 2^24, i.e. D <= 1040, so the
+    fast float GEMM yields the result of an int8 GEMM.
+    """
+    name = 'int8'
+    extra_keys = ['descriptor_scales']
+
+    def encode(self, descriptors):
+        descriptors = descriptors.astype(np.float32)
+        scales = np.abs(descriptors).max(0) / 127
+        scales = np.maximum(scales, 1e-8)
+        codes = np.round(descriptors / scales).astype(np.int8)
+        return {'descriptors': codes, 'descriptor_scales': scales}
+
+    def decode(self, codes):
+        return (codes['descriptors'].astype(np.float32)
+                * codes['descriptor_scales'].astype(np.float32))
+
+    def similarity(self, data):
+        sim = torch.einsum(
+            'bdn,bdm->bnm', data['descriptors0'].float(),
+            data['descriptors1'].float())
+        return (sim * data['descriptor_scales0'][:, :, None]
+                * data['descriptor_scales1'][:, None, :])
+
+
+class PQCodec(Codec):
+    """Product quantization: each of M sub-vectors is replaced by the index
+    of its nearest centroid among K, learned by k-means.
+
+    The similarity of two codes is the sum over the sub-vectors of the dot
+    products of their centroids, which are looked up in the codebook, and
+    normalized by the norms of the reconstructions. The looked-up centroids
+    are compared with a single GEMM, which is faster than indexing MxKxK
+    tables of centroid dot products with PyTorch.
+    """
+    name = 'pq'
+    default_conf = {
+        'num_subvectors': 32,
+        'num_centroids': 256,
+        'num_iterations': 20,
+        'seed': 0,
+    }
+
+    def fit(self, descriptors):
+        conf = self.conf
+        assert conf['num_centroids'] <= 256
+        dim, num = descriptors.shape
+        assert dim % conf['num_subvectors'] == 0
+        rng = np.random.RandomState(conf['seed'])
+        subvectors = descriptors.astype(np.float32).reshape(
+            conf['num_subvectors'], -1, num).transpose(0, 2, 1)
+        self.centroids = np.stack([
+            kmeans(x, conf['num_centroids'], conf['num_iterations'], rng)
+            for x in subvectors])  # MxKxd
+        return self
+
+    def encode(self, descriptors):
+        num = descriptors.shape[1]
+        subvectors = descriptors.astype(np.float32).reshape(
+            len(self.centroids), -1, num).transpose(0, 2, 1)
+        codes = np.stack([assign(x, c) for x, c in zip(
+            subvectors, self.centroids)]).astype(np.uint8)
+        return {'descriptors': codes}
+
+    def decode(self, codes):
+        codes = codes['descriptors'].astype(np.int64)  # MxN
+        desc = self.centroids[np.arange(len(codes))[:, None], codes]
+        desc = desc.transpose(0, 2, 1).reshape(-1, codes.shape[1])
+        return desc / np.maximum(
+            np.linalg.norm(desc, axis=0, keepdims=True), 1e-8)
+
+    def lookup(self, codes):
+        centroids = self.tensor('centroids', codes.device)  # MxKxd
+        codes = codes.long()  # BxMxN
+        index = torch.arange(codes.shape[1], device=codes.device)
+        sub = centroids[index[None, :, None], codes]
+        b, m, n, d = sub.shape
+        desc = sub.permute(0, 1, 3, 2).reshape(b, m*d, n)
+        return torch.nn.functional.normalize(desc, dim=1)
+
+    def similarity(self, data):
+        return torch.einsum('bdn,bdm->bnm', self.lookup(data['descriptors0']),
+                            self.lookup(data['descriptors1']))
+
+    def get_state(self):
+        return {'centroids': self.centroids}
+
+    def set_state(self, state):
+        self.centroids = state['centroids']
+
+
+def assign(x, centroids):
+    """Index of the nearest centroid of each row of x."""
+    x, centroids = torch.from_numpy(x), torch.from_numpy(centroids)
+    dist = (centroids**2).sum(1)[None] - 2 * x @ centroids.T
+    return dist.argmin(1).numpy()
+
+
+def kmeans(x, k, num_iterations, rng):
+    centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+    for _ in range(num_iterations):
+        labels = assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=x[:, j], minlength=k)
+                         for j in range(x.shape[1])], 1)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # re-seed empty clusters with random points
+        centroids[empty] = x[rng.choice(len(x), empty.sum())]
+    return centroids
+
+
+codecs = {c.name: c for c in [PCACodec, Int8Codec, PQCodec]}
+
+
+def build_codec(conf):
+    conf = dict(conf)
+    name = conf.pop('name')
+    if name not in codecs:
+        raise ValueError(f'Unknown codec {name}, '
+                         f'choose one of {list(codecs.keys())}.')
+    return codecs[name](**conf)
+
+
+def codec_path(feature_path):
+    return Path(str(feature_path)+'.codec.npz')
+
+
+def load_codec(path):
+    with np.load(str(path)) as data:
+        codec = codecs[str(data['name'])](**json.loads(str(data['conf'])))
+        codec.set_state({k: data[k] for k in data.files
+                         if k not in ['name', 'conf']})
+    return codec
+
+
+def codec_for_features(*feature_paths):
+    """Load the codec shared by feature files, or None if uncompressed."""
+    found = [load_codec(codec_path(p)) if codec_path(p).exists() else None
+             for p in feature_paths]
+    if all(c is None for c in found):
+        return None
+    if any(c is None for c in found) or len(
+            set(c.digest() for c in found)) > 1:
+        raise ValueError('Feature files must be compressed with the same '
+                         f'codec to be matched: {feature_paths}.')
+    return found[0]
+
+
+def decode_features(feats, codec):
+    """Replace the encoded descriptors of a dict of features by floats."""
+    codes = {k: feats.pop(k) for k in ['descriptors'] + codec.extra_keys}
+    feats['descriptors'] = codec.decode(codes)
+    return feats
@@ -0,0 +1,129 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+import h5py
+
+
+class ContentCache:
+    """A content-addressed cache of the features of images.
+
+    Entries are keyed by the hash of the image bytes and the hash of the
+    extraction configuration, such that copies of an image in different
+    datasets are only extracted once. Each entry is a small HDF5 file, and
+    an SQLite index tracks their sizes and last use for LRU eviction once
+    the cache exceeds `max_bytes`. Entries that are referenced by external
+    links from feature files are pinned and never evicted.
+    """
+    def __init__(self, root, conf_hash, max_bytes=None):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True, parents=True)
+        self.conf_hash = conf_hash
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        # the index is used by the main and the writer threads in turn
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            str(self.root / 'index.sqlite'), timeout=60,
+            check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'image_hash TEXT, conf_hash TEXT, size INTEGER, '
+            'last_used REAL, pinned INTEGER DEFAULT 0, '
+            'PRIMARY KEY (image_hash, conf_hash))')
+        self.db.commit()
+
+    def path(self, image_hash, conf_hash=None):
+        conf_hash = conf_hash or self.conf_hash
+        return self.root / conf_hash[:16] / image_hash[:2] / (
+            image_hash+'.h5')
+
+    def get(self, image_hash):
+        """Return the path of the entry of an image, or None if missing."""
+        path = self.path(image_hash)
+        with self.lock:
+            found = self.db.execute(
+                'UPDATE entries SET last_used = ? '
+                'WHERE image_hash = ? AND conf_hash = ?',
+                (time.time(), image_hash, self.conf_hash)).rowcount > 0
+            self.db.commit()
+        if found and path.exists():
+            self.hits += 1
+            return path
+        self.misses += 1
+        return None
+
+    def copy_to(self, image_hash, feature_file, name, link=False):
+        """Copy the cached features of an image into a feature file."""
+        path = self.path(image_hash)
+        if name in feature_file:
+            del feature_file[name]
+        if link:
+            with self.lock:
+                self.db.execute(
+                    'UPDATE entries SET pinned = 1 '
+                    'WHERE image_hash = ? AND conf_hash = ?',
+                    (image_hash, self.conf_hash))
+                self.db.commit()
+            feature_file[name] = h5py.ExternalLink(str(path.resolve()), '/')
+        else:
+            parent, _, base = name.rpartition('/')
+            with h5py.File(str(path), 'r') as entry:
+                entry.copy(entry['/'], feature_file.require_group(
+                    parent or '/'), name=base)
+
+    def put(self, image_hash, grp):
+        """Add the features of an HDF5 group to the cache."""
+        path = self.path(image_hash)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with h5py.File(str(tmp), 'w') as entry:
+            for k, v in grp.items():
+                grp.copy(v, entry, name=k)
+        os.replace(str(tmp), str(path))
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(image_hash, conf_hash, size, last_used) VALUES (?, ?, ?, ?)',
+                (image_hash, self.conf_hash, path.stat().st_size,
+                 time.time()))
+            self.db.commit()
+
+    def size(self):
+        with self.lock:
+            return self.db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def evict(self):
+        """Remove the least recently used entries beyond the size limit."""
+        if self.max_bytes is None:
+            return
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT image_hash, conf_hash, size FROM entries '
+                'WHERE pinned = 0 ORDER BY last_used').fetchall()
+            for image_hash, conf_hash, size in rows:
+                if excess <= 0:
+                    break
+                path = self.path(image_hash, conf_hash)
+                if path.exists():
+                    path.unlink()
+                self.db.execute(
+                    'DELETE FROM entries '
+                    'WHERE image_hash = ? AND conf_hash = ?',
+                    (image_hash, conf_hash))
+                excess -= size
+                self.evictions += 1
+            self.db.commit()
+
+    def close(self):
+        self.evict()
+        logging.info(f'Feature cache: {self.hits} hits, {self.misses} '
+                     f'misses, {self.evictions} evictions, '
+                     f'{self.size()/1e6:.1f}MB.')
+        self.db.close()
@@ -0,0 +1,136 @@
+import threading
+from collections import OrderedDict
+import torch
+
+from .io import read_features
+from .codecs import decode_features
+
+
+def load_features(grp, device, codec=None):
+    """Read the features of an image as float tensors, ready to be matched.
+
+    Compressed descriptors are decoded if a codec is given.
+    """
+    pred = read_features(grp)
+    if codec is not None:
+        pred = decode_features(pred, codec)
+    return {k: torch.from_numpy(v).float().to(device)
+            for k, v in pred.items()}
+
+
+class FeatureCache(object):
+    """A least recently used cache of the feature tensors of images.
+
+    Matching reads the features of an image for each of its pairs, so
+    keeping them for consecutive pairs saves most of the HDF5 reads and
+    conversions if the pairs are ordered by image, see plan_pairs.py. The
+    cache holds at most `max_bytes` of tensors and can be filled ahead of
+    the matching by a Prefetcher.
+    """
+    def __init__(self, max_bytes=1 << 30, device='cpu', codec=None):
+        self.max_bytes = max_bytes
+        self.device = device
+        self.codec = codec
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.prefetches = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load, prefetch=False):
+        with self.lock:
+            if key in self.entries:
+                self.hits += not prefetch
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            if prefetch:
+                self.prefetches += 1
+            else:
+                self.misses += 1
+        value = load()
+        size = sum(v.element_size() * v.numel() for v in value.values())
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = value
+                self.sizes[key] = size
+                self.size += size
+            while self.size > self.max_bytes:
+                old, _ = self.entries.popitem(last=False)
+                self.size -= self.sizes.pop(old)
+                self.evictions += 1
+        return value
+
+    def read(self, hfile, name, prefetch=False):
+        """The feature tensors of an image of an HDF5 file."""
+        return self.get((hfile.filename, name), lambda: load_features(
+            hfile[name], self.device, self.codec), prefetch)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def capacity(self):
+        """The number of images that fit in the cache, estimated from the
+        size of the cached features, or None if the cache is empty."""
+        if len(self.entries) == 0:
+            return None
+        return int(self.max_bytes * len(self.entries) / max(self.size, 1))
+
+    def summary(self):
+        return (f'{self.hits} hits, {self.misses} misses '
+                f'({100*self.hit_rate:.1f}% hit rate), {self.prefetches} '
+                f'prefetched, {self.evictions} evictions, '
+                f'{self.size/1e6:.1f}MB in {len(self.entries)} images')
+
+
+class Prefetcher(threading.Thread):
+    """Read the features of the upcoming images into a cache, in the
+    background while the matcher is busy.
+
+    `requests` is an iterable of (HDF5 file, name) in the order in which
+    the matching reads them. The matching reports its position in the
+    requests with `advance` or `seek`, and the prefetcher stays at most
+    `lookahead` requests ahead, or half of the capacity of the cache,
+    skipping those that were passed.
+    """
+    def __init__(self, cache, requests, lookahead=32):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.requests = requests
+        self.lookahead = lookahead
+        self.position = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def seek(self, position):
+        with self.condition:
+            self.position = max(self.position, position)
+            self.condition.notify()
+
+    def advance(self, num=1):
+        self.seek(self.position + num)
+
+    def run(self):
+        for i, (hfile, name) in enumerate(self.requests):
+            # do not evict the features of the next pairs from a small cache
+            capacity = self.cache.capacity()
+            lookahead = self.lookahead if capacity is None else max(
+                min(self.lookahead, capacity // 2), 1)
+            with self.condition:
+                while (not self.stopped
+                       and i >= self.position + lookahead):
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                if i < self.position:
+                    continue
+            try:
+                self.cache.read(hfile, name, prefetch=True)
+            except Exception:
+                return  # the error is raised again when matching this pair
+
+    def close(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.join()
@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+from pathlib import Path
+import h5py
+import numpy as np
+import torch
+
+from .io import list_names
+
+
+class GlobalDescriptors(object):
+    """The global descriptors of an HDF5 file as a memory-mapped matrix.
+
+    The descriptors are exported once into a contiguous <file>.global.npy
+    matrix, with the names of its rows in <file>.global.json, such that
+    loading them does not require one HDF5 read per image. The matrix is
+    mapped read-only and thus shared by the processes that load it. It is
+    exported again whenever the size or mtime of the HDF5 file changes.
+    """
+    def __init__(self, path, key='global_descriptor'):
+        self.source = Path(path)
+        self.key = key
+        self.matrix_path = Path(str(path)+'.global.npy')
+        self.index_path = Path(str(path)+'.global.json')
+        if not self.load():
+            self.export()
+            assert self.load()
+        self.index = {n: i for i, n in enumerate(self.names)}
+
+    def stamp(self):
+        stat = os.stat(str(self.source))
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def load(self):
+        if not (self.index_path.exists() and self.matrix_path.exists()):
+            return False
+        with open(str(self.index_path), 'r') as f:
+            info = json.load(f)
+        if info['source'] != self.stamp() or info['key'] != self.key:
+            return False
+        self.matrix = np.load(str(self.matrix_path), mmap_mode='r')
+        self.names = info['names']
+        return len(self.matrix) == len(self.names)
+
+    def export(self, block_size=4096):
+        logging.info(f'Exporting the global descriptors of {self.source}.')
+        stamp = self.stamp()
+        with h5py.File(str(self.source), 'r') as hfile:
+            names = list_names(hfile)
+            dim = hfile[names[0]][self.key].shape[-1] if names else 0
+            tmp = Path(f'{self.matrix_path}.{os.getpid()}.tmp.npy')
+            matrix = np.lib.format.open_memmap(
+                str(tmp), mode='w+', dtype=np.float32,
+                shape=(len(names), dim))
+            for i in range(0, len(names), block_size):
+                matrix[i:i+block_size] = np.stack([
+                    hfile[n][self.key].__array__()
+                    for n in names[i:i+block_size]])
+            matrix.flush()
+            del matrix
+        # the index is replaced last, such that it always describes the matrix
+        os.replace(str(tmp), str(self.matrix_path))
+        tmp = Path(f'{self.index_path}.{os.getpid()}.tmp')
+        with open(str(tmp), 'w') as f:
+            json.dump({'source': stamp, 'key': self.key, 'names': names}, f)
+        os.replace(str(tmp), str(self.index_path))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def rows(self, names):
+        return np.array([self.index[n] for n in names], dtype=np.int64)
+
+    def read(self, names):
+        """The NxD descriptors of a list of names."""
+        rows = self.rows(names)
+        if len(rows) and np.all(np.diff(rows) == 1):
+            return np.array(self.matrix[rows[0]:rows[-1]+1])
+        return self.matrix[rows]
+
+    def tensor(self, names, device):
+        return torch.from_numpy(self.read(names)).to(device)
@@ -0,0 +1,315 @@
+import glob
+import os
+from pathlib import Path
+import h5py
+import numpy as np
+
+
+'''
+Storage layouts of the feature files, selected with the `storage` entry of an
+extraction configuration, either by name or as a dictionary with entries:
+    - chunks: True for automatic chunking, or the number of rows per chunk.
+    - compression: None, 'lzf', 'gzip' or 'blosc' (requires hdf5plugin).
+    - compression_opts: the compression level, if supported by the filter.
+    - shuffle: whether to apply the byte-shuffle filter before compression.
+    - {keypoints,scores,descriptors}_dtype: None to keep the dtype of the
+      prediction, 'float16', or 'uint8' to linearly quantize values in a
+      fixed range (only sensible for L2-normalized descriptors).
+Note that float16 keypoints have a resolution of 0.5 pixel above 512 pixels
+and of 1 pixel above 1024 pixels.
+'''
+default_layout = {
+    'chunks': None,
+    'compression': None,
+    'compression_opts': None,
+    'shuffle': False,
+    'keypoints_dtype': None,
+    'scores_dtype': None,
+    'descriptors_dtype': None,
+}
+layouts = {
+    'default': {},
+    'lzf': {
+        'compression': 'lzf',
+        'shuffle': True,
+    },
+    'gzip': {
+        'compression': 'gzip',
+        'compression_opts': 4,
+        'shuffle': True,
+    },
+    'half-lzf': {
+        'compression': 'lzf',
+        'shuffle': True,
+        'keypoints_dtype': 'float16',
+        'scores_dtype': 'float16',
+        'descriptors_dtype': 'float16',
+    },
+    'compact': {
+        'compression': 'lzf',
+        'shuffle': True,
+        'keypoints_dtype': 'float16',
+        'scores_dtype': 'float16',
+        'descriptors_dtype': 'uint8',
+    },
+}
+
+# range of the values of L2-normalized descriptors, for uint8 quantization
+QUANTIZATION_RANGE = (-1., 1.)
+
+
+def get_layout(layout):
+    if layout is None:
+        layout = 'default'
+    if isinstance(layout, str):
+        if layout not in layouts:
+            raise ValueError(f'Unknown storage layout {layout}, '
+                             f'choose one of {list(layouts.keys())}.')
+        layout = layouts[layout]
+    return {**default_layout, **layout}
+
+
+def filter_kwargs(layout):
+    compression = layout['compression']
+    kwargs = {}
+    if compression == 'blosc':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError('The blosc filter requires hdf5plugin: '
+                              '`pip install hdf5plugin`.')
+        kwargs.update(hdf5plugin.Blosc(
+            clevel=layout['compression_opts'] or 5,
+            shuffle=(hdf5plugin.Blosc.SHUFFLE if layout['shuffle']
+                     else hdf5plugin.Blosc.NOSHUFFLE)))
+    elif compression is not None:
+        kwargs['compression'] = compression
+        if layout['compression_opts'] is not None:
+            kwargs['compression_opts'] = layout['compression_opts']
+        kwargs['shuffle'] = layout['shuffle']
+    return kwargs
+
+
+def write_dataset(grp, key, value, layout):
+    """Write an array to a group, encoding it following a storage layout."""
+    value = np.asarray(value)
+    dtype = layout.get(f'{key}_dtype')
+    attrs = {}
+    if dtype == 'uint8' and value.dtype.kind == 'f':
+        low, high = QUANTIZATION_RANGE
+        scale = (high - low) / 255
+        value = np.round((np.clip(value, low, high) - low) / scale)
+        value = value.astype(np.uint8)
+        attrs = {'encoding': 'uint8', 'scale': scale, 'offset': low}
+    elif dtype is not None and value.dtype.kind == 'f':
+        value = value.astype(dtype)
+
+    kwargs = {}
+    if value.ndim > 0 and value.size > 0:
+        kwargs = filter_kwargs(layout)
+        chunks = layout['chunks']
+        if isinstance(chunks, int) and not isinstance(chunks, bool):
+            chunks = (min(chunks, value.shape[0]),) + value.shape[1:]
+        if chunks is not None:
+            kwargs['chunks'] = chunks
+    dset = grp.create_dataset(key, data=value, **kwargs)
+    for k, v in attrs.items():
+        dset.attrs[k] = v
+    return dset
+
+
+def write_features(grp, pred, layout=None):
+    layout = get_layout(layout)
+    for k, v in pred.items():
+        write_dataset(grp, k, v, layout)
+
+
+def read_feature(grp, key):
+    """Read and decode a single array from an HDF5 group or a dict."""
+    dset = grp[key]
+    if not isinstance(dset, h5py.Dataset):
+        return np.asarray(dset)
+    value = dset[()]
+    if dset.attrs.get('encoding') == 'uint8':
+        value = (value * dset.attrs['scale'] + dset.attrs['offset'])
+        value = value.astype(np.float32)
+    elif value.dtype == np.float16:
+        value = value.astype(np.float32)
+    return value
+
+
+def read_features(grp, keys=None):
+    if keys is None:
+        keys = list(grp.keys())
+    return {k: read_feature(grp, k) for k in keys}
+
+
+# root dataset of the feature files that lists the names of their images
+NAMES_KEY = '__names__'
+
+
+def walk_names(hfile):
+    """Find the names of the images of a file, i.e. of the groups that
+    contain datasets, without visiting all the datasets."""
+    names, stack = [], [('', hfile)]
+    while stack:
+        name, grp = stack.pop()
+        for key in grp.keys():
+            if name == '' and key == NAMES_KEY:
+                continue
+            # external links, e.g. to shards, are followed, so the names
+            # of the linked groups cannot be used
+            if grp.get(key, getclass=True) is h5py.Dataset:
+                names.append(name)
+                break
+            stack.append((f'{name}/{key}' if name else key, grp[key]))
+    return sorted(names)
+
+
+def read_index(hfile, writing=False):
+    """Read the index of names of a file, None if it may be out of date.
+
+    The index is out of date if it is marked as such by `mark_writing`,
+    unless `writing`, or if the file has top-level groups that it misses,
+    e.g. added by a writer that ignores the index.
+    """
+    index = hfile.get(NAMES_KEY)
+    if index is None or not index.attrs.get('complete', False):
+        return None
+    if index.attrs.get('writing', False) and not writing:
+        return None
+    names = sorted(n.decode() if isinstance(n, bytes) else n
+                   for n in index[()])
+    if len({n.partition('/')[0] for n in names}) != len(hfile) - 1:
+        return None
+    return names
+
+
+def list_names(hfile):
+    """List the names of the images of a feature file.
+
+    The index of names maintained by `update_names` is used if it is up to
+    date, otherwise the groups of the file are walked.
+    """
+    names = read_index(hfile)
+    return walk_names(hfile) if names is None else names
+
+
+def mark_writing(hfile):
+    """Mark the index of names as out of date until `update_names`.
+
+    If the writer dies before, readers walk the file instead. A mark left
+    by a previous writer means that it died, so that the next update also
+    walks the file.
+    """
+    index = hfile.get(NAMES_KEY)
+    if index is None:
+        return
+    if index.attrs.get('writing', False):
+        index.attrs['complete'] = False
+    index.attrs['writing'] = True
+    hfile.flush()
+
+
+def update_names(hfile, added=(), removed=()):
+    """Add and remove names from the index of names of a feature file.
+
+    The index is created from a walk of the file if missing or out of date.
+    """
+    names = read_index(hfile, writing=True)
+    names = set(walk_names(hfile) if names is None else names)
+    names = (names - set(removed)) | set(added)
+    if NAMES_KEY in hfile:
+        del hfile[NAMES_KEY]
+    index = hfile.create_dataset(NAMES_KEY, data=sorted(names),
+                                 dtype=h5py.string_dtype())
+    index.attrs['complete'] = True
+
+
+def merge_files(paths, output, link=False, index_names=True):
+    """Merge HDF5 files with disjoint groups into a single file.
+
+    Groups are either copied, or referenced through external links to the
+    original files, which must then be kept next to the output file. The
+    output is a path or an open file. Returns the names of the merged
+    groups.
+    """
+    merged = []
+    dst = output if isinstance(output, h5py.File) else h5py.File(
+        str(output), 'a')
+    output_path = dst.filename
+    if index_names:
+        mark_writing(dst)
+    try:
+        for path in paths:
+            with h5py.File(str(path), 'r') as src:
+                names = list_names(src)
+                for name in names:
+                    if name in dst:
+                        del dst[name]
+                    if link:
+                        target = os.path.relpath(
+                            str(path), str(Path(output_path).parent))
+                        dst[name] = h5py.ExternalLink(target, name)
+                    else:
+                        parent, _, base = name.rpartition('/')
+                        src.copy(src[name], dst.require_group(parent or '/'),
+                                 name=base)
+                merged += names
+        if index_names:
+            update_names(dst, merged)
+    finally:
+        if dst is not output:
+            dst.close()
+    return sorted(set(merged))
+
+
+def new_shard_run(base):
+    """A run number that no shard <base>.run{n}.shard*.h5 uses yet.
+
+    Shards that were merged as external links must be kept, so each run
+    writes its shards under new names instead of overwriting them. Shards
+    that are not linked anymore are then deleted by `remove_unlinked_shards`.
+    """
+    base = Path(base)
+    pattern = glob.escape(base.name) + '.run{}.shard*.h5'
+    run = 0
+    while any(base.parent.glob(pattern.format(run))):
+        run += 1
+    return run
+
+
+def linked_files(hfile):
+    """The absolute paths of the files that external links point to."""
+    parent = os.path.dirname(os.path.abspath(hfile.filename))
+    paths, stack = set(), [hfile]
+    while stack:
+        grp = stack.pop()
+        for key in grp.keys():
+            link = grp.get(key, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                paths.add(os.path.normpath(
+                    os.path.join(parent, link.filename)))
+            elif (isinstance(link, h5py.HardLink)
+                    and grp.get(key, getclass=True) is h5py.Group):
+                stack.append(grp[key])
+    return paths
+
+
+def remove_unlinked_shards(hfile, base):
+    """Delete the shards <base>.run*.shard*.h5 that no external link of the
+    file points to anymore, e.g. once all their groups were overwritten by a
+    later run. Shards with a journal belong to an interrupted run and are
+    kept. Returns the paths of the deleted shards.
+    """
+    linked = linked_files(hfile)
+    base = Path(base)
+    removed = []
+    for path in sorted(base.parent.glob(
+            glob.escape(base.name) + '.run*.shard*.h5')):
+        if (os.path.abspath(str(path)) in linked
+                or Path(str(path)+'.journal').exists()):
+            continue
+        path.unlink()
+        removed.append(path)
+    return removed
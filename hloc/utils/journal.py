@@ -0,0 +1,128 @@
+import logging
+import os
+import time
+from pathlib import Path
+import h5py
+
+from .io import NAMES_KEY
+
+
+class MatchJournal:
+    """Write a match file with checkpoints, such that it can be resumed.
+
+    The match file is flushed at checkpoints, every `interval` seconds,
+    after which the pairs written since the previous checkpoint are
+    appended to the journal <match file>.journal. On restart, the journal
+    gives the completed pairs in a single read instead of probing the
+    match file for each pair. Pairs that were matched but not written,
+    e.g. because of too few valid matches, can be recorded as rejected.
+
+    A journal that was not closed indicates a crash: groups written after
+    the last checkpoint may then be incomplete, and are overwritten. A
+    match file that cannot be opened anymore is moved aside and the
+    matching restarts from scratch.
+    """
+    OPENED = '# opened'
+    CLOSED = '# closed'
+
+    def __init__(self, match_path, interval=60.):
+        self.match_path = Path(match_path)
+        self.path = Path(str(match_path)+'.journal')
+        self.interval = interval
+        self.completed, self.rejected = set(), set()
+        self.recovering = False
+        loaded = self.match_path.exists() and self.load()
+
+        try:
+            self.file = h5py.File(str(self.match_path), 'a')
+        except OSError:
+            corrupt = Path(str(self.match_path)+'.corrupt')
+            logging.warning(f'Cannot open the match file {self.match_path}, '
+                            f'moving it to {corrupt}.')
+            os.replace(str(self.match_path), str(corrupt))
+            self.file = h5py.File(str(self.match_path), 'a')
+            self.completed, self.rejected = set(), set()
+            self.recovering, loaded = False, False
+
+        self.pending = []
+        if not loaded:
+            # a new match file, or one written without journal
+            self.completed = set(self.file.keys()) - {NAMES_KEY}
+            self.pending = sorted(self.completed)
+        self.journal = open(str(self.path), 'w' if not loaded else 'a')
+        self.journal.write(self.OPENED+'\n')
+        self.last = time.time()
+        self.checkpoint()
+
+    def load(self):
+        if not self.path.exists():
+            return False
+        with open(str(self.path), 'r') as f:
+            lines = f.read().split('\n')
+        # the last line is incomplete if the process died while writing it
+        lines = lines[:-1]
+        for line in lines:
+            # pairs have no space, unlike the comments and rejected pairs
+            if line.startswith('- '):
+                self.rejected.add(line[2:])
+            elif line and not line.startswith('# '):
+                self.completed.add(line)
+        self.recovering = len(lines) > 0 and lines[-1] != self.CLOSED
+        if self.recovering:
+            logging.info(f'Resuming the interrupted matches of '
+                         f'{self.match_path} from the last checkpoint.')
+        return True
+
+    def __contains__(self, pair):
+        return pair in self.completed
+
+    def write(self, pair, **data):
+        """Write the datasets of a pair to a new group of the match file."""
+        if self.recovering and pair in self.file:
+            del self.file[pair]  # possibly incomplete
+        grp = self.file.create_group(pair)
+        for k, v in data.items():
+            grp.create_dataset(k, data=v)
+        self.add(pair)
+
+    def add(self, pair):
+        """Record a pair that was written to the match file."""
+        self.completed.add(pair)
+        self.pending.append(pair)
+        self.tick()
+
+    def reject(self, pair):
+        """Record a pair that was matched but not written."""
+        self.rejected.add(pair)
+        self.pending.append('- '+pair)
+        self.tick()
+
+    def tick(self):
+        if time.time() - self.last >= self.interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.file.flush()
+        if self.pending:
+            self.journal.write(''.join(p+'\n' for p in self.pending))
+            self.pending = []
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.last = time.time()
+
+    def close(self, clean=True):
+        """Checkpoint and close the match file. The journal is marked as
+        closed only if all the groups of the file are complete."""
+        self.checkpoint()
+        if clean:
+            self.journal.write(self.CLOSED+'\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        self.journal.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(clean=exc_type is None)
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+
+def conf_hash(conf):
+    """Hash a JSON-serializable configuration, independently of key order."""
+    conf = json.dumps(conf, sort_keys=True, default=str)
+    return hashlib.sha1(conf.encode()).hexdigest()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_entry(path, hash_content=False):
+    """Describe the current state of a file: size, mtime and optional hash."""
+    stat = os.stat(str(path))
+    entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if hash_content:
+        entry['hash'] = file_hash(path)
+    return entry
+
+
+def same_content(old, new):
+    """Compare two file entries, trusting the content hash when available."""
+    if old['size'] != new['size']:
+        return False
+    if 'hash' in old and 'hash' in new:
+        return old['hash'] == new['hash']
+    return old['mtime'] == new['mtime']
+
+
+class Manifest:
+    """Record which images a feature file holds and in which state they were.
+
+    The manifest is a JSON sidecar of the feature file that maps each image
+    name to its size, mtime and, optionally, content hash at the time of
+    extraction, along with the hash of the extraction configuration. Entries
+    are staged before extraction and only committed once the features have
+    been written, so that an interrupted run can be resumed.
+    """
+    def __init__(self, path, conf_hash_):
+        self.path = Path(path)
+        self.conf_hash = conf_hash_
+        self.entries = {}
+        self.staged = {}
+
+        if self.path.exists():
+            with open(str(self.path), 'r') as f:
+                data = json.load(f)
+            if data.get('conf_hash') == conf_hash_:
+                self.entries = data['images']
+            else:
+                logging.info('The extraction configuration changed, '
+                             'all images will be re-extracted.')
+
+    @classmethod
+    def for_features(cls, feature_path, conf_hash_):
+        return cls(Path(str(feature_path)+'.manifest.json'), conf_hash_)
+
+    def diff(self, current):
+        """Split the current {name: entry} into up-to-date, todo and stale."""
+        uptodate, todo = [], []
+        for name, entry in current.items():
+            old = self.entries.get(name)
+            if old is not None and same_content(old, entry):
+                uptodate.append(name)
+            else:
+                todo.append(name)
+        stale = [n for n in self.entries if n not in current]
+        return uptodate, todo, stale
+
+    def stage(self, name, entry):
+        self.entries.pop(name, None)
+        self.staged[name] = entry
+
+    def commit(self, name):
+        self.entries[name] = self.staged.pop(name)
+
+    def remove(self, name):
+        self.entries.pop(name, None)
+        self.staged.pop(name, None)
+
+    def save(self):
+        data = {'conf_hash': self.conf_hash, 'images': self.entries}
+        tmp = self.path.with_name(self.path.name+'.tmp')
+        with open(str(tmp), 'w') as f:
+            json.dump(data, f)
+        os.replace(str(tmp), str(self.path))
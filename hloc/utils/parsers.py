@@ -25,6 +25,16 @@ def parse_image_lists_with_intrinsics(paths):
     return results
 
 
+def parse_image_list(path):
+    """Read a list of image names, one per line, e.g. a list of keyframes.
+
+    Anything after the name, such as intrinsics, is ignored.
+    """
+    with open(path, 'r') as f:
+        return [line.split(' ')[0] for line in f.read().split('\n')
+                if line.strip()]
+
+
 def parse_retrieval(path):
     retrieval = defaultdict(list)
     with open(path, 'r') as f:
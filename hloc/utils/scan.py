@@ -0,0 +1,115 @@
+import fnmatch
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def name_matcher(globs):
+    """Match file names against glob patterns, ignoring the case.
+
+    Patterns of the form '*.ext' are checked with a set of suffixes.
+    """
+    globs = [g.lower() for g in globs]
+    simple = [g for g in globs
+              if g.startswith('*.') and not any(c in g[1:] for c in '*?[')]
+    suffixes = tuple(g[1:] for g in simple)
+    others = [g for g in globs if g not in simple]
+
+    def match(name):
+        name = name.lower()
+        return (name.endswith(suffixes)
+                or any(fnmatch.fnmatchcase(name, g) for g in others))
+    return match
+
+
+def list_dir(path, cached=None):
+    """List the files and subdirectories of a directory.
+
+    As with glob, links to directories are not followed, such that loops
+    of links cannot list the same images again. The listing is reused from
+    the cache if the mtime of the directory did not change, i.e. if no
+    entry was added, removed or renamed in it.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    if cached is not None and cached['mtime'] == mtime:
+        return cached, False
+    files, dirs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif not entry.is_dir():  # skip links to directories
+                    files.append(entry.name)
+            except OSError:  # e.g. a broken link on a network drive
+                continue
+    if time.time_ns() - mtime < 2e9:
+        mtime = None  # may still change within the timestamp resolution
+    return {'mtime': mtime, 'files': sorted(files), 'dirs': sorted(dirs)}, True
+
+
+def walk(root, rel, cache, listings):
+    """Recursively list a directory tree into `listings`, keyed by the
+    POSIX path relative to the root. Returns the number of directories that
+    were actually listed."""
+    stack, num_listed = [rel], 0
+    while stack:
+        rel = stack.pop()
+        try:
+            listing, listed = list_dir(
+                os.path.join(root, rel) if rel else root, cache.get(rel))
+        except OSError as e:
+            logging.warning(f'Cannot list directory {rel}: {e}')
+            continue
+        listings[rel] = listing
+        num_listed += listed
+        stack += [f'{rel}/{d}' if rel else d for d in listing['dirs']]
+    return num_listed
+
+
+def scan_images(root, globs, index_path=None, num_threads=8):
+    """List the images under a root directory with a single walk.
+
+    Top-level directories are walked in parallel. The listings of all the
+    directories are saved to the JSON index at `index_path`, if given, such
+    that later runs only list again the directories that changed. Returns
+    the sorted paths relative to the root.
+    """
+    root = str(root)
+    cache = {}
+    if index_path is not None and Path(index_path).exists():
+        with open(str(index_path), 'r') as f:
+            data = json.load(f)
+        if data.get('root') == os.path.abspath(root):
+            cache = data['dirs']
+
+    listing, listed = list_dir(root, cache.get(''))
+    num_listed = int(listed)
+    listings = {'': listing}
+    top = listing['dirs']
+    if top:
+        with ThreadPoolExecutor(max(1, min(num_threads, len(top)))) as pool:
+            parts = [{} for _ in top]
+            num_listed += sum(pool.map(
+                lambda args: walk(root, args[0], cache, args[1]),
+                zip(top, parts)))
+        for p in parts:
+            listings.update(p)
+    logging.info(f'Listed {num_listed} of {len(listings)} directories '
+                 f'under {root}.')
+
+    changed = num_listed > 0 or listings.keys() != cache.keys()
+    if index_path is not None and changed:
+        data = {'root': os.path.abspath(root), 'dirs': listings}
+        tmp = Path(str(index_path)+'.tmp')
+        with open(str(tmp), 'w') as f:
+            json.dump(data, f)
+        os.replace(str(tmp), str(index_path))
+
+    match = name_matcher(globs)
+    paths = [Path(rel, name) for rel, listing in listings.items()
+             for name in listing['files'] if match(name)]
+    return sorted(paths)
@@ -1,6 +1,12 @@
-from torch._six import string_classes
 import collections.abc as collections
+from collections import defaultdict
+from contextlib import contextmanager
+import time
 import torch
+try:
+    from torch._six import string_classes
+except ImportError:  # removed in PyTorch 2.0
+    string_classes = (str, bytes)
 
 
 def map_tensor(input_, func):
@@ -15,3 +21,26 @@ def map_tensor(input_, func):
     else:
         raise TypeError(
             f'input must be tensor, dict or list; found {type(input_)}')
+
+
+class StageTimer:
+    """Accumulate the busy time of the stages of a threaded pipeline."""
+    def __init__(self):
+        self.busy = defaultdict(float)
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def __call__(self, stage):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.busy[stage] += time.perf_counter() - t
+
+    def utilization(self):
+        wall = time.perf_counter() - self.start
+        return {k: v / max(wall, 1e-9) for k, v in self.busy.items()}
+
+    def summary(self):
+        return ', '.join(f'{k}: {100*u:.1f}%'
+                         for k, u in self.utilization().items())
@@ -9,6 +9,7 @@ import h5py
 from .utils.read_write_model import read_images_binary, read_points3d_binary
 from .utils.viz import plot_images, plot_keypoints, plot_matches, cm_RdGn
 from .utils.parsers import names_to_pair
+from .utils.io import read_feature
 
 
 def read_image(path):
@@ -196,8 +197,8 @@ def visualize_match(image_dir, match_file, feat1_file, image_dir2=None, feat2_fi
         matches = match_item['matches0'][()]
         matching_score = match_item['matching_scores0'][()]
 
-        kpts0 = feat1_db[f0]['keypoints'][()]
-        kpts1 = feat2_db[f1]['keypoints'][()]
+        kpts0 = read_feature(feat1_db[f0], 'keypoints')
+        kpts1 = read_feature(feat2_db[f1], 'keypoints')
 
         valid = matches > -1
         mkpts0 = kpts0[valid]
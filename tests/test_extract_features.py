@@ -0,0 +1,62 @@
+import sys
+import types
+import cv2
+import numpy as np
+import torch
+
+from hloc import extract_features
+from hloc.utils.base_model import BaseModel
+
+MODULE = 'hloc.extractors.grid_test'
+
+
+class GridTest(BaseModel):
+    """Detect a fixed grid of keypoints and count the extracted images."""
+    default_conf = {'nms_radius': 1}
+    required_data_keys = ['image']
+    num_images = 0
+
+    def _init(self, conf):
+        pass
+
+    def _forward(self, data):
+        GridTest.num_images += 1
+        h, w = data['image'].shape[-2:]
+        xy = torch.stack(torch.meshgrid(
+            torch.arange(4., w, 8), torch.arange(4., h, 8),
+            indexing='xy'), -1).reshape(-1, 2)
+        return {'keypoints': [xy], 'scores': [torch.ones(len(xy))],
+                'descriptors': [torch.ones(8, len(xy)) / 8**.5]}
+
+
+GridTest.__module__ = MODULE
+
+
+def extract(image_dir, export_dir, tile_size):
+    conf = {
+        'output': 'feats-grid',
+        'model': {'name': 'grid_test'},
+        'preprocessing': {'grayscale': True},
+        'tiling': {'tile_size': tile_size, 'overlap': 8},
+    }
+    GridTest.num_images = 0
+    extract_features.main(conf, image_dir, export_dir, num_workers=0,
+                          incremental=True)
+    return GridTest.num_images
+
+
+def test_incremental_extracts_again_with_new_tiling(tmp_path, monkeypatch):
+    module = types.ModuleType(MODULE)
+    module.GridTest = GridTest
+    monkeypatch.setitem(sys.modules, MODULE, module)
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir()
+    rng = np.random.RandomState(0)
+    for i in range(2):
+        cv2.imwrite(str(image_dir / f'{i}.png'),
+                    (rng.rand(48, 64) * 255).astype(np.uint8))
+
+    # the model runs once per tile: 3x2 tiles of 32px, 2x2 tiles of 40px
+    assert extract(image_dir, tmp_path, 32) == 2 * 6
+    assert extract(image_dir, tmp_path, 32) == 0
+    assert extract(image_dir, tmp_path, 40) == 2 * 4